@@ -0,0 +1,162 @@
+# Summing the cleaned trials per place (map_id) and decade.
+
+# Every backend computes the same two tables in one pass over the trials:
+# the per-decade sums (map_id, decade, tried, executed) and, from those, the
+# totals per place (tried, executed, mortality, first and last decade). The
+# pandas backend works on a DataFrame, or on a Parquet file chunk by chunk.
+# The DuckDB backend scans a DataFrame or a Parquet file with an embedded
+# query engine that spills to disk, so the trials never have to fit in
+# memory; it's picked automatically for large inputs when duckdb is
+# installed.
+
+import os
+
+import pandas as pd
+
+from ingest import CHUNK_SIZE, sum_chunks
+
+
+KEYS = ['map_id', 'decade']
+VALUES = ['tried', 'executed']
+
+# Inputs with more rows than this go to DuckDB when it's available:
+LARGE_INPUT_ROWS = 2_000_000
+
+
+class Aggregates:
+
+    def __init__(self, per_decade, totals):
+        self.per_decade = per_decade  # map_id, decade, tried, executed
+        # map_id, tried, executed, mortality, min_decade, max_decade:
+        self.totals = totals
+
+
+def place_totals(per_decade):
+    """Totals per place from the per-decade sums (a small table)."""
+    totals = per_decade.groupby('map_id').agg(
+        tried=('tried', 'sum'), executed=('executed', 'sum'),
+        min_decade=('decade', 'min'),
+        max_decade=('decade', 'max')).reset_index()
+    totals['mortality'] = totals['executed'] / totals['tried']
+    return totals[['map_id', 'tried', 'executed', 'mortality', 'min_decade',
+                   'max_decade']]
+
+
+# BACKENDS ********************************************************************
+
+class PandasBackend:
+    name = 'pandas'
+
+    def per_decade(self, source):
+        if isinstance(source, pd.DataFrame):
+            per_decade = source.groupby(KEYS, observed=True)[VALUES].sum()
+            return per_decade.astype('int64').reset_index()
+
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(source).iter_batches(
+            batch_size=CHUNK_SIZE, columns=KEYS + VALUES)
+        return sum_chunks((batch.to_pandas() for batch in batches), KEYS,
+                          VALUES)
+
+    def aggregate(self, source):
+        per_decade = self.per_decade(source)
+        per_decade = per_decade[per_decade['map_id'].notna()]
+        return Aggregates(per_decade.reset_index(drop=True),
+                          place_totals(per_decade))
+
+
+class DuckDBBackend:
+    name = 'duckdb'
+
+    PER_DECADE = '''
+        CREATE TEMP TABLE per_decade AS
+        SELECT map_id, decade,
+               SUM(tried)::BIGINT AS tried,
+               SUM(executed)::BIGINT AS executed
+        FROM {source}
+        WHERE map_id IS NOT NULL
+        GROUP BY map_id, decade
+    '''
+    TOTALS = '''
+        SELECT map_id,
+               SUM(tried)::BIGINT AS tried,
+               SUM(executed)::BIGINT AS executed,
+               SUM(executed) / SUM(tried) AS mortality,
+               MIN(decade) AS min_decade,
+               MAX(decade) AS max_decade
+        FROM per_decade
+        GROUP BY map_id
+    '''
+
+    def __init__(self, memory_limit=None, temp_directory=None):
+        self.memory_limit = memory_limit  # e.g. '2GB'
+        self.temp_directory = temp_directory  # where to spill
+
+    def aggregate(self, source):
+        import duckdb
+
+        con = duckdb.connect()
+        try:
+            if self.memory_limit:
+                con.execute("SET memory_limit = '%s'" % self.memory_limit)
+            if self.temp_directory:
+                con.execute("SET temp_directory = '%s'" % self.temp_directory)
+            if isinstance(source, pd.DataFrame):
+                con.register('trials', source[KEYS + VALUES])
+                table = 'trials'
+            else:
+                table = "read_parquet('%s')" % source.replace("'", "''")
+
+            # the trials are scanned once, into the (small) per-decade table
+            con.execute(self.PER_DECADE.format(source=table))
+            per_decade = con.execute('SELECT * FROM per_decade '
+                                     'ORDER BY map_id, decade').df()
+            totals = con.execute(self.TOTALS + ' ORDER BY map_id').df()
+        finally:
+            con.close()
+
+        decade = per_decade['decade'].dtype
+        totals[['min_decade', 'max_decade']] = totals[[
+            'min_decade', 'max_decade']].astype(decade)
+        return Aggregates(per_decade, totals)
+
+
+BACKENDS = {'pandas': PandasBackend, 'duckdb': DuckDBBackend}
+
+
+def duckdb_available():
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def input_rows(source):
+    if isinstance(source, pd.DataFrame):
+        return len(source)
+    import pyarrow.parquet as pq
+
+    return pq.ParquetFile(source).metadata.num_rows
+
+
+def choose_backend(source, large=LARGE_INPUT_ROWS):
+    """DuckDB for inputs over `large` rows (if it's installed), pandas
+    otherwise."""
+    if input_rows(source) > large and duckdb_available():
+        return DuckDBBackend()
+    return PandasBackend()
+
+
+def aggregate_trials(source, backend='auto'):
+    """Per-decade sums and totals per place of the cleaned trials: a
+    DataFrame or the path of a Parquet file with map_id, decade, tried and
+    executed. `backend` is 'auto', a name from BACKENDS or an instance."""
+    if isinstance(source, (str, os.PathLike)):
+        source = os.fspath(source)
+    if backend == 'auto':
+        backend = choose_backend(source)
+    elif isinstance(backend, str):
+        backend = BACKENDS[backend]()
+    return backend.aggregate(source)
@@ -0,0 +1,165 @@
+# Animated map: one frame per decade, with a slider and a play button.
+
+# The coastlines and boundaries (Layers 1-3), the legend and the footer are
+# in the figure once. A frame only updates the circles, their centers and the
+# tooltips (Layers 4-6), and only with the arrays that change from one decade
+# to the next: the markers' sizes and the tooltips' positions and numbers.
+# The places' coordinates and names don't change, so they're in the base
+# traces, and every number goes out as a base64 typed array (see
+# layers.typed_array) rather than JSON text. The totals per decade come from
+# the decade index (decades.py).
+
+# python animation.py                 # trials in each decade
+# python animation.py --cumulative    # all the trials up to each decade
+
+import argparse
+
+import numpy as np
+
+import eu_witch_trials as ewt
+from batch import static_figure
+from cleaning import circle_sizes
+from decades import DecadeIndex
+from export import array_dtype, print_report, write_page
+from layers import TOOLTIP_FIELDS, tooltip_text, typed_array
+
+
+OUTPUT_FILE = 'witch_trials_animated.html'
+
+# The traces a frame updates (see data_traces in eu_witch_trials.py):
+DATA_LAYERS = ['layer-4', 'layer-5', 'layer-6']
+
+FONT = dict(color='rgba(255,234,187,0.8)', family='Almendra Display', size=18)
+
+
+# FRAMES **********************************************************************
+
+def frame_data(index, start, end, countries=None):
+    """Updates of Layers 4-6 for the decades from `start` to `end` (and only
+    the places in `countries`, if given). Places without trials in the
+    window keep their circles at size 0 and have no tooltip (their position
+    is NaN)."""
+    window = index.window(start, end)
+    active = window['tried'] > 0
+    if countries:
+        active &= index.places['CNTR_CODE'].isin(countries).to_numpy()
+    size1, size2 = circle_sizes(np.where(active, window['tried'], 0))
+    lat = np.where(active, index.places['lat'], np.nan)
+    lon = np.where(active, index.places['lon'], np.nan)
+    customdata = np.column_stack([window[name] for name in TOOLTIP_FIELDS])
+    mortality = np.where(active, window['mortality'], np.nan)
+    return [
+        {'marker': {'size': typed_array(size1 * 2)}},
+        {'marker': {'size': typed_array(size2, 'u1')}},
+        {'lat': typed_array(lat), 'lon': typed_array(lon),
+         'marker': {'size': typed_array(hit_sizes(size1 * 2), 'u1'),
+                    'color': typed_array(mortality)},
+         'customdata': typed_array(customdata, array_dtype(customdata))},
+    ]
+
+
+def hit_sizes(sizes):
+    """The invisible tooltip markers' sizes in whole pixels, one byte
+    each."""
+    return np.minimum(np.round(sizes), 255)
+
+
+def merged(trace, update):
+    """`trace` with `update` applied the way Plotly.animate applies it."""
+    trace = dict(trace)
+    for name, value in update.items():
+        if isinstance(value, dict) and isinstance(trace.get(name), dict):
+            value = merged(trace[name], value)
+        trace[name] = value
+    return trace
+
+
+def base_traces(static, index):
+    """The static figure's traces (batch.static_figure) with what doesn't
+    change between the frames filled into Layers 4-6, and the positions of
+    those three traces."""
+    positions = {trace.get('uid'): i for i, trace in enumerate(static['data'])}
+    traces = [positions[uid] for uid in DATA_LAYERS]
+
+    places = ewt.marker_columns(index.totals())
+    lat, lon = typed_array(places['lat']), typed_array(places['lon'])
+    fixed = [{'lat': lat, 'lon': lon},
+             {'lat': lat, 'lon': lon},
+             {'text': tooltip_text(places)}]
+
+    data = list(static['data'])
+    for i, update in zip(traces, fixed):
+        data[i] = merged(data[i], update)
+    return data, traces
+
+
+def animated_figure(static, index, cumulative=False, duration=400):
+    """The static figure dict (batch.static_figure) with a frame per decade
+    of the index, starting at the first one."""
+    data, traces = base_traces(static, index)
+    decades = index.decades.tolist()
+
+    frames = [{'name': str(decade),
+               'traces': traces,
+               'data': frame_data(index, decades[0] if cumulative else decade,
+                                  decade)}
+              for decade in decades]
+
+    for i, update in zip(traces, frames[0]['data']):
+        data[i] = merged(data[i], update)
+
+    animate = {'frame': {'duration': duration, 'redraw': True},
+               'transition': {'duration': 0}, 'mode': 'immediate'}
+    slider = dict(
+        active=0,
+        steps=[{'label': str(decade), 'method': 'animate',
+                'args': [[str(decade)], animate]} for decade in decades],
+        currentvalue=dict(prefix='Decade: ' if not cumulative else 'Up to: ',
+                          font=dict(FONT, size=21)),
+        font=FONT,
+        bgcolor='rgba(255,234,187,0.3)',
+        activebgcolor='rgba(255,178,0,0.9)',
+        bordercolor='rgba(0,0,0,0)',
+        tickcolor='rgba(255,234,187,0.8)',
+        x=0.12, len=0.8, y=0.05, yanchor='bottom',
+        pad=dict(t=0, b=10))
+    buttons = dict(
+        type='buttons',
+        direction='left',
+        showactive=False,
+        x=0.11, y=0.05, xanchor='right', yanchor='bottom',
+        pad=dict(t=0, b=10, r=10),
+        font=FONT,
+        bgcolor='rgba(255,234,187,0.3)',
+        buttons=[
+            dict(label='&#9654;', method='animate',
+                 args=[None, dict(animate, fromcurrent=True)]),
+            dict(label='&#10073;&#10073;', method='animate',
+                 args=[[None], dict(animate, frame=dict(duration=0,
+                                                        redraw=False))]),
+        ])
+
+    layout = dict(static['layout'], sliders=[slider], updatemenus=[buttons])
+    return {'data': data, 'layout': layout, 'frames': frames}
+
+
+# COMMAND LINE ****************************************************************
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the animated map '
+                                     '(a frame per decade) to an HTML file.')
+    parser.add_argument('--out', default=OUTPUT_FILE)
+    parser.add_argument('--cumulative', action='store_true',
+                        help='show all the trials up to each decade')
+    parser.add_argument('--duration', type=int, default=400,
+                        help='milliseconds per frame')
+    args = parser.parse_args()
+
+    index = DecadeIndex.from_arrays(ewt.pipeline.run('decade_index'))
+    fig = animated_figure(static_figure(), index, args.cumulative,
+                          args.duration)
+    print_report(*write_page(fig, args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# Small multiples: the map for several subsets of the trials (a century, a
+# range of decades, a group of countries) in one go.
+
+# Running eu_witch_trials.py once per variant redoes the geometry and the
+# whole figure every time. Here the part of the map that doesn't depend on the
+# data (Layers 1-3, the legend, the footer and the layout) is drawn once, as a
+# plain figure dict. Each variant only queries the decade index (decades.py)
+# for its window, recomputes Layers 4-6 and swaps them into that dict by uid.
+# The variants are rendered in parallel, one Kaleido per worker process (or
+# with --backend raster, drawn by raster.py without a browser).
+
+# python batch.py --centuries 1500 1600 1700 --grid
+# python batch.py --filters variants.json --out variants --workers 4
+# python batch.py --centuries 1500 1600 1700 --backend raster
+
+# where variants.json is a list of filters such as
+# [{"century": 1600}, {"decades": [1560, 1630], "countries": ["DE", "CH"]},
+#  {"name": "alps", "title": "The Alps", "countries": ["CH", "AT"]}]
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import eu_witch_trials as ewt
+from decades import DecadeIndex
+
+
+TITLE = '<b>Witch Trials in Europe<br>%s</b>'
+
+
+# FILTERS *********************************************************************
+
+def decade_range(spec):
+    """(first, last) decade of a filter, or None for all of them."""
+    if spec.get('century') is not None:
+        return spec['century'], spec['century'] + 90
+    if spec.get('decades') is not None:
+        return tuple(spec['decades'])
+    return None
+
+
+def filter_totals(index, spec):
+    """Totals per place for the filter's decades (see decades.py), limited to
+    the filter's countries."""
+    totals = index.totals(*(decade_range(spec) or ()))
+    if spec.get('countries'):
+        totals = totals[totals['CNTR_CODE'].isin(spec['countries'])]
+    return totals.reset_index(drop=True)
+
+
+def variant_name(spec):
+    if spec.get('name'):
+        return spec['name']
+    parts = []
+    decades = decade_range(spec)
+    if decades is not None:
+        parts.append('%d-%d' % (decades[0], decades[1] + 9))
+    if spec.get('countries'):
+        parts.append('_'.join(spec['countries']))
+    return '_'.join(parts) or 'all'
+
+
+def variant_title(spec):
+    if spec.get('title'):
+        return TITLE % spec['title']
+    decades = decade_range(spec)
+    period = ('%d-%d' % (decades[0], decades[1] + 9) if decades is not None
+              else '1300-1850')
+    if spec.get('countries'):
+        period += ' | ' + ', '.join(spec['countries'])
+    return TITLE % period
+
+
+# FIGURES *********************************************************************
+
+def static_figure():
+    """The map without Layers 4-6 (they're there, but empty), as a dict."""
+    base = ewt.pipeline.run('base_layers')
+    topology = ewt.pipeline.run('topology')
+    empty = ewt.pipeline.run('data_layers').iloc[:0]
+    return ewt.figure(base, topology, empty, **ewt.view).to_plotly_json()
+
+
+def variant_figure(static, index, spec):
+    df_scatter_total = ewt.marker_columns(filter_totals(index, spec))
+    traces = {trace.uid: trace.to_plotly_json()
+              for trace in ewt.data_traces(df_scatter_total)}
+
+    layout = dict(static['layout'])
+    layout['title'] = dict(layout['title'], text=variant_title(spec))
+    return {'data': [traces.get(trace.get('uid'), trace)
+                     for trace in static['data']],
+            'layout': layout}
+
+
+# WORKERS *********************************************************************
+
+# The static figure and the decade index are sent to each worker once, not
+# with every variant:
+_shared = {}
+
+
+def _init_worker(static, index_arrays, backend):
+    _shared['static'] = static
+    _shared['index'] = DecadeIndex.from_arrays(index_arrays)
+    _shared['backend'] = backend
+
+
+def _render(spec, path):
+    fig = variant_figure(_shared['static'], _shared['index'], spec)
+    ewt.render(fig, path, ewt.view['width'], ewt.view['height'],
+               _shared['backend'])
+    return path
+
+
+def render_variants(specs, out='variants', workers=None,
+                    backend=ewt.render_backend):
+    """Render a PNG per filter into `out`; returns their paths in order.
+    `backend` is 'kaleido' or 'raster' (see eu_witch_trials.render)."""
+    if backend not in ('kaleido', 'raster'):
+        raise ValueError('unknown render backend %r' % backend)
+    os.makedirs(out, exist_ok=True)
+    static = static_figure()
+    index_arrays = ewt.pipeline.run('decade_index')
+    paths = [os.path.join(out, variant_name(spec) + '.png') for spec in specs]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(static, index_arrays,
+                                       backend)) as pool:
+        return list(pool.map(_render, specs, paths))
+
+
+def make_grid(paths, path, columns=None, cell_width=350):
+    """All the PNGs side by side, `columns` to a row, in one image."""
+    from PIL import Image  # only needed for the grid
+
+    images = [Image.open(p) for p in paths]
+    columns = columns or int(len(images) ** 0.5 + 0.999)
+    rows = -(-len(images) // columns)
+    cell_height = round(cell_width * images[0].height / images[0].width)
+
+    grid = Image.new('RGB', (columns * cell_width, rows * cell_height),
+                     '#010103')
+    for i, image in enumerate(images):
+        thumb = image.convert('RGB').resize((cell_width, cell_height),
+                                            Image.LANCZOS)
+        grid.paste(thumb, ((i % columns) * cell_width,
+                           (i // columns) * cell_height))
+    grid.save(path)
+    return path
+
+
+# COMMAND LINE ****************************************************************
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the map for several '
+                                     'subsets of the witch trials.')
+    parser.add_argument('--filters', help='JSON file with a list of filters')
+    parser.add_argument('--centuries', type=int, nargs='*', default=[],
+                        help='one variant per century, e.g. 1500 1600')
+    parser.add_argument('--countries', nargs='*', default=[],
+                        help='one variant per country code, e.g. DE CH')
+    parser.add_argument('--out', default='variants')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', choices=['kaleido', 'raster'],
+                        default=ewt.render_backend,
+                        help='how to draw the PNGs')
+    parser.add_argument('--grid', action='store_true',
+                        help='also write all the variants into grid.png')
+    args = parser.parse_args()
+
+    specs = []
+    if args.filters:
+        with open(args.filters) as f:
+            specs.extend(json.load(f))
+    specs.extend({'century': century} for century in args.centuries)
+    specs.extend({'countries': [code]} for code in args.countries)
+    if not specs:
+        parser.error('no filters given')
+
+    paths = render_variants(specs, args.out, args.workers, args.backend)
+    if args.grid:
+        paths.append(make_grid(paths, os.path.join(args.out, 'grid.png')))
+    for path in paths:
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
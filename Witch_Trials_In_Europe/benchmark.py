@@ -0,0 +1,240 @@
+# Timing every stage of eu_witch_trials.py, on the real trials and on
+# synthetic ones 10x, 100x or 1000x as large.
+
+# The stages are called directly (not through the pipeline, whose cache
+# would skip them), each one `repeat` times, and the results go into a JSON
+# file (benchmarks/<date>-<commit>.json by default) that a later run can be
+# compared with, stage by stage:
+#   python benchmark.py --scales 1 10 100
+#   python benchmark.py --compare benchmarks/2026-10-17-6d82d2e.json
+
+# The synthetic datasets are made of copies of data/trials.csv resampled
+# with replacement, so the countries, regions, decades and counts keep their
+# real distribution (and joint frequencies). In every copy but the first the
+# years move within their decade, the coordinates move by up to ~1 km and
+# the sources get the copy's number, so that the copies aren't dropped as
+# duplicates by the clean stage. They're written to .bench_data/ once.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import eu_witch_trials as ewt
+import geo_prep
+from decades import DecadeIndex
+from ingest import TRIALS_FILE, TRIALS_SCHEMA, read_csv, read_trials
+from loading import load_json
+
+
+DATA_DIR = '.bench_data'
+RESULTS_DIR = 'benchmarks'
+
+
+# SYNTHETIC DATA **************************************************************
+
+def synthetic_copies(trials, scale, seed=0):
+    """`scale` copies of the trials table (all its columns), the first one
+    as it is and the others resampled and jittered, one at a time."""
+    rng = np.random.default_rng(seed)
+    yield trials
+    for copy in range(1, scale):
+        sample = trials.iloc[rng.integers(0, len(trials), len(trials))]
+        sample = sample.reset_index(drop=True)
+        dated = sample['year'].notna().to_numpy()
+        years = sample['decade'].to_numpy() + rng.integers(0, 10, len(sample))
+        sample['year'] = sample['year'].mask(
+            dated, pd.array(years, dtype=sample['year'].dtype))
+        for name in ('lon', 'lat'):
+            sample[name] = (sample[name] + rng.uniform(
+                -0.01, 0.01, len(sample))).astype(sample[name].dtype)
+        sample['record.source'] = (sample['record.source'].astype(str)
+                                   + ' #%d' % copy)
+        yield sample
+
+
+def synthetic_file(scale, source=TRIALS_FILE, folder=DATA_DIR, seed=0):
+    """Path of a CSV with `scale` times the trials of `source`, written on
+    the first call."""
+    if scale == 1:
+        return source
+    path = os.path.join(folder, 'trials_x%d_seed%d.csv' % (scale, seed))
+    if os.path.exists(path):
+        return path
+    os.makedirs(folder, exist_ok=True)
+    trials = read_csv(source, list(TRIALS_SCHEMA))
+    columns = pd.read_csv(source, nrows=0).columns
+    tmp = path + '.tmp'
+    for i, copy in enumerate(synthetic_copies(trials, scale, seed)):
+        copy[columns].to_csv(tmp, mode='w' if i == 0 else 'a',
+                             header=i == 0, index=False, na_rep='NA')
+    os.replace(tmp, path)
+    return path
+
+
+# STAGES **********************************************************************
+
+def timed(func, repeat):
+    """The result of the last call of func() and the seconds each of the
+    `repeat` calls took."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+class Run:
+    """The timings of one benchmark run."""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, stage, func, scale=None, rows=None):
+        result, times = timed(func, self.repeat)
+        self.results.append({'stage': stage, 'scale': scale, 'rows': rows,
+                             'times': times, 'min': min(times),
+                             'median': float(np.median(times))})
+        print('%-38s %6s %10s %9.3f s' % (
+            stage, '' if scale is None else 'x%d' % scale,
+            '' if rows is None else '{:,}'.format(rows), min(times)))
+        return result
+
+
+def geo_stages(run):
+    """The stages that don't depend on the trials (once per run)."""
+    for path in (geo_prep.COAST_FILE, geo_prep.NUTS_POLYGONS_FILE,
+                 geo_prep.NUTS_DOTS_FILE, geo_prep.EUROPE_FILE):
+        run.time('load_json ' + os.path.basename(path),
+                 lambda: load_json(path))
+    coast = run.time('build_coast (clipping)',
+                     lambda: geo_prep.build_coast(**ewt.coast_params))
+    run.time('build_coast_pyramid',
+             lambda: geo_prep.build_coast_pyramid(coast))
+    run.time('build_boundaries', geo_prep.build_boundaries)
+    run.time('build_centroids', geo_prep.build_centroids)
+
+    geo = ewt.pipeline.run('load_geo')
+    base = run.time('base_layers', lambda: ewt.base_layers(
+        geo, **ewt.view, indexes_to_exclude=ewt.indexes_to_exclude))
+    topology = run.time('topology', lambda: ewt.topology(
+        base, **ewt.topology_params))
+    return geo, base, topology
+
+
+def data_stages(run, scale, geo, base, topology, render=True):
+    """The stages that depend on the trials, on `scale` times as many."""
+    path = synthetic_file(scale)
+    trials = run.time('read_csv', lambda: read_csv(path), scale)
+    rows = run.results[-1]['rows'] = len(trials)
+    read_trials(path)  # writes the Parquet copy
+    trials = run.time('read_trials (parquet)', lambda: read_trials(path),
+                      scale, rows)
+
+    located = run.time('locate', lambda: ewt.locate(trials, geo), scale, rows)
+    clean = run.time('clean', lambda: ewt.clean(
+        trials, located, geo, **ewt.name_matching), scale, rows)
+    sums = run.time('rollup', lambda: ewt.rollup(clean, located), scale,
+                    rows)
+    df_map_dec = run.time('aggregate', lambda: ewt.aggregate(
+        sums, geo, ewt.nuts_levels), scale, rows)
+    index = run.time('decade_index', lambda: ewt.decade_index(df_map_dec),
+                     scale, rows)
+    df_scatter_total = run.time('data_layers', lambda: ewt.data_layers(index),
+                                scale, rows)
+    run.time('window query', lambda: DecadeIndex.from_arrays(index).window(
+        1560, 1630), scale, rows)
+    fig = run.time('figure', lambda: ewt.figure(
+        base, topology, df_scatter_total, **ewt.view), scale, rows)
+    if render:
+        with tempfile.TemporaryDirectory() as folder:
+            png = os.path.join(folder, 'map.png')
+            run.time('render', lambda: ewt.render(
+                fig, png, ewt.view['width'], ewt.view['height']), scale, rows)
+            run.time('render (raster)', lambda: ewt.render(
+                fig, png, ewt.view['width'], ewt.view['height'], 'raster'),
+                scale, rows)
+
+
+# RESULTS *********************************************************************
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(run, path=None):
+    commit = git_commit()
+    now = datetime.now()
+    if path is None:
+        name = now.strftime('%Y-%m-%d-%H%M%S')
+        path = os.path.join(RESULTS_DIR, name + ('-' + commit if commit
+                                                 else '') + '.json')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'date': now.isoformat(timespec='seconds'),
+                   'commit': commit,
+                   'python': platform.python_version(),
+                   'pandas': pd.__version__,
+                   'numpy': np.__version__,
+                   'machine': platform.platform(),
+                   'repeat': run.repeat,
+                   'results': run.results}, f, indent=1)
+    return path
+
+
+def compare(old_path, results):
+    """Print the new/old ratio of the best times, per stage and scale."""
+    with open(old_path) as f:
+        old = {(r['stage'], r['scale']): r['min']
+               for r in json.load(f)['results']}
+    print('\n%-38s %6s %9s %9s %7s' % ('vs ' + os.path.basename(old_path),
+                                       '', 'old', 'new', 'ratio'))
+    for r in results:
+        before = old.get((r['stage'], r['scale']))
+        if before:
+            print('%-38s %6s %9.3f %9.3f %6.2fx' % (
+                r['stage'], '' if r['scale'] is None else 'x%d' % r['scale'],
+                before, r['min'], r['min'] / before))
+
+
+# COMMAND LINE ****************************************************************
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the stages of the '
+                                     'map on real and synthetic data.')
+    parser.add_argument('--scales', type=int, nargs='*', default=[1, 10, 100],
+                        help='sizes of the trials data, as multiples of '
+                        'data/trials.csv (e.g. 1 10 100 1000)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-render', action='store_true',
+                        help="don't time the PNG rendering")
+    parser.add_argument('--out', help='JSON file for the results')
+    parser.add_argument('--compare', help='an earlier results file')
+    args = parser.parse_args()
+
+    run = Run(args.repeat)
+    geo, base, topology = geo_stages(run)
+    for scale in args.scales:
+        data_stages(run, scale, geo, base, topology, not args.no_render)
+
+    print(save(run, args.out))
+    if args.compare:
+        compare(args.compare, run.results)
+
+
+if __name__ == '__main__':
+    main()
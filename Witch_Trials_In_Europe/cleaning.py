@@ -0,0 +1,84 @@
+# Cleaning and re-ordering the witch trials dataset (see "WITCH TRIALS
+# DATASET" in eu_witch_trials.py for why each step is needed).
+
+# Every step works on whole columns (masks, map, np.select) rather than
+# DataFrame.apply(axis=1), which builds a Series for every row.
+
+import numpy as np
+import pandas as pd
+
+
+# NUTS level by the length of the NUTS code:
+NUTS_LEVELS = {5: 3, 4: 2, 3: 1, 2: 0}
+
+
+def put(column, where, value):
+    """`column` with `value` where `where` is True; works for categorical
+    columns too (the value is added to the categories if needed)."""
+    if (isinstance(column.dtype, pd.CategoricalDtype)
+            and value not in column.cat.categories):
+        column = column.cat.add_categories([value])
+    return column.mask(where, value)
+
+
+def fix_regions(trials):
+    """Fixing a few mistakes in the country, region and county columns."""
+    trials = trials.copy()
+
+    # Valais is in Switzerland, not in France.
+    trials['country'] = put(trials['country'],
+                            trials['gadm.adm1'] == 'Valais', 'Switzerland')
+
+    # There's Appenzell Ausserrhoden and Appenzell Innerrhoden, and according
+    # to the data from surrounding years, "Appenzell" stands for Appenzell
+    # Ausserrhoden: 1) They have no intersectional years. 2) The death rate is
+    # 100% in both.
+    trials['gadm.adm1'] = put(trials['gadm.adm1'],
+                              trials['gadm.adm1'] == 'Appenzell',
+                              'Appenzell Ausserrhoden')
+
+    # Luxembourg is also a region in Belgium.
+    trials['gadm.adm2'] = put(trials['gadm.adm2'],
+                              (trials['gadm.adm1'] == 'Wallonie')
+                              & (trials['gadm.adm2'] == 'Luxembourg'),
+                              'Luxembourg (BE)')
+
+    trials['city'] = put(trials['city'], trials['city'] == 'kotz', 'Kotz')
+    return trials
+
+
+def new_region(trials, nuts_dict_1, nuts_dict_2, detail):
+    """The region each trial is counted in: a merged region from one of the
+    dictionaries, or else the column named by `detail` for the country
+    ('gadm.adm1', 'gadm.adm2' or 'country'). None where there's no match."""
+    adm1 = trials['gadm.adm1']
+    adm2 = trials['gadm.adm2']
+    country = trials['country']
+    level = country.map(detail)
+
+    return pd.Series(np.select(
+        [adm1.isin(nuts_dict_1.keys()),
+         adm2.isin(nuts_dict_2.keys()),
+         level == 'gadm.adm1',
+         level == 'gadm.adm2',
+         level == 'country'],
+        [adm1.map(nuts_dict_1),
+         adm2.map(nuts_dict_2),
+         adm1,
+         adm2,
+         country],
+        default=None), index=trials.index, dtype='object')
+
+
+def nuts_level(map_id):
+    """NUTS level (0-3) of each NUTS code, read from the code's length."""
+    return map_id.str.len().map(NUTS_LEVELS)
+
+
+def circle_sizes(tried):
+    """Circles' sizes (to compare their areas, not radiuses, divide by pi)
+    and their centers' sizes; zero where nobody was tried."""
+    tried = np.asarray(tried)
+    size1 = np.where(tried == 0, 0, np.sqrt(tried / np.pi) * 1.5)
+    size2 = np.where(tried == 0, 0, 3)
+    return size1, size2
@@ -0,0 +1,135 @@
+# Time-window queries over the per-decade table (df_map_dec).
+
+# "1560-1630 only" used to mean filtering the table again and re-running the
+# groupbys behind the tooltips. Instead, the table is turned once into dense
+# places x decades arrays with cumulative sums along the decades, so that the
+# totals for any window are the difference of two columns, and the first and
+# last active decade are one lookup each: O(places) per query, no pandas.
+
+import numpy as np
+import pandas as pd
+
+
+PLACE_COLUMNS = ['index', 'CNTR_CODE', 'NAME_LATN', 'lon', 'lat']
+
+
+class DecadeIndex:
+    """`tried` and `executed` per place (row) and decade (column), stored as
+    cumulative sums with a leading zero column, plus for every decade the
+    position of the nearest decade with data at or after it (`next_active`)
+    and at or before it (`prev_active`), -1/D where there's none."""
+
+    def __init__(self, places, decades, tried_cum, executed_cum, next_active,
+                 prev_active):
+        self.places = places  # DataFrame with the PLACE_COLUMNS
+        self.decades = np.asarray(decades, dtype='int64')
+        self.tried_cum = np.asarray(tried_cum, dtype='int64')
+        self.executed_cum = np.asarray(executed_cum, dtype='int64')
+        self.next_active = np.asarray(next_active, dtype='int64')
+        self.prev_active = np.asarray(prev_active, dtype='int64')
+
+    @classmethod
+    def from_table(cls, df_map_dec, step=10):
+        """Build the index from df_map_dec (one row per place and decade;
+        places without any trials have a NaN decade)."""
+        ids, row = np.unique(df_map_dec['index'].to_numpy(dtype=str),
+                             return_inverse=True)
+        first = np.unique(row, return_index=True)[1]
+        places = df_map_dec.iloc[first][PLACE_COLUMNS].reset_index(drop=True)
+
+        dated = df_map_dec['decade'].notna().to_numpy()
+        decade = df_map_dec['decade'].to_numpy()[dated].astype('int64')
+        if len(decade):
+            decades = np.arange(decade.min(), decade.max() + step, step)
+        else:
+            decades = np.zeros(0, dtype='int64')
+        n, d = len(ids), len(decades)
+        col = (decade - (decades[0] if d else 0)) // step
+
+        tried = np.zeros((n, d), dtype='int64')
+        executed = np.zeros((n, d), dtype='int64')
+        active = np.zeros((n, d), dtype=bool)
+        np.add.at(tried, (row[dated], col),
+                  df_map_dec['tried'].to_numpy()[dated].astype('int64'))
+        np.add.at(executed, (row[dated], col),
+                  df_map_dec['executed'].to_numpy()[dated].astype('int64'))
+        active[row[dated], col] = True
+
+        positions = np.broadcast_to(np.arange(d), (n, d))
+        prev_active = np.maximum.accumulate(np.where(active, positions, -1),
+                                            axis=1)
+        next_active = np.minimum.accumulate(
+            np.where(active, positions, d)[:, ::-1], axis=1)[:, ::-1]
+
+        zero = np.zeros((n, 1), dtype='int64')
+        return cls(places, decades,
+                   np.hstack([zero, np.cumsum(tried, axis=1)]),
+                   np.hstack([zero, np.cumsum(executed, axis=1)]),
+                   next_active, prev_active)
+
+    def __len__(self):
+        return len(self.places)
+
+    def to_arrays(self):
+        arrays = {'place.' + name: self.places[name].to_numpy()
+                  for name in PLACE_COLUMNS}
+        arrays['place.index'] = arrays['place.index'].astype(str)
+        arrays['place.CNTR_CODE'] = arrays['place.CNTR_CODE'].astype(str)
+        arrays['place.NAME_LATN'] = arrays['place.NAME_LATN'].astype(str)
+        arrays.update(decades=self.decades, tried_cum=self.tried_cum,
+                      executed_cum=self.executed_cum,
+                      next_active=self.next_active,
+                      prev_active=self.prev_active)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        places = pd.DataFrame({name: np.asarray(arrays['place.' + name])
+                               for name in PLACE_COLUMNS})
+        places[['index', 'CNTR_CODE', 'NAME_LATN']] = places[[
+            'index', 'CNTR_CODE', 'NAME_LATN']].astype(object)
+        return cls(places, arrays['decades'], arrays['tried_cum'],
+                   arrays['executed_cum'], arrays['next_active'],
+                   arrays['prev_active'])
+
+    # QUERIES *****************************************************************
+
+    def span(self, start=None, end=None):
+        """Column positions [a, b) of the decades within [start, end]."""
+        a = 0 if start is None else np.searchsorted(self.decades, start)
+        b = (len(self.decades) if end is None
+             else np.searchsorted(self.decades, end, side='right'))
+        return a, max(a, b)
+
+    def window(self, start=None, end=None):
+        """tried, executed, mortality (NaN where nobody was tried) and the
+        first and last decade with trials (0 where there are none) of every
+        place between the decades `start` and `end`, both included."""
+        a, b = self.span(start, end)
+        tried = self.tried_cum[:, b] - self.tried_cum[:, a]
+        executed = self.executed_cum[:, b] - self.executed_cum[:, a]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mortality = executed / tried
+
+        n = len(self)
+        min_decade = np.zeros(n, dtype='int64')
+        max_decade = np.zeros(n, dtype='int64')
+        if b > a:
+            first = self.next_active[:, a]
+            last = self.prev_active[:, b - 1]
+            found = first < b
+            min_decade[found] = self.decades[first[found]]
+            max_decade[found] = self.decades[last[found]]
+
+        return {'tried': tried, 'executed': executed, 'mortality': mortality,
+                'min_decade': min_decade, 'max_decade': max_decade}
+
+    def totals(self, start=None, end=None):
+        """The window as a table with the places' columns, laid out like the
+        one data_layers() in eu_witch_trials.py starts from."""
+        table = self.places.copy()
+        window = self.window(start, end)
+        for name in ('min_decade', 'max_decade', 'tried', 'executed',
+                     'mortality'):
+            table[name] = window[name]
+        return table
@@ -7,6 +7,12 @@
 # Eurostat https://ec.europa.eu/eurostat/web/gisco
 # leakyMirror's repo https://github.com/leakyMirror/map-of-europe
 
+# The script is split into stages (load_geo, load_trials, locate, clean,
+# rollup, aggregate, decade_index, base_layers, topology, data_layers,
+# figure, render). Each one's output is kept in .stage_cache/ and only
+# rebuilt when its inputs, files, parameters or code change (see
+# pipeline.py), so restyling the map only reruns figure and render.
+
 
 # IMPORTING THE PACKAGES ******************************************************
 # *****************************************************************************
@@ -17,41 +23,128 @@ import numpy as np
 import plotly.graph_objects as go
 import plotly.io as pio
 
-import geopandas as gpd
-import chardet
+from geo_cache import (GeoCache, feature_collection, line_arrays,
+                       select_features)
+import geo_prep
+from cleaning import circle_sizes, fix_regions
+from decades import DecadeIndex
+from ingest import TRIALS_FILE, read_trials
+from regions import REGION_MAP_FILE, RegionLookup, drop_unresolved
+from layers import (TOOLTIP_TEMPLATE, add_line_layers, merge_lines,
+                    tooltip_data)
+from pipeline import Pipeline
+from rollup import RollUp
+from profiling import REPORT_FILE, Profiler, from_environment
+from simplify import LOD_TOLERANCES, build_pyramid, pick_level, pyramid_level
+from fuzzy import NameIndex
+from spatial import PolygonLocator
+from topology import STEP, Topology
+
+
+# SETTINGS ********************************************************************
+# *****************************************************************************
+
+OUTPUT_FILE = 'proportional_symbols.png'
+
+# The picture's size and the part of the map it shows:
+view = {'width': 1050, 'height': 1395,
+        'lon_range': [-13, 30], 'lat_range': [37, 73.75]}
+
+# Region names without a NUTS code are matched to the NUTS names (see
+# fuzzy.py): the matches that score at least `threshold` are printed, and
+# used if `apply` is True.
+name_matching = {'threshold': 0.8, 'apply': False}
+
+# The NUTS level (0-3) a country is shown at, by country code, where it
+# should differ from the level of detail in data/region_map_v1.csv (see
+# rollup.py), e.g. {'DE': 1}:
+nuts_levels = {}
+
+# Grid the boundaries are snapped to, in degrees (see topology.py):
+topology_params = {'step': STEP}
+
+# How the PNG is drawn: 'kaleido' (plotly's headless browser) or 'raster'
+# (see raster.py: a few times faster, with nearly the same pixels):
+render_backend = 'kaleido'
+
+# Stage timing and memory (see profiling.py): on with WITCH_TRIALS_PROFILE
+# set, or with --profile.
+pipeline = Pipeline('.stage_cache', profiler=from_environment())
 
 
 # UPLOADING THE DATA **********************************************************
 # *****************************************************************************
 
-# 1. Eurostat GeoJSON files:
+# The GeoJSON files are parsed and trimmed down to what the map needs only
+# once: the results are kept in .geo_cache/ and reused for as long as the
+# source files stay the same (see geo_prep.py for the processing steps and
+# geo_cache.py for the storage).
+
+geo_cache = GeoCache('.geo_cache', profiler=pipeline.profiler)
+
+coast_params = {'window': geo_prep.COAST_WINDOW, 'mask': geo_prep.EUROPE_MASK,
+                'island_area': geo_prep.ISLAND_AREA}
+
+
+@pipeline.stage(sources=[geo_prep.COAST_FILE, geo_prep.NUTS_POLYGONS_FILE,
+                         geo_prep.EUROPE_FILE, geo_prep.NUTS_DOTS_FILE],
+                params={**coast_params, 'tolerances': LOD_TOLERANCES},
+                store=False)  # stored by geo_cache
+def load_geo(tolerances, **coast_params):
+
+    # 1. Eurostat GeoJSON files:
+
+    # World's coastlines --> European coastlines (lines) and lands (polygons)
+    coast = geo_cache.get('coast', [geo_prep.COAST_FILE],
+                          lambda: geo_prep.build_coast(**coast_params),
+                          params=coast_params)
 
-# EU country polygons
-enc_p = chardet.detect(open('geo/eu_polygons_10_2021.geojson',
-                            'rb').read())['encoding']
-with open('geo/eu_polygons_10_2021.geojson', 'r', encoding=enc_p) as f:
-    geojson = json.load(f)
+    # EU country polygons + Ukraine's, Belarus's, and Russia's boundaries from
+    # an additional GeoJSON
+    boundaries = geo_cache.get(
+        'boundaries', [geo_prep.NUTS_POLYGONS_FILE, geo_prep.EUROPE_FILE],
+        geo_prep.build_boundaries)
 
-# World's coastlines
-enc_c = chardet.detect(open('geo/coast_10_2016.geojson', 'rb').read())['encoding']
-with open('geo/coast_10_2016.geojson', 'r', encoding=enc_c) as f:
-    json_coast_l = json.load(f)  # polygons --> to transform into lines
-with open('geo/coast_10_2016.geojson', 'r', encoding=enc_c) as f:
-    json_coast_p = json.load(f)  # polygons -- > to stay polygons :-)
+    # Both simplified at a few tolerances (see "TRANSFORMING THE GEOJSON
+    # FILES" below):
+    coast_lod = geo_cache.get('coast_lod', [geo_prep.COAST_FILE],
+                              lambda: geo_prep.build_coast_pyramid(
+                                  coast, tolerances),
+                              params={**coast_params,
+                                      'tolerances': tolerances})
+    boundaries_lod = geo_cache.get(
+        'boundaries_lod', [geo_prep.NUTS_POLYGONS_FILE, geo_prep.EUROPE_FILE],
+        lambda: build_pyramid(boundaries, tolerances),
+        params={'tolerances': tolerances})
 
-# 2. Additional GeoJSON (to add Ukraine's, Belarus's, and Russia's boundaries):
+    # NUTS-3 regions' polygons, to place the trials by their coordinates
+    nuts_regions = geo_cache.get('nuts_regions', [geo_prep.NUTS_POLYGONS_FILE],
+                                 geo_prep.build_nuts_regions)
 
-enc_a = chardet.detect(open('geo/europe.geojson', 'rb').read())['encoding']
-with open('geo/europe.geojson', 'r', encoding=enc_a) as f:
-    geojson_add = json.load(f)
+    # The n-gram index of the NUTS names, to match misspelled regions
+    nuts_names = geo_cache.get('nuts_names', [geo_prep.NUTS_DOTS_FILE],
+                               geo_prep.build_name_index)
 
-# 3. Datasets:
+    # 2. Datasets:
+
+    # EU geo data (NUTS regions' centroids)
+    nuts = geo_prep.Centroids(
+        geo_cache.get('nuts_centroids', [geo_prep.NUTS_DOTS_FILE],
+                      geo_prep.build_centroids))
+
+    return {'coast_lod': coast_lod, 'boundaries_lod': boundaries_lod,
+            'nuts_regions': nuts_regions, 'nuts_names': nuts_names,
+            'nuts': nuts}
 
-# EU geo data
-nuts = gpd.read_file('geo/eu_dots_10_2021.geojson')
 
 # Witch trials dataset
-trials = pd.read_csv('data/trials.csv')
+
+# (typed and cut down to the columns used, read from a Parquet copy of the
+# CSV after the first run, see ingest.py)
+
+@pipeline.stage(sources=[TRIALS_FILE, 'ingest.py'], store=False)
+def load_trials():
+    return read_trials(TRIALS_FILE)
 
 
 # WITCH TRIALS DATASET ********************************************************
@@ -89,901 +182,552 @@ trials = pd.read_csv('data/trials.csv')
 # with minimum value losses). I define them for each country individually. So, 
 # for each country, detalization differs. 
 
+# Rows whose regions can't be matched to NUTS are dropped, unless their
+# region's name is close enough to a NUTS name (if name_matching allows it)
+# or they have coordinates: then the NUTS-3 region they fall into (and the NUTS-2 and
+# NUTS-1 regions it's part of) decides. All the points are placed at once,
+# with an STRtree over the polygons (see spatial.PolygonLocator).
 
-# Fixing the data types and some mistakes *************************************
-
-trials = trials.rename(columns={'gadm.adm0': 'country', 'deaths': 'executed'})
-
-trials['executed'] = trials['executed'].fillna(0).astype('int')
-
-trials = trials.drop_duplicates()
-
-
-def fix_region_0(s):
-    if s['gadm.adm1'] == 'Valais':  # Valais is in Switzerland, not in France.
-        return 'Switzerland'
-    else:
-        return s['country']
-
-
-trials['country'] = trials.apply(fix_region_0, axis=1)
-
-
-def fix_region_1(s):
-    if s['gadm.adm1'] == 'Appenzell':  # There's Appenzell Ausserrhoden and 
-        # Appenzell Innerrhoden, and according to the data from surrounding 
-        # years, "Appenzell" stands for Appenzell Ausserrhoden: 1) They 
-        # have no intersectional years. 2) The death rate is 100% in both.
-        return 'Appenzell Ausserrhoden'
-    else:
-        return s['gadm.adm1']
-
-
-trials['gadm.adm1'] = trials.apply(fix_region_1, axis=1)
-
-
-def fix_region_2(s):
-    if s['gadm.adm1'] == 'Wallonie' and s[
-            'gadm.adm2'] == 'Luxembourg':  # Luxembourg is also a region in 
-                                           # Belgium.
-        return 'Luxembourg (BE)'
-    else:
-        return s['gadm.adm2']
-
-
-trials['gadm.adm2'] = trials.apply(fix_region_2, axis=1)
-
-trials['city'] = trials['city'].replace('kotz', 'Kotz')
-
-
-# Re-ordering the dataset *****************************************************
-
-# The next column will do one of the following: 
-# update the country's regional division in cases where it changes; 
-# unite several territories into one in line with EU NUTS; 
-# divide each country with the required detail (country, region, or county):
-
-nuts_dict_1 = {
-    
-    # Denmark
-    'Fyn': 'Southern Denmark', 
-    'Ribe': 'Southern Denmark', 
-    'South Jutland': 'Southern Denmark',
-    'Ringkobing': 'Central Jutland',
-    'Storstrom': 'Zealand',
-    
-    # Ireland
-    'Cork': 'Southern', 
-    'Kilkenny': 'Southern', 
-    'Clare': 'Southern', 
-    'Wexford': 'Southern',
-    'Waterford': 'Southern', 
-    'Tipperary': 'Southern', 
-    'Limerick': 'Southern',
-    'Louth': 'Eastern and Midland', 
-    'Meath': 'Eastern and Midland', 
-    'Dublin': 'Eastern and Midland',
-    'Donegal': 'Northern and Western', 
-    'Galway': 'Northern and Western',
-    
-    # Portugal
-    'Faro': 'Algarve',
-    'Grevenmacher': 'Luxembourg', 
-    'Luxembourg': 'Luxembourg',
-}
-
-nuts_dict_2 = {
-    
-    # Germany
-    'Magdeburg': 'Sachsen-Anhalt',
-    'Dessau': 'Sachsen-Anhalt', 
-    'Halle': 'Sachsen-Anhalt',
-
-    # UK
-    'Hertfordshire': 'Bedfordshire and Hertfordshire', 
-    'Bedfordshire': 'Bedfordshire and Hertfordshire',
-    'Oxfordshire': 'Berkshire, Buckinghamshire and Oxfordshire', 
-    'Buckinghamshire': 'Berkshire, Buckinghamshire and Oxfordshire', 
-    'Berkshire': 'Berkshire, Buckinghamshire and Oxfordshire',
-    'Cornwall': 'Cornwall and Isles of Scilly',
-    'Nottingham': 'Derbyshire and Nottinghamshire', 
-    'Derby': 'Derbyshire and Nottinghamshire', 
-    'Derbyshire': 'Derbyshire and Nottinghamshire',
-    'Dorset': 'Dorset and Somerset', 
-    'Somerset': 'Dorset and Somerset',
-    'Norfolk': 'East Anglia', 
-    'Cambridgeshire': 'East Anglia', 
-    'Suffolk': 'East Anglia',
-    'Cardiff': 'East Wales',
-    'East Riding of Yorkshire': 'East Yorkshire and Northern Lincolnshire',
-    'Fife': 'Eastern Scotland', 
-    'Stirling': 'Eastern Scotland', 
-    'Angus': 'Eastern Scotland',
-    'Perthshire and Kinross': 'Eastern Scotland', 
-    'Edinburgh': 'Eastern Scotland',
-    'East Lothian': 'Eastern Scotland', 
-    'West Lothian': 'Eastern Scotland', 
-    'Clackmannanshire': 'Eastern Scotland',
-    'Wiltshire': 'Gloucestershire, Wiltshire and Bristol/Bath area', 
-    'Bristol': 'Gloucestershire, Wiltshire and Bristol/Bath area', 
-    'Gloucestershire': 'Gloucestershire, Wiltshire and Bristol/Bath area',
-    'Manchester': 'Greater Manchester',
-    'Hampshire': 'Hampshire and Isle of Wight',
-    'Southampton': 'Hampshire and Isle of Wight',
-    'Worcestershire': 'Herefordshire, Worcestershire and Warwickshire',
-    'Warwickshire': 'Herefordshire, Worcestershire and Warwickshire',
-    'Highland': 'Highlands and Islands',
-    'Orkney Islands': 'Highlands and Islands', 
-    'Argyll and Bute': 'Highlands and Islands',
-    'Shetland Islands': 'Highlands and Islands', 
-    'Moray': 'Highlands and Islands',
-    'Leicester': 'Leicestershire, Rutland and Northamptonshire',
-    'Rutland': 'Leicestershire, Rutland and Northamptonshire',
-    'Northamptonshire': 'Leicestershire, Rutland and Northamptonshire',
-    'Aberdeenshire': 'North Eastern Scotland', 
-    'Aberdeen': 'North Eastern Scotland',
-    'York': 'North Yorkshire',
-    'Newry and Mourne': 'Northern Ireland', 
-    'Lisburn': 'Northern Ireland',
-    'Dungannon': 'Northern Ireland',
-    'Derry': 'Northern Ireland', 
-    'Armagh': 'Northern Ireland',
-    'Antrim': 'Northern Ireland',
-    'Tyne and Wear': 'Northumberland and Tyne and Wear', 
-    'Northumberland': 'Northumberland and Tyne and Wear',
-    'Richmond upon Thames': 'Outer London — West and North West', 
-    'Hounslow': 'Outer London — West and North West',
-    'Shropshire': 'Shropshire and Staffordshire',
-    'Staffordshire': 'Shropshire and Staffordshire',
-    'Scottish Borders': 'Southern Scotland',
-    'South Ayrshire': 'Southern Scotland',
-    'Dumfries and Galloway': 'Southern Scotland',
-    'South Lanarkshire': 'Southern Scotland',
-    'East Ayrshire': 'Southern Scotland',
-    'East Sussex': 'Surrey, East and West Sussex',
-    'West Sussex': 'Surrey, East and West Sussex',
-    'Brighton and Hove': 'Surrey, East and West Sussex',
-    'Durham': 'Tees Valley and Durham',
-    'Darlington': 'Tees Valley and Durham',
-    'West Dunbartonshire': 'West Central Scotland',
-    'Renfrewshire': 'West Central Scotland',
-    'North Lanarkshire': 'West Central Scotland',
-    'Carmarthenshire': 'West Wales and The Valleys', 
-    'Pembrokeshire': 'West Wales and The Valleys'
-}
-
-def new_region(s):
-    
-    if s['gadm.adm1'] in list(nuts_dict_1.keys()):
-        return nuts_dict_1[s['gadm.adm1']]
-    
-    elif s['gadm.adm2'] in list(nuts_dict_2.keys()):
-        return nuts_dict_2[s['gadm.adm2']]
-    
-    elif s['country'] in ('Austria', 'Czech Republic', 'France', 'Italy',
-                          'Netherlands', 'Poland', 'Spain', 'Sweden',
-                          'Switzerland'):
-        return s['gadm.adm1']  # detailing at the regional level
-
-    elif s['country'] in ('Belgium', 'Germany', 'United Kingdom'):
-        return s['gadm.adm2']  # detailing at the county level
-
-    elif s['country'] in ('Estonia', 'Finland', 'Hungary', 'Norway'):
-        return s['country']  # detailing at the country level
-
-trials['new_region'] = trials.apply(new_region, axis=1)
-
-
-# The next column assigns a corresponding NUTS code to each county, region, or 
-# country in the new_region column:
-
-new_id_dict = {
-    'Niederosterreich': 'AT12',
-    'Wien': 'AT13',
-    'Steiermark': 'AT22',
-    'Oberosterreich': 'AT31',
-    'Salzburg': 'AT32',
-    'Tirol': 'AT33',
-    'Vorarlberg': 'AT34',
-    'Namur': 'BE35',
-    'Liege': 'BE33',
-    'Hainaut': 'BE32',
-    'Brabant Wallon': 'BE31',
-    'Luxembourg (BE)': 'BE34',
-    'Bruxelles': 'BE10',
-    'West-Vlaanderen': 'BE25',
-    'Oost-Vlaanderen': 'BE23',
-    'Vlaams Brabant': 'BE24',
-    'Antwerpen': 'BE21',
-    'Plzensky': 'CZ032',
-    'Jihocesky': 'CZ031',
-    'Prague': 'CZ010',
-    'Jihomoravsky': 'CZ064',
-    'Stredocesky': 'CZ020',
-    'Olomoucky': 'CZ071',
-    'Alsace': 'FRF1',
-    'Aquitaine': 'FRI1',
-    'Auvergne': 'FRK1',
-    'Basse-Normandie': 'FRD1',
-    'Bourgogne': 'FRC1',
-    'Bretagne': 'FRH0',
-    'Centre': 'FRB0',
-    'Champagne-Ardenne': 'FRF2',
-    'Franche-Comte': 'FRC2',
-    'Haute-Normandie': 'FRD2',
-    'Ile-de-France': 'FR10',
-    'Languedoc-Roussillon': 'FRJ1',
-    'Limousin': 'FRI2',
-    'Lorraine': 'FRF3',
-    'Midi-Pyrenees': 'FRJ2',
-    'Nord-Pas-de-Calais': 'FRE1',
-    'Pays de la Loire': 'FRG0',
-    'Picardie': 'FRE2',
-    'Poitou-Charentes': 'FRI3',
-    "Provence-Alpes-Cote d'Azur": 'FRL0',
-    'Rhone-Alpes': 'FRK2',
-    'Stuttgart': 'DE11',
-    'Karlsruhe': 'DE12',
-    'Freiburg': 'DE13',
-    'Tubingen': 'DE14',
-    'Oberbayern': 'DE21',
-    'Niederbayern': 'DE22',
-    'Oberpfalz': 'DE23',
-    'Oberfranken': 'DE24',
-    'Mittelfranken': 'DE25',
-    'Unterfranken': 'DE26',
-    'Schwaben': 'DE27',
-    'Berlin': 'DE30',
-    'Brandenburg': 'DE40',
-    'Hamburg': 'DE60',
-    'Darmstadt': 'DE71',
-    'Giessen': 'DE72',
-    'Kassel': 'DE73',
-    'Mecklenburg-Vorpommern': 'DE80',
-    'Braunschweig': 'DE91',
-    'Hannover': 'DE92',
-    'Luneburg': 'DE93',
-    'Weser-Ems': 'DE94',
-    'Dusseldorf': 'DEA1',
-    'Koln': 'DEA2',
-    'Munster': 'DEA3',
-    'Detmold': 'DEA4',
-    'Arnsberg': 'DEA5',
-    'Koblenz': 'DEB1',
-    'Trier': 'DEB2',
-    'Rheinhessen-Pfalz': 'DEB3',
-    'Saarland': 'DEC0',
-    'Dresden': 'DED2',
-    'Chemnitz': 'DED4',
-    'Leipzig': 'DED5',
-    'Sachsen-Anhalt': 'DEE0',
-    'Schleswig-Holstein': 'DEF0',
-    'Thuringen': 'DEG0',
-    'Piemonte': 'ITC1',
-    'Lombardia': 'ITC4',
-    'Trentino-Alto Adige': 'ITH2',
-    'Veneto': 'ITH3',
-    'Emilia-Romagna': 'ITH5',
-    'Toscana': 'ITI1',
-    'Umbria': 'ITI2',
-    'Marche': 'ITI3',
-    'Lazio': 'ITI4',
-    'Luxembourg': 'LU00',
-    'Groningen': 'NL11',
-    'Friesland': 'NL12',
-    'Overijssel': 'NL21',
-    'Gelderland': 'NL22',
-    'Flevoland': 'NL23',
-    'Utrecht': 'NL31',
-    'Noord-Holland': 'NL32',
-    'Zuid-Holland': 'NL33',
-    'Zeeland': 'NL34',
-    'Noord-Brabant': 'NL41',
-    'Limburg': 'NL42',
-    'Greater Poland': 'PL41',
-    'Lower Silesian': 'PL51',
-    'Warmian-Masurian': 'PL62',
-    'Pais Vasco': 'ES21',
-    'Comunidad Foral de Navarra': 'ES22',
-    'Castilla y Leon': 'ES41',
-    'Cataluna': 'ES51',
-    'Andalucia': 'ES61',
-    'Ostergotland': 'SE123',
-    'Jonkoping': 'SE211',
-    'Kronoberg': 'SE212',
-    'Kalmar': 'SE213',
-    'Blekinge': 'SE221',
-    'Skane': 'SE224',
-    'Halland': 'SE231',
-    'Vastra Gotaland': 'SE232',
-    'Varmland': 'SE311',
-    'Vaud': 'CH011',
-    'Valais': 'CH012',
-    'Geneve': 'CH013',
-    'Bern': 'CH021',
-    'Fribourg': 'CH022',
-    'Solothurn': 'CH023',
-    'Neuchatel': 'CH024',
-    'Basel-Stadt': 'CH031',
-    'Basel-Landschaft': 'CH032',
-    'Aargau': 'CH033',
-    'Zurich': 'CH040',
-    'Glarus': 'CH051',
-    'Schaffhausen': 'CH052',
-    'Appenzell Ausserrhoden': 'CH053',
-    'Appenzell Innerrhoden': 'CH054',
-    'Sankt Gallen': 'CH055',
-    'Graubunden': 'CH056',
-    'Thurgau': 'CH057',
-    'Lucerne': 'CH061',
-    'Uri': 'CH062',
-    'Schwyz': 'CH063',
-    'Obwalden': 'CH064',
-    'Nidwalden': 'CH065',
-    'Ticino': 'CH070',
-    'Zug': 'CH066',
-    'Tees Valley and Durham': 'UKC1',
-    'Northumberland and Tyne and Wear': 'UKC2',
-    'Cumbria': 'UKD1',
-    'Greater Manchester': 'UKD3',
-    'Lancashire': 'UKD4',
-    'Cheshire': 'UKD6',
-    'East Yorkshire and Northern Lincolnshire': 'UKE1',
-    'North Yorkshire': 'UKE2',
-    'West Yorkshire': 'UKE4',
-    'Derbyshire and Nottinghamshire': 'UKF1',
-    'Leicestershire, Rutland and Northamptonshire': 'UKF2',
-    'Lincolnshire': 'UKF3',
-    'Herefordshire, Worcestershire and Warwickshire': 'UKG1',
-    'Shropshire and Staffordshire': 'UKG2',
-    'West Midlands': 'UKG3',
-    'East Anglia': 'UKH1',
-    'Bedfordshire and Hertfordshire': 'UKH2',
-    'Essex': 'UKH3',
-    'Outer London — West and North West': 'UKI7',
-    'Berkshire, Buckinghamshire and Oxfordshire': 'UKJ1',
-    'Surrey, East and West Sussex': 'UKJ2',
-    'Hampshire and Isle of Wight': 'UKJ3',
-    'Kent': 'UKJ4',
-    'Gloucestershire, Wiltshire and Bristol/Bath area': 'UKK1',
-    'Dorset and Somerset': 'UKK2',
-    'Cornwall and Isles of Scilly': 'UKK3',
-    'Devon': 'UKK4',
-    'West Wales and The Valleys': 'UKL1',
-    'East Wales': 'UKL2',
-    'North Eastern Scotland': 'UKM5',
-    'Highlands and Islands': 'UKM6',
-    'Eastern Scotland': 'UKM7',
-    'West Central Scotland': 'UKM8',
-    'Southern Scotland': 'UKM9',
-    'Northern Ireland': 'UKN0',
-    'Estonia': 'EE00',
-    'Finland': 'FI1',
-    'Hungary': 'HU',
-    'Norway': 'NO0',
-    'Zealand': 'DK02',
-    'Southern Denmark': 'DK03',
-    'Central Jutland': 'DK04',
-    'Northern and Western': 'IE04',
-    'Southern': 'IE05',
-    'Eastern and Midland': 'IE06',
-    'Algarve': 'PT15'
-}
-
-trials['map_id'] = trials['new_region'].map(new_id_dict)
-trials = trials[trials['map_id'].notna()]
-
-
-# The next column specifies the level of NUTS detail for each country:
-
-
-def set_nuts(s):
-    if len(str(s['map_id'])) == 5:
-        return 3
-    elif len(str(s['map_id'])) == 4:
-        return 2
-    elif len(str(s['map_id'])) == 3 and str(s['map_id']) != 'nan':
-        return 1
-    elif len(str(s['map_id'])) == 2:
-        return 0
-    else:
-        return s['map_id']
-
-
-trials['nuts_level'] = trials.apply(set_nuts, axis=1)
-
-
-# A column with a country code:
-
-trials['cntr_code'] = trials['map_id'].str[:2]
 
+@pipeline.stage(inputs=['load_trials', 'load_geo'], sources=['spatial.py'])
+def locate(trials, geo):
+    locator = PolygonLocator.from_packed(geo['nuts_regions'])
+    nuts_3 = pd.Series(locator.locate_ids(trials['lon'], trials['lat']),
+                       index=trials.index, dtype=object)
+    return pd.DataFrame({'nuts_1': nuts_3.str[:3], 'nuts_2': nuts_3.str[:4],
+                         'nuts_3': nuts_3})
 
-# EU GEO DATASET **************************************************************
-# *****************************************************************************
 
-# In this part, I process the NUTS dataset created from GeoJSON at the beginning.
-
-# Codes and names of all the EU countries we'll put on the map:
-
-country_dict = {
-    'AL': 'Albania',
-    'AT': 'Austria',
-    'BE': 'Belgium',
-    'BG': 'Bulgaria',
-    'CH': 'Switzerland',
-    'CZ': 'Czechia',
-    'DE': 'Germany',
-    'DK': 'Denmark',
-    'EE': 'Estonia',
-    'EL': 'Greece',
-    'ES': 'Spain',
-    'FI': 'Finland',
-    'FR': 'France',
-    'HR': 'Croatia',
-    'HU': 'Hungary',
-    'IE': 'Ireland',
-    'IT': 'Italy',
-    'LI': 'Liechtenstein',
-    'LT': 'Lithuania',
-    'LU': 'Luxembourg',
-    'LV': 'Latvia',
-    'ME': 'Montenegro',
-    'MK': 'Macedonia',
-    'MT': 'Malta',
-    'NL': 'Netherlands',
-    'NO': 'Norway',
-    'PL': 'Poland',
-    'PT': 'Portugal',
-    'RO': 'Romania',
-    'RS': 'Serbia',
-    'SE': 'Sweden',
-    'SI': 'Slovenia',
-    'SK': 'Slovakia',
-    'UK': 'United Kingdom'
-}
-
-# Lists of country codes to extract coordinates from the dataset:
-
-# for the countries aggregated on the NUTS-1 level:
-countries_1 = trials[trials['nuts_level'] == 1]['cntr_code'].unique().tolist(
-)
-# for the countries aggregated on the NUTS-2 level:
-countries_2 = trials[trials['nuts_level'] == 2]['cntr_code'].unique().tolist(
-) 
-# for the countries aggregated on the NUTS-3 level:
-countries_3 = trials[trials['nuts_level'] == 3]['cntr_code'].unique().tolist(
-) 
-# for the countries aggregated on the NUTS-0 (country) level and the countries
-# without the data:
-present_countries = trials['cntr_code'].unique().tolist(
-)  
-zero_countries = [
-    x for x in list(country_dict.keys()) if x not in present_countries
-] 
-zero_countries.append('HU')
-
-# Extracting the coordinates & some data:
-
-df_map_0 = nuts[(nuts['CNTR_CODE'].isin(zero_countries))
-                & (nuts['LEVL_CODE'] == 0)][[
-                    'id', 'CNTR_CODE', 'LEVL_CODE', 'NAME_LATN', 'geometry'
-                ]]
-df_map_1 = nuts[(nuts['CNTR_CODE'].isin(countries_1))
-                & (nuts['LEVL_CODE'] == 1)][[
-                    'id', 'CNTR_CODE', 'LEVL_CODE', 'NAME_LATN', 'geometry'
-                ]]
-df_map_2 = nuts[(nuts['CNTR_CODE'].isin(countries_2))
-                & (nuts['LEVL_CODE'] == 2)][[
-                    'id', 'CNTR_CODE', 'LEVL_CODE', 'NAME_LATN', 'geometry'
-                ]]
-df_map_3 = nuts[(nuts['CNTR_CODE'].isin(countries_3))
-                & (nuts['LEVL_CODE'] == 3)][[
-                    'id', 'CNTR_CODE', 'LEVL_CODE', 'NAME_LATN', 'geometry'
-                ]]
-
-df_map = pd.concat([df_map_0, df_map_1, df_map_2,
-                    df_map_3])
-
-# Extracting latitude and longitute from the geometry column:
-
-lon = []
-lat = []
-
-for i in df_map['geometry']:
-    lon.append(i.x)
-    lat.append(i.y)
-
-df_map['lon'] = lon
-df_map['lat'] = lat
-
-
-# JOINING THE DATASETS ********************************************************
-# *****************************************************************************
+@pipeline.stage(inputs=['load_trials', 'locate', 'load_geo'],
+                sources=[REGION_MAP_FILE, 'cleaning.py', 'regions.py',
+                         'fuzzy.py'],
+                params=name_matching)
+def clean(trials, located, geo, threshold, apply):
 
-# Witch trials dataset + EU geo dataset:
+    # Fixing the data types and some mistakes *********************************
 
-df_map_dec = df_map[[
-    'id', 'CNTR_CODE', 'LEVL_CODE', 'NAME_LATN', 'lon', 'lat'
-]].set_index('id').join(trials[[
-    'map_id', 'decade', 'tried', 'executed'
-]].groupby(['map_id', 'decade'
-            ]).agg('sum').reset_index().set_index('map_id')).reset_index()
+    trials = trials.rename(columns={'gadm.adm0': 'country',
+                                    'deaths': 'executed'})
 
+    trials['executed'] = trials['executed'].fillna(0).astype('int')
 
-# SOME MORE DATA FOR THE MAP **************************************************
-# *****************************************************************************
+    trials = trials.drop_duplicates()
 
-# Tooltips-1 | the first and last decade of witch trials for each place:
+    # Valais is in Switzerland, not in France; "Appenzell" stands for
+    # Appenzell Ausserrhoden; Luxembourg is also a region in Belgium (details
+    # in cleaning.py):
 
-df_map_dec['min_decade'] = df_map_dec.groupby('index')['decade'].transform(
-    'min')
-df_map_dec['max_decade'] = df_map_dec.groupby('index')['decade'].transform(
-    'max')
+    trials = fix_regions(trials)
 
-df_map_dec[['tried', 'executed', 'min_decade', 'max_decade'
-            ]] = df_map_dec[['tried', 'executed', 'min_decade',
-                             'max_decade']].fillna(0)
+    # Re-ordering the dataset *************************************************
 
-# Trials summation + getting rid of the decade column:
+    # The next columns will do the following:
+    # new_region -- update the country's regional division in cases where it
+    # changes; unite several territories into one in line with EU NUTS; divide
+    # each country with the required detail (country, region, or county);
+    # map_id -- assign a corresponding NUTS code to each county, region, or
+    # country in the new_region column (rows without one are placed by their
+    # coordinates or dropped);
+    # nuts_level -- specify the level of NUTS detail for each country;
+    # cntr_code -- a country code.
 
-df_scatter_total = df_map_dec.groupby([
-    'index', 'CNTR_CODE', 'NAME_LATN', 'lon', 'lat', 'min_decade', 'max_decade'
-]).agg('sum')[['tried', 'executed']].reset_index()
+    # All the dictionaries behind them are in data/region_map_v1.csv:
 
-df_scatter_total[['min_decade', 'max_decade', 'tried',
-                  'executed']] = df_scatter_total[[
-                      'min_decade', 'max_decade', 'tried', 'executed'
-                  ]].astype('int')
+    regions = RegionLookup.from_csv(REGION_MAP_FILE)
 
-# Tooltips-2 | the percentage of executed among the tried:
+    trials = regions.resolve(trials, keep_unresolved=True)
 
-df_scatter_total[
-    'mortality'] = df_scatter_total['executed'] / df_scatter_total['tried']
+    proposals = regions.match_names(
+        trials, NameIndex.from_arrays(geo['nuts_names']), threshold)
+    for row in proposals.itertuples():
+        print('clean: %s (%s) ~ %s %s (%.2f)' % (
+            row.new_region, row.country, row.map_id, row.NAME_LATN,
+            row.score))
+    if apply:
+        trials, matched = regions.apply_matches(trials, proposals)
+        print('clean: %d rows resolved by a fuzzy name match' % matched)
 
-# Tooltips-3 | country names:
+    unresolved = trials['map_id'].isna().sum()
+    trials, recovered = regions.recover(trials, located)
+    print('clean: %d of %d rows without a region placed by their coordinates'
+          % (recovered, unresolved))
 
-df_scatter_total['country'] = df_scatter_total['CNTR_CODE'].map(country_dict)
+    return drop_unresolved(trials)
 
 
-# Circles' sizes: to compare their areas, not radiuses, divide by pi
+# EU GEO DATASET **************************************************************
+# *****************************************************************************
 
+# In this part, I process the NUTS dataset created from GeoJSON at the beginning
+# and join the witch trials to it.
 
-def size1(s):
-    if s['tried'] == 0 or s['tried'] == np.nan:
-        return 0
-    else:
-        return np.sqrt(s['tried'] / np.pi) * 1.5
+# The trials are summed once per decade at the finest NUTS code known for
+# each of them, and rolled up from there to the level each country is shown
+# at (see rollup.py), so a country's level can change without rerunning
+# the cleaning or the summing:
 
+@pipeline.stage(inputs=['clean', 'locate'],
+                sources=['rollup.py', 'aggregation.py'])
+def rollup(trials, located):
+    return RollUp.from_trials(trials, located).to_arrays()
 
-# Circles' centers sizes:
 
+def map_table(trial_sums, nuts, levels):
+    """df_map_dec: one row per place and decade, for the countries' NUTS
+    levels (the defaults, with `levels` over them)."""
 
-def size2(s):
-    if s['tried'] == 0 or s['tried'] == np.nan:
-        return 0
-    else:
-        return 3
+    # Codes and names of all the EU countries we'll put on the map:
 
+    country_dict = RegionLookup.from_csv(REGION_MAP_FILE).country_dict
 
-df_scatter_total['size1'] = df_scatter_total.apply(size1, axis=1)
-df_scatter_total['size2'] = df_scatter_total.apply(size2, axis=1)
+    # The per-decade sums and the totals per place, rolled up to the
+    # countries' levels:
 
+    sums = trial_sums.aggregate(levels)
 
-# TRANSFORMING THE GEOJSON FILES **********************************************
-# *****************************************************************************
+    # Picking the coordinates & some data, for every country at its level:
+    # the countries with trials at the level they're counted at, the other
+    # ones at the NUTS-0 (country) level (one take from the centroid table,
+    # see geo_prep.Centroids), plus the coarser places of the trials that
+    # can't go down to their country's level:
 
-# What we want to get on the map: 
-# Level-1: Europe continent only, without Africa + surrounding islands;
-# Level-2: European countries' borders;
-# Level-3: Coastlines;
-# Level-4: Scatter map.
+    df_map = nuts.select(trial_sums.places(country_dict, levels))
+    places = sums.totals['map_id']
+    coarser = places[~places.isin(df_map.index)
+                     & places.isin(nuts.table.index)]
+    if len(coarser):
+        df_map = pd.concat([df_map, nuts.take(coarser)])
 
-# I'll start with the coastlines. The problem is that the Eurostat coastline file 
-# creates a solid polygon of Eurasia and Africa. We need only the European part
-# and surrounding islands. 
+    # JOINING THE DATASETS ****************************************************
 
-# Transforming one of the coast GeoJSONs from a polygon into a line type:
+    # Witch trials dataset + EU geo dataset:
 
-for p in json_coast_l['features']:
-    p['geometry']['type'] = 'LineString'
-    p['geometry']['coordinates'] = p['geometry']['coordinates'][0]
+    df_map_dec = df_map.join(
+        sums.per_decade.set_index('map_id')).rename_axis('index').reset_index()
 
-# Filtering out all the elements that don't fall into our area of interest 
-# (approximately -28:30 by longitude and 32:74 by latitude):
+    # Tooltips-1 | the first and last decade of witch trials for each place:
 
-lon_dict = dict()  # longitudes of all the elements in the area of interest
-lat_dict = dict()  # latitudes of all the elements in the area of interest
-indexes = []  # their ids in the GeoJSON file
+    df_map_dec = df_map_dec.join(
+        sums.totals.set_index('map_id')[['min_decade', 'max_decade']],
+        on='index')
 
-for i in range(len(json_coast_l['features'])):
-    coord = pd.DataFrame(
-        json_coast_l['features'][i]['geometry']['coordinates'])
-    idx = json_coast_l['features'][i]['id']
-    if coord[0].max() > -28 and coord[0].min() < 30 and coord[1].max(
-    ) > 32 and coord[1].min() < 74:
-        lon_dict[idx] = coord[0]
-        lat_dict[idx] = coord[1]
-        indexes.append(idx) # --> GeoJSON IDs to filter
+    df_map_dec[['tried', 'executed', 'min_decade', 'max_decade'
+                ]] = df_map_dec[['tried', 'executed', 'min_decade',
+                                 'max_decade']].fillna(0)
 
-# Filtering the second (polygon) coast GeoJSON by the created IDs list:
+    return df_map_dec
 
-new_features = []
-for i in range(len(json_coast_p['features'])):
-    if json_coast_p['features'][i]['id'] in indexes:
-        new_features.append(json_coast_p['features'][i])
 
-json_coast_p['features'] = new_features
+@pipeline.stage(inputs=['rollup', 'load_geo'], params={'levels': nuts_levels},
+                sources=[REGION_MAP_FILE, 'rollup.py'], uses=[map_table])
+def aggregate(sums, geo, levels):
+    return map_table(RollUp.from_arrays(sums), geo['nuts'], levels)
 
 
-# Now we have a line file and a polygon file with only the elements that 
-# fall into our area of interest. One of these elements is Eurasia-Africa. 
-# We need to leave only the European part.
+# SOME MORE DATA FOR THE MAP **************************************************
+# *****************************************************************************
 
-# I'll cut the polygon by creating an index for each coordinate point and
-# then filtering out unnecessary points by this index. 
+# The per-decade table is turned into cumulative sums over the decades (see
+# decades.py), so the totals for the whole period, or for any window of it,
+# don't need another groupby:
 
-main_df = pd.DataFrame(json_coast_l['features'][0]['geometry']['coordinates'])
-main_df.columns = ['lon', 'lat']
-main_df['index'] = list(range(len(main_df['lon'])))
+@pipeline.stage(inputs=['aggregate'], sources=['decades.py'])
+def decade_index(df_map_dec):
+    return DecadeIndex.from_table(df_map_dec).to_arrays()
 
-# After checking the map, I manually selected the point range to display
-# (the line will start near Turkey and end after the Finnish-Russian border):
 
-main_df_eu = main_df[(main_df['index'] > 5231) & (main_df['index'] < 8051)]
+def marker_columns(df_scatter_total):
 
-# Replacing the Eurasia-Africa coordinates with truncated coordinates --> lines:
+    # Tooltips-3 | country names:
 
-lon_dict[1] = main_df_eu['lon'].tolist()
-lat_dict[1] = main_df_eu['lat'].tolist()
+    country_dict = RegionLookup.from_csv(REGION_MAP_FILE).country_dict
+    df_scatter_total['country'] = df_scatter_total['CNTR_CODE'].map(
+        country_dict)
 
-# Replacing the Eurasia-Africa coordinates with truncated coordinates --> polygons:
+    # Circles' sizes: to compare their areas, not radiuses, divide by pi +
+    # circles' centers sizes:
 
-coordinates_0 = []
+    df_scatter_total['size1'], df_scatter_total['size2'] = circle_sizes(
+        df_scatter_total['tried'])
 
-for lon, lat in zip(main_df_eu['lon'].tolist(), main_df_eu['lat'].tolist()):
-    coordinates_0.append([lon, lat])
+    return df_scatter_total
 
-json_coast_p['features'][0]['geometry']['coordinates'] = [coordinates_0]
 
+@pipeline.stage(inputs=['decade_index'],
+                sources=[REGION_MAP_FILE, 'cleaning.py', 'decades.py'],
+                uses=[marker_columns])
+def data_layers(index):
 
-# The EU file misses the data on Ukraine's, Belarus's, and Russia's borders, so
-# let's extract them from another GeoJSON and append:
+    # Trials summation + getting rid of the decade column; Tooltips-2 | the
+    # percentage of executed among the tried:
 
-add_features = []
+    df_scatter_total = DecadeIndex.from_arrays(index).totals()
 
-for i in range(len(geojson_add['features'])):
-    geojson_add['features'][i]['id'] = geojson_add['features'][i][
-        'properties']['ISO2']
-    if geojson_add['features'][i]['id'] in ['BY', 'RU', 'UA']:
-        add_features.append(geojson_add['features'][i])
+    return marker_columns(df_scatter_total)
 
-country_dict['RU'] = 'Russia'
-country_dict['BY'] = 'Belarus'
-country_dict['UA'] = 'Ukraine'
 
-geojson['features'].extend(add_features)
+def scatter_total(levels):
+    """df_scatter_total (data_layers) with other NUTS levels for some
+    countries, e.g. scatter_total({'DE': 1, 'FR': 3}): rolled up from the
+    stored sums, without rerunning any stage."""
+    df_map_dec = map_table(RollUp.from_arrays(pipeline.run('rollup')),
+                           pipeline.run('load_geo')['nuts'], levels)
+    return marker_columns(DecadeIndex.from_table(df_map_dec).totals())
 
 
-# + I'll delete one Norwegian island that ruins the view:
+# TRANSFORMING THE GEOJSON FILES **********************************************
+# *****************************************************************************
 
-geojson['features'][1984]['geometry']['coordinates'] = geojson['features'][
-    1984]['geometry']['coordinates'][:-1]
+# What we want to get on the map: 
+# Level-1: Europe continent only, without Africa + surrounding islands;
+# Level-2: European countries' borders;
+# Level-3: Coastlines;
+# Level-4: Scatter map.
 
+# I'll start with the coastlines. The problem is that the Eurostat coastline file 
+# creates a solid polygon of Eurasia and Africa. We need only the European part
+# and surrounding islands. 
 
-# DRAWING THE MAP *************************************************************
-# *****************************************************************************
+# geo_prep.build_coast turns the outer rings of the coast polygons into lines, 
+# keeps only the elements that fall into our area of interest (approximately 
+# -28:30 by longitude and 32:74 by latitude) and clips them to a mask of 
+# Europe, which cuts the Eurasia-Africa polygon down to its European part and 
+# drops the islands off Africa and Asia. 
+
+# The 1:10M geometry has more detail than the picture can show, so it's also 
+# simplified at a few tolerances (see simplify.py), and we take the coarsest 
+# level that stays under half a pixel for the output size and the viewport.
 
-fig = go.Figure()
+# The EU file misses the data on Ukraine's, Belarus's, and Russia's borders, so
+# geo_prep.build_boundaries has appended them from another GeoJSON (and deleted
+# one Norwegian island that ruins the view).
 
 # IDs of elements that I want to exclude from the view:
-indexes_to_exclude = [360, 527, 1789, 1241] 
-
-
-# Layer 1 | Polygons | Europe's and islands' lands
-
-fig.add_choropleth(
-    geojson=json_coast_p,
-    locations=[idx for idx in indexes if idx not in indexes_to_exclude],
-    z=[1] * len(indexes),
-    text=[idx for idx in indexes if idx not in indexes_to_exclude],
-    colorscale=[[0, 'rgba(0,0,0,0)'], [1, 'rgba(64, 64, 64, 0.5)']],
-    showscale=False,
-    marker=dict(line_color='rgba(0,0,0,0)'),
-    hoverinfo='none')
-
-# Layer 2 | Polygons | Country boundaries
-
-fig.add_choropleth(geojson=geojson,
-                   locations=list(country_dict.keys()),
-                   z=[1] * len(list(country_dict.keys())),
-                   colorscale=[[0, 'rgba(0,0,0,0)'], [1, 'rgba(0,0,0,0)']],
-                   showscale=False,
-                   marker=dict(line_width=0.5,
-                               line_color='rgba(64, 64, 64, 0.7)'),
-                   hoverinfo='none')
-
-# Layer 3 | Lines | Europe's and islands' coastlines
-
-widths = [3.1, 2.5, 2.5, 1.5, 1.5, 0.5]
-colors = ['rgba(64, 64, 64, 0.4)', 'rgba(1, 1, 1, 1.0)', 'rgba(64, 64, 64, 0.6)',
-          'rgba(1, 1, 1, 1.0)', 'rgba(64, 64, 64, 0.8)', 'rgba(64, 64, 64, 1)']
-
-for i in [h for h in indexes if h not in indexes_to_exclude]:
-    for width, color in zip(widths, colors): # this loop is just for better design
-        fig.add_scattergeo(lat=lat_dict[i],
-                           lon=lon_dict[i],
-                           mode='lines',
-                           line=dict(width=width, color=color),
-                           hoverinfo='none')
-
-# Layer 4 | Points | Scatter map - circles
-
-fig.add_scattergeo(lat=df_scatter_total['lat'],
-                   lon=df_scatter_total['lon'],
-                   mode='markers',
-                   marker=dict(size=df_scatter_total['size1'] * 2,
-                               color='rgba(155,1,3,0.3)',
-                               showscale=False,
-                               line_width=0,
-                               line_color='rgba(0,0,0,0)',
-                               gradient=dict(
-                                   color='rgba(255,178,0,0.9)',
-                                   type="radial",
-                               )),
-                   hoverinfo='none')
-
-# Layer 5 | Points | Scatter map - circles' centers
-
-fig.add_scattergeo(lat=df_scatter_total['lat'],
-                   lon=df_scatter_total['lon'],
-                   mode='markers',
-                   marker=dict(size=df_scatter_total['size2'],
-                               color='rgba(255,234,187,0.8)',
-                               showscale=False,
-                               line_width=0,
-                               line_color='rgba(0,0,0,0)'),
-                   hoverinfo='none')
-
-# Layer 6 | Points (Invisible) | Tooltips
-
-fig.add_scattergeo(
-    lat=df_scatter_total[df_scatter_total['tried'] > 0]['lat'],
-    lon=df_scatter_total[df_scatter_total['tried'] > 0]['lon'],
-    mode='markers',
-    marker=dict(size=df_scatter_total[df_scatter_total['tried'] > 0]['size1'] * 2,
-                color='rgba(0,0,0,0)',
-                showscale=False,
-                line_width=0,
-                line_color='rgba(0,0,0,0)'),
-    customdata=np.stack(
-        (df_scatter_total[df_scatter_total['tried'] > 0]['NAME_LATN'], 
-         df_scatter_total[df_scatter_total['tried'] > 0]['country'],
-         df_scatter_total[df_scatter_total['tried'] > 0]['min_decade'],
-         df_scatter_total[df_scatter_total['tried'] > 0]['max_decade'],
-         df_scatter_total[df_scatter_total['tried'] > 0]['tried'], 
-         df_scatter_total[df_scatter_total['tried'] > 0]['executed'],
-         df_scatter_total[df_scatter_total['tried'] > 0]['mortality']),
-        axis=-1),
-    hovertemplate=
-    '<extra></extra><b>%{customdata[0]} | %{customdata[1]}\
-    <br><br><span style="color:#c66a0e;font-size:27">%{customdata[2]}-%{customdata[3]}</span>\
-    <br><br><span style="color:#c66a0e;font-size:27">%{customdata[4]:,.0f}</span>\
-    people were tried for witchcraft\
-    <br><span style="color:#c66a0e;font-size:27">%{customdata[5]:,.0f} (%{customdata[6]:,.0%})</span>\
-    of them were killed</b>'
-)
-
-
-# Legend | Title
-
-fig.add_annotation(xref="x domain",
-                   yref="y domain",
-                   text="<b>Number of people tried for witchcraft:</b>",
-                   showarrow=False,
-                   x=0.065,
-                   y=0.82,
-                   font=dict(color='rgba(255,234,187,0.8)',
-                             family='Almendra Display',
-                             size=21),
-                   align='left')
-
-# Legend | Circles
-
-fig.add_scatter(x=[0.07, 0.17, 0.27, 0.37],
-                y=[0.755, 0.755, 0.755, 0.755],
-                mode='markers',
-                marker=dict(size=[
-                    np.sqrt(10 / np.pi) * 3,
-                    np.sqrt(100 / np.pi) * 3,
-                    np.sqrt(1000 / np.pi) * 3,
-                    np.sqrt(3000 / np.pi) * 3
-                ],
-                            color='rgba(155,1,3,0.3)',
-                            showscale=False,
-                            line_width=0,
-                            line_color='rgba(0,0,0,0)',
-                            gradient=dict(
-                                color='rgba(255,178,0,0.9)',
-                                type="radial",
-                            )),
-                hoverinfo='none')
-
-# Legend | Circles' centers
-
-fig.add_scatter(
-    x=[0.07, 0.17, 0.27, 0.37],
-    y=[0.755, 0.755, 0.755, 0.755],
-    mode='markers+text',
-    marker=dict(size=[3, 3, 3, 3],
-                color='rgba(255,234,187,0.8)',
-                showscale=False,
-                line_width=0,
-                line_color='rgba(0,0,0,0)'),
-    text=['<b> 10</b>', '<b> 100</b>', '<b> 1,000</b>', '<b> 3,000</b>'],
-    textfont=dict(color='rgba(255,234,187,0.8)',
-                  family='Almendra Display',
-                  size=21),
-    textposition='middle right',
-    hoverinfo='none')
+indexes_to_exclude = [360, 527, 1789, 1241]
+
+
+@pipeline.stage(inputs=['load_geo'], sources=[REGION_MAP_FILE],
+                params={**view, 'indexes_to_exclude': indexes_to_exclude})
+def base_layers(geo, width, height, lon_range, lat_range, indexes_to_exclude):
+    lod = pick_level(width, height, lon_range, lat_range)
+
+    coast_lod = geo['coast_lod']
+    coast_lines = line_arrays(
+        pyramid_level(geo_prep.unprefixed(coast_lod, 'lines.'), lod))
+    coast_polygons = pyramid_level(
+        geo_prep.unprefixed(coast_lod, 'polygons.'), lod)
+
+    indexes = list(coast_lines)  # ids of the elements in the GeoJSON file
+    shown = [idx for idx in indexes if idx not in indexes_to_exclude]
+
+    # All the coastline segments merged into one line (see layers.py):
+    lon, lat = merge_lines([coast_lines[idx] for idx in shown])
+
+    country_dict = dict(RegionLookup.from_csv(REGION_MAP_FILE).country_dict)
+    country_dict['RU'] = 'Russia'
+    country_dict['BY'] = 'Belarus'
+    country_dict['UA'] = 'Ukraine'
+
+    return {
+        **geo_prep.prefixed(coast_polygons, 'coast.'),
+        **geo_prep.prefixed(pyramid_level(geo['boundaries_lod'], lod),
+                            'boundaries.'),
+        'coast.indexes': np.asarray(indexes),
+        'coast.shown': np.asarray(shown),
+        'lines.lon': lon,
+        'lines.lat': lat,
+        'countries': np.asarray(list(country_dict.keys())),
+    }
+
+
+# The two choropleth layers only draw the features their locations list
+# (the coast polygons shown, the countries); only those go into a topology
+# (topology.py): each border shared by two countries is kept once, and the
+# coordinates are snapped to a grid of `step` degrees. The figure decodes it
+# back into GeoJSON, and the exported page (export.py) gets it as TopoJSON.
+
+@pipeline.stage(inputs=['base_layers'], sources=['topology.py'],
+                params=topology_params)
+def topology(base, step):
+    coast = select_features(geo_prep.unprefixed(base, 'coast.'),
+                            base['coast.shown'])
+    boundaries = select_features(geo_prep.unprefixed(base, 'boundaries.'),
+                                 base['countries'])
+    return {
+        **geo_prep.prefixed(Topology.from_packed(coast, step).to_arrays(),
+                            'coast.'),
+        **geo_prep.prefixed(Topology.from_packed(boundaries, step).to_arrays(),
+                            'boundaries.'),
+    }
 
 
-# Footer
+# DRAWING THE MAP *************************************************************
+# *****************************************************************************
 
-fig.add_annotation(
-    xref="paper",
-    yref="paper",
-    text=
-    "<b>Created by Tanya Lomskaya\
+# Layers 4-6 depend on the data, everything else on the map doesn't: the
+# batch mode (batch.py) swaps them, by uid, into a figure drawn once.
+
+def data_traces(df_scatter_total):
+
+    # Layer 4 | Points | Scatter map - circles
+
+    circles = go.Scattergeo(lat=df_scatter_total['lat'],
+                            lon=df_scatter_total['lon'],
+                            mode='markers',
+                            marker=dict(size=df_scatter_total['size1'] * 2,
+                                        color='rgba(155,1,3,0.3)',
+                                        showscale=False,
+                                        line_width=0,
+                                        line_color='rgba(0,0,0,0)',
+                                        gradient=dict(
+                                            color='rgba(255,178,0,0.9)',
+                                            type="radial",
+                                        )),
+                            hoverinfo='none',
+                            uid='layer-4')
+
+    # Layer 5 | Points | Scatter map - circles' centers
+
+    centers = go.Scattergeo(lat=df_scatter_total['lat'],
+                            lon=df_scatter_total['lon'],
+                            mode='markers',
+                            marker=dict(size=df_scatter_total['size2'],
+                                        color='rgba(255,234,187,0.8)',
+                                        showscale=False,
+                                        line_width=0,
+                                        line_color='rgba(0,0,0,0)'),
+                            hoverinfo='none',
+                            uid='layer-5')
+
+    # Layer 6 | Points (Invisible) | Tooltips
+
+    # (the places with trials only, picked once; the name and country are
+    # the text, the whole numbers an int32 matrix and the mortality the
+    # transparent markers' color, see layers.tooltip_data)
+
+    tooltip = tooltip_data(df_scatter_total)
+    tooltips = go.Scattergeo(
+        lat=tooltip['lat'],
+        lon=tooltip['lon'],
+        mode='markers',
+        marker=dict(
+            tooltip['marker'],
+            showscale=False,
+            line_width=0,
+            line_color='rgba(0,0,0,0)'),
+        text=tooltip['text'],
+        customdata=tooltip['customdata'],
+        hovertemplate=TOOLTIP_TEMPLATE,
+        uid='layer-6')
+
+    return [circles, centers, tooltips]
+
+
+@pipeline.stage(inputs=['base_layers', 'topology', 'data_layers'],
+                params=view, sources=['layers.py', 'topology.py'],
+                uses=[data_traces], store=False)
+def figure(base, topology, df_scatter_total, width, height, lon_range,
+           lat_range):
+    json_coast_p = feature_collection(Topology.from_arrays(
+        geo_prep.unprefixed(topology, 'coast.')).to_packed())
+    geojson = feature_collection(Topology.from_arrays(
+        geo_prep.unprefixed(topology, 'boundaries.')).to_packed())
+    countries = base['countries'].tolist()
+
+    fig = go.Figure()
+
+    # Layer 1 | Polygons | Europe's and islands' lands
+
+    fig.add_choropleth(
+        geojson=json_coast_p,
+        locations=base['coast.shown'].tolist(),
+        z=[1] * len(base['coast.indexes']),
+        text=base['coast.shown'].tolist(),
+        colorscale=[[0, 'rgba(0,0,0,0)'], [1, 'rgba(64, 64, 64, 0.5)']],
+        showscale=False,
+        marker=dict(line_color='rgba(0,0,0,0)'),
+        hoverinfo='none')
+
+    # Layer 2 | Polygons | Country boundaries
+
+    fig.add_choropleth(geojson=geojson,
+                       locations=countries,
+                       z=[1] * len(countries),
+                       colorscale=[[0, 'rgba(0,0,0,0)'], [1, 'rgba(0,0,0,0)']],
+                       showscale=False,
+                       marker=dict(line_width=0.5,
+                                   line_color='rgba(64, 64, 64, 0.7)'),
+                       hoverinfo='none')
+
+    # Layer 3 | Lines | Europe's and islands' coastlines
+
+    widths = [3.1, 2.5, 2.5, 1.5, 1.5, 0.5]
+    colors = ['rgba(64, 64, 64, 0.4)', 'rgba(1, 1, 1, 1.0)',
+              'rgba(64, 64, 64, 0.6)', 'rgba(1, 1, 1, 1.0)',
+              'rgba(64, 64, 64, 0.8)', 'rgba(64, 64, 64, 1)']
+
+    # All the segments share one trace per stroke style (6 traces in total),
+    # the layered strokes are just for better design:
+
+    add_line_layers(fig, [(base['lines.lon'], base['lines.lat'])], widths,
+                    colors)
+
+    # Layers 4-6 | Points | Scatter map
+
+    fig.add_traces(data_traces(df_scatter_total))
+
+    # Legend | Title
+
+    fig.add_annotation(xref="x domain",
+                       yref="y domain",
+                       text="<b>Number of people tried for witchcraft:</b>",
+                       showarrow=False,
+                       x=0.065,
+                       y=0.82,
+                       font=dict(color='rgba(255,234,187,0.8)',
+                                 family='Almendra Display',
+                                 size=21),
+                       align='left')
+
+    # Legend | Circles
+
+    fig.add_scatter(x=[0.07, 0.17, 0.27, 0.37],
+                    y=[0.755, 0.755, 0.755, 0.755],
+                    mode='markers',
+                    marker=dict(size=[
+                        np.sqrt(10 / np.pi) * 3,
+                        np.sqrt(100 / np.pi) * 3,
+                        np.sqrt(1000 / np.pi) * 3,
+                        np.sqrt(3000 / np.pi) * 3
+                    ],
+                                color='rgba(155,1,3,0.3)',
+                                showscale=False,
+                                line_width=0,
+                                line_color='rgba(0,0,0,0)',
+                                gradient=dict(
+                                    color='rgba(255,178,0,0.9)',
+                                    type="radial",
+                                )),
+                    hoverinfo='none')
+
+    # Legend | Circles' centers
+
+    fig.add_scatter(
+        x=[0.07, 0.17, 0.27, 0.37],
+        y=[0.755, 0.755, 0.755, 0.755],
+        mode='markers+text',
+        marker=dict(size=[3, 3, 3, 3],
+                    color='rgba(255,234,187,0.8)',
+                    showscale=False,
+                    line_width=0,
+                    line_color='rgba(0,0,0,0)'),
+        text=['<b> 10</b>', '<b> 100</b>', '<b> 1,000</b>', '<b> 3,000</b>'],
+        textfont=dict(color='rgba(255,234,187,0.8)',
+                      family='Almendra Display',
+                      size=21),
+        textposition='middle right',
+        hoverinfo='none')
+
+    # Footer
+
+    fig.add_annotation(
+        xref="paper",
+        yref="paper",
+        text=
+        "<b>Created by Tanya Lomskaya\
     <br>Datasource: Leeson, P. T. and Russ, J. W.. Witch Trials. 2018 - The Economic Journal | Github.com/JakeRuss/witch-trials<br></b>",
-    showarrow=False,
-    x=0.5,
-    y=0.0035,
-    font=dict(color='rgba(255,234,187,0.8)',
-              family='Almendra Display',
-              size=18),
-    align='center')
-
-
-# Layout 
-
-fig.update_xaxes(range=[0, 1],
-                 showticklabels=False,
-                 showgrid=False,
-                 zeroline=False)
-
-fig.update_yaxes(range=[0, 1],
-                 showticklabels=False,
-                 showgrid=False,
-                 zeroline=False)
-
-fig.update_geos(bgcolor='rgba(0,0,0,0)',
-                showcountries=False,
-                landcolor='rgba(0,0,0,0)',
-                framecolor='rgba(0,0,0,0)',
-                projection=dict(type='miller'),
-                showlakes=False,
-                scope='europe',
-                lonaxis=dict(range=[-13, 30]),
-                lataxis=dict(range=[37, 73.75]))
-
-fig.update_layout(title='<b>Witch Trials in Europe<br>1300-1850</b>',
-                  title_x=0.5,
-                  title_y=0.92,
-                  titlefont=dict(family='Almendra Display',
-                                 size=37.5,
-                                 color='rgba(255,234,187,0.8)'),
-                  paper_bgcolor='#010103',
-                  plot_bgcolor='#010103',
-                  margin=dict(r=0, l=0, t=0, b=30),
-                  width=1050,
-                  height=1395,
-                  showlegend=False,
-                  hoverlabel=dict(bgcolor="#010103",
-                                  font=dict(family='Almendra Display',
-                                            size=22.5,
-                                            color='rgba(255,234,187,1)')))
-
-
-pio.write_image(fig, 'proportional_symbols.png', width=1050, height=1395)
-
-fig.show()
\ No newline at end of file
+        showarrow=False,
+        x=0.5,
+        y=0.0035,
+        font=dict(color='rgba(255,234,187,0.8)',
+                  family='Almendra Display',
+                  size=18),
+        align='center')
+
+    # Layout
+
+    fig.update_xaxes(range=[0, 1],
+                     showticklabels=False,
+                     showgrid=False,
+                     zeroline=False)
+
+    fig.update_yaxes(range=[0, 1],
+                     showticklabels=False,
+                     showgrid=False,
+                     zeroline=False)
+
+    fig.update_geos(bgcolor='rgba(0,0,0,0)',
+                    showcountries=False,
+                    landcolor='rgba(0,0,0,0)',
+                    framecolor='rgba(0,0,0,0)',
+                    projection=dict(type='miller'),
+                    showlakes=False,
+                    scope='europe',
+                    lonaxis=dict(range=lon_range),
+                    lataxis=dict(range=lat_range))
+
+    fig.update_layout(title='<b>Witch Trials in Europe<br>1300-1850</b>',
+                      title_x=0.5,
+                      title_y=0.92,
+                      titlefont=dict(family='Almendra Display',
+                                     size=37.5,
+                                     color='rgba(255,234,187,0.8)'),
+                      paper_bgcolor='#010103',
+                      plot_bgcolor='#010103',
+                      margin=dict(r=0, l=0, t=0, b=30),
+                      width=width,
+                      height=height,
+                      showlegend=False,
+                      hoverlabel=dict(bgcolor="#010103",
+                                      font=dict(family='Almendra Display',
+                                                size=22.5,
+                                                color='rgba(255,234,187,1)')))
+
+    return fig
+
+
+# RENDERING *******************************************************************
+# *****************************************************************************
+
+# Skipped while the figure is unchanged and the PNG is still there:
+
+@pipeline.stage(inputs=['figure'], outputs=[OUTPUT_FILE],
+                params={'path': OUTPUT_FILE, 'width': view['width'],
+                        'height': view['height'], 'backend': render_backend})
+def render(fig, path, width, height, backend='kaleido'):
+    if backend not in ('kaleido', 'raster'):
+        raise ValueError('unknown render backend %r' % backend)
+    if backend == 'raster':
+        import raster  # only needed for this backend
+        try:
+            raster.write_png(fig, path, width, height)
+            return
+        except raster.UnsupportedFigure as error:
+            print("render: the raster backend can't draw the figure (%s), "
+                  'using Kaleido' % error)
+    pio.write_image(fig, path, width=width, height=height, validate=False)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the map.')
+    parser.add_argument('--profile', nargs='?', const=REPORT_FILE,
+                        metavar='PATH', help='time the stages and write the '
+                        'report to PATH (default %s)' % REPORT_FILE)
+    parser.add_argument('--backend', choices=['kaleido', 'raster'],
+                        help='how to draw the PNG (default %s)'
+                        % render_backend)
+    args = parser.parse_args()
+    if args.backend:
+        pipeline.stages['render'].params['backend'] = args.backend
+    if args.profile and pipeline.profiler is None:
+        pipeline.profiler = geo_cache.profiler = Profiler(args.profile)
+
+    try:
+        fig = pipeline.run('figure')
+        pipeline.run('render')
+    finally:  # a failed build is profiled as well
+        if pipeline.profiler is not None:
+            pipeline.profiler.finish()
+    fig.show()
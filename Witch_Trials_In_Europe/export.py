@@ -0,0 +1,307 @@
+# Writing the map as a standalone HTML page.
+
+# fig.write_html() inlines the 3.5 MB plotly.js into every page and writes
+# every coordinate of the coastlines, boundaries and lines as JSON text, which
+# the browser then spends seconds parsing. Here:
+# - plotly.js is written once, as plotly-<version>.min.js next to the pages,
+#   and every page (this one, the animated map) loads that same file;
+# - the numeric arrays of the traces (and frames) go out as base64 typed
+#   arrays (layers.typed_array), and arrays repeated across traces (the line
+#   layers draw the same lines once per stroke style) are written once and
+#   referenced;
+# - the choropleths' GeoJSON goes out as TopoJSON (topology.py: shared
+#   borders once, coordinates as small integers on a grid of `step`
+#   degrees, delta-encoded along the arcs), with the arcs as typed arrays
+#   too, which the page turns back into GeoJSON before plotting;
+# - the page is also written precompressed, as .html.gz and .html.br (the
+#   latter only if brotli is installed), for servers that can serve those;
+# - a report lists the size of every trace in the page.
+
+# python export.py [--out witch_trials.html]
+
+import argparse
+import gzip
+import json
+import os
+
+import numpy as np
+import plotly
+import plotly.utils
+from plotly.offline import get_plotlyjs
+
+from geo_cache import pack_features
+from layers import typed_array
+from topology import DECODE_JS, STEP, Topology
+
+
+OUTPUT_FILE = 'witch_trials.html'
+
+# Shorter arrays stay JSON lists (the typed-array header isn't worth it):
+MIN_TYPED_LENGTH = 16
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<script src="%(plotlyjs)s"></script>
+<style>body {margin: 0; background: #010103;}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+const arrays = %(arrays)s;
+const topologies = %(topologies)s;
+%(decoder)s
+function resolve(value) {
+  if (Array.isArray(value)) {
+    return value.map(resolve);
+  }
+  if (value && typeof value === 'object') {
+    if ('$array' in value) {
+      return Object.assign({}, arrays[value.$array]);
+    }
+    if ('$topology' in value) {
+      return topologyFeatures(resolve(topologies[value.$topology]),
+                              'features');
+    }
+    for (const name of Object.keys(value)) {
+      value[name] = resolve(value[name]);
+    }
+  }
+  return value;
+}
+
+Plotly.newPlot('map', resolve(%(figure)s));
+</script>
+</body>
+</html>
+'''
+
+
+# ARRAYS **********************************************************************
+
+def numeric_array(value):
+    """`value` as a 1-D or 2-D numeric NumPy array, or None if it isn't one
+    (strings, nested dicts, ragged lists, too short)."""
+    if isinstance(value, (list, tuple)):
+        if len(value) < MIN_TYPED_LENGTH:
+            return None
+        if not all(isinstance(v, (int, float, list, tuple)) or v is None
+                   for v in value[:MIN_TYPED_LENGTH]):
+            return None
+        try:
+            value = np.array(value, dtype='float64')
+        except (TypeError, ValueError):
+            return None
+    if not isinstance(value, np.ndarray) or value.size < MIN_TYPED_LENGTH:
+        return None
+    if value.dtype == object:
+        try:
+            value = value.astype('float64')
+        except (TypeError, ValueError):
+            return None
+    if value.dtype.kind not in 'iuf' or value.ndim > 2:
+        return None
+    return value
+
+
+def array_dtype(values):
+    """The smallest typed-array type that holds `values` exactly (floats are
+    float32)."""
+    floats = values.dtype.kind == 'f'
+    finite = values[np.isfinite(values)] if floats else values
+    if floats and (len(finite) < values.size
+                   or (finite != np.round(finite)).any()):
+        return 'f4'
+    low, high = (finite.min(), finite.max()) if finite.size else (0, 0)
+    for dtype in ('u1', 'i1', 'u2', 'i2', 'u4', 'i4'):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return 'f8'
+
+
+class ArrayTable:
+    """The typed arrays of a figure, each distinct one stored once."""
+
+    def __init__(self):
+        self.arrays = []
+        self.positions = {}
+
+    def add(self, values):
+        return self.add_spec(typed_array(values, array_dtype(values)))
+
+    def add_spec(self, spec):
+        key = (spec['dtype'], spec.get('shape'), spec['bdata'])
+        if key not in self.positions:
+            self.positions[key] = len(self.arrays)
+            self.arrays.append(spec)
+        return {'$array': self.positions[key]}
+
+
+def encode_arrays(value, table):
+    """`value` (a trace, a frame...) with its numeric arrays moved to the
+    table. GeoJSON is left alone."""
+    if isinstance(value, dict) and 'bdata' in value:  # typed already
+        return table.add_spec(value)
+    if isinstance(value, dict):
+        return {name: item if name == 'geojson' else encode_arrays(item, table)
+                for name, item in value.items()}
+    values = numeric_array(value)
+    if values is not None:
+        return table.add(values)
+    if isinstance(value, (list, tuple)):
+        return [encode_arrays(item, table) for item in value]
+    return value
+
+
+def encode_geojson(trace, topologies, table, step):
+    """The trace with its GeoJSON moved, as TopoJSON, to `topologies`
+    (only polygons matched by id; anything else is left as it is). The
+    arcs go to the table as typed arrays."""
+    geojson = trace.get('geojson')
+    if (not isinstance(geojson, dict)
+            or trace.get('featureidkey', 'id') != 'id'
+            or not all(f['geometry']['type'] in ('Polygon', 'MultiPolygon')
+                       for f in geojson['features'])):
+        return trace
+    topology = Topology.from_packed(pack_features(geojson['features']), step)
+    topojson = topology.to_topojson(typed=True)
+    topojson['arcs'] = encode_arrays(topojson['arcs'], table)
+    topologies.append(topojson)
+    return dict(trace, geojson={'$topology': len(topologies) - 1})
+
+
+# PAGE ************************************************************************
+
+def plotlyjs_file(folder):
+    """Write this plotly's plotly.js into `folder` (once) and return its
+    name."""
+    name = 'plotly-%s.min.js' % plotly.__version__
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(get_plotlyjs())
+        os.replace(tmp, path)
+    return name
+
+
+def to_json(value):
+    return json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder,
+                      separators=(',', ':'))
+
+
+def trace_label(i, trace):
+    name = trace.get('uid') or trace.get('name') or ''
+    return ('%2d %s %s' % (i, trace.get('type', 'scatter'), name)).rstrip()
+
+
+def page_figure(fig, step=STEP):
+    """The figure dict (with its config) as the page writes it: the GeoJSON
+    moved to a list of topologies and the arrays to an ArrayTable. Returns
+    it, the topologies, the table and a size report: the bytes of every
+    trace and of the frames, each with the topology and the arrays it's the
+    first to use."""
+    fig = fig if isinstance(fig, dict) else fig.to_plotly_json()
+    topologies = []
+    table = ArrayTable()
+    report = []
+
+    def encoded(label, value):
+        start, topology = len(table.arrays), len(topologies)
+        if isinstance(value, dict):
+            value = encode_geojson(value, topologies, table, step)
+        value = encode_arrays(value, table)
+        size = len(to_json(value)) + sum(
+            len(to_json(item)) for item in
+            table.arrays[start:] + topologies[topology:])
+        report.append((label, size))
+        return value
+
+    data = [encoded(trace_label(i, trace), trace)
+            for i, trace in enumerate(fig['data'])]
+    page = {'data': data, 'layout': fig.get('layout', {}),
+            'config': {'responsive': True}}
+    if fig.get('frames'):
+        page['frames'] = encoded('frames (%d)' % len(fig['frames']),
+                                 fig['frames'])
+    report.append(('layout', len(to_json(page['layout']))))
+    return page, topologies, table, report
+
+
+def compress(path):
+    """Write `path`.gz, and `path`.br if brotli is installed; returns the
+    files written."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    written = [path + '.gz']
+    with gzip.open(path + '.gz', 'wb', compresslevel=9) as f:
+        f.write(raw)
+    try:
+        import brotli
+    except ImportError:
+        return written
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(raw, quality=11))
+    written.append(path + '.br')
+    return written
+
+
+def write_page(fig, path=OUTPUT_FILE, title='Witch Trials in Europe',
+               step=STEP, precompress=True):
+    """Write the figure (a go.Figure or a dict, with frames or without) as a
+    standalone page loading the shared plotly.js next to it. Returns the
+    size report (see page_figure) and the files written."""
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    plotlyjs = plotlyjs_file(folder)
+
+    page, topologies, table, report = page_figure(fig, step)
+    html = PAGE % {'title': title, 'plotlyjs': plotlyjs,
+                   'arrays': to_json(table.arrays),
+                   'topologies': to_json(topologies), 'decoder': DECODE_JS,
+                   'figure': to_json(page)}
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+
+    written = [path, os.path.join(folder, plotlyjs)]
+    if precompress:
+        written += compress(path)
+        if not os.path.exists(written[1] + '.gz'):
+            written += compress(written[1])
+    return report, written
+
+
+def print_report(rows, written):
+    width = max(len(label) for label, _ in rows)
+    for label, size in rows:
+        print('%-*s %10s' % (width, label, '{:,}'.format(size)))
+    for path in written:
+        print('%-*s %10s' % (width, path,
+                             '{:,}'.format(os.path.getsize(path))))
+
+
+# COMMAND LINE ****************************************************************
+
+def main():
+    import eu_witch_trials as ewt
+
+    parser = argparse.ArgumentParser(description='Write the interactive map '
+                                     'to a standalone HTML page.')
+    parser.add_argument('--out', default=OUTPUT_FILE)
+    parser.add_argument('--step', type=float, default=STEP,
+                        help='grid of the boundaries, in degrees')
+    parser.add_argument('--no-compress', action='store_true',
+                        help="don't write the .gz/.br copies")
+    args = parser.parse_args()
+
+    rows, written = write_page(ewt.pipeline.run('figure'), args.out,
+                               step=args.step,
+                               precompress=not args.no_compress)
+    print_report(rows, written)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# Fuzzy matching of place names through a character n-gram index.
+
+# A region name in the trials has to match a name in data/region_map_v1.csv
+# exactly, so spelling variants ("Cataluna" vs "Catalunya", accents, old
+# county names) don't resolve. Here every NUTS name (NAME_LATN) is cut into
+# its character trigrams, after folding case and accents, and the index maps
+# each trigram to the names that contain it. A query only meets the names it
+# shares a trigram with, and the candidates of a whole batch of queries are
+# counted at once (np.unique over the (query, name) pairs), so matching tens
+# of thousands of names never compares all the pairs. The score is the Dice
+# coefficient of the two trigram sets (1 for the same name).
+
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+
+NGRAM = 3
+
+# Letters NFKD doesn't split into a base letter and an accent:
+LETTERS = str.maketrans({'ø': 'o', 'æ': 'ae', 'œ': 'oe', 'ł': 'l', 'đ': 'd',
+                         'ð': 'd', 'þ': 'th', 'ı': 'i'})
+
+BATCH_SIZE = 4096  # queries counted together
+
+
+def normalize(name):
+    """Lower case, no accents, words separated by single spaces."""
+    name = unicodedata.normalize('NFKD', str(name).casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.translate(LETTERS)).split())
+
+
+def ngrams(name, n=NGRAM):
+    """The distinct character n-grams of the normalized name, padded with a
+    space at both ends so that the first and last letters count too."""
+    text = ' %s ' % normalize(name)
+    return sorted({text[i:i + n] for i in range(len(text) - n + 1)})
+
+
+def split_grams(names, n=NGRAM):
+    """All the n-grams of all the names in one flat array, and the number of
+    n-grams per name."""
+    grams = [ngrams(name, n) for name in names]
+    sizes = np.array([len(g) for g in grams], dtype='int64')
+    flat = np.array([g for name in grams for g in name], dtype='U%d' % n)
+    return flat, sizes
+
+
+class NameIndex:
+    """Names (with an id and a group each, e.g. a NUTS code and 'UK2' for
+    its country and level) and, for every n-gram, the positions of the names
+    that contain it: `grams` is sorted and the names with grams[i] are
+    postings[offsets[i]:offsets[i + 1]]."""
+
+    def __init__(self, names, ids, groups, sizes, grams, offsets, postings,
+                 n=NGRAM):
+        self.names = np.asarray(names)
+        self.ids = np.asarray(ids)
+        self.groups = np.asarray(groups)
+        self.sizes = np.asarray(sizes, dtype='int64')  # n-grams per name
+        self.grams = np.asarray(grams)
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.postings = np.asarray(postings, dtype='int64')
+        self.n = int(n)
+
+    @classmethod
+    def from_names(cls, names, ids, groups, n=NGRAM):
+        flat, sizes = split_grams(names, n)
+        owner = np.repeat(np.arange(len(sizes)), sizes)
+        grams, codes = np.unique(flat, return_inverse=True)
+        order = np.argsort(codes, kind='stable')
+        offsets = np.searchsorted(codes[order], np.arange(len(grams) + 1))
+        return cls(names, ids, groups, sizes, grams, offsets, owner[order], n)
+
+    def __len__(self):
+        return len(self.names)
+
+    def to_arrays(self):
+        return {'names': self.names.astype(str), 'ids': self.ids.astype(str),
+                'groups': self.groups.astype(str), 'sizes': self.sizes,
+                'grams': self.grams, 'offsets': self.offsets,
+                'postings': self.postings, 'n': np.array(self.n)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['names'], arrays['ids'], arrays['groups'],
+                   arrays['sizes'], arrays['grams'], arrays['offsets'],
+                   arrays['postings'], arrays['n'])
+
+    # QUERIES *****************************************************************
+
+    def scores(self, queries):
+        """(query, name, score) for every name sharing at least one n-gram
+        with a query, as three arrays."""
+        flat, sizes = split_grams(queries, self.n)
+        owner = np.repeat(np.arange(len(sizes)), sizes)
+
+        # the posting list of each of the queries' n-grams (none for the
+        # n-grams that aren't in the index):
+        position = np.searchsorted(self.grams, flat)
+        known = position < len(self.grams)
+        known[known] = self.grams[position[known]] == flat[known]
+        starts = self.offsets[position[known]]
+        lengths = self.offsets[position[known] + 1] - starts
+        owner = owner[known]
+
+        # ... laid end to end, one entry per (query n-gram, name):
+        entry = np.repeat(np.arange(len(starts)), lengths)
+        within = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        name = self.postings[starts[entry] + within]
+        query = owner[entry]
+
+        # the number of shared n-grams is the number of entries per pair:
+        pairs, shared = np.unique(query * len(self) + name, return_counts=True)
+        query, name = pairs // len(self), pairs % len(self)
+        score = 2 * shared / (sizes[query] + self.sizes[name])
+        return query, name, score
+
+    def match(self, queries, groups=None, threshold=0.0):
+        """The best matching name for each query (of the names in the query's
+        group, if `groups` are given) with a score of at least `threshold`:
+        a table with the query's position, the name, its id and the score.
+        Queries without a match are left out."""
+        queries = np.asarray(queries, dtype=object)
+        tables = []
+        for start in range(0, len(queries), BATCH_SIZE):
+            batch = slice(start, start + BATCH_SIZE)
+            query, name, score = self.scores(queries[batch])
+            keep = score >= threshold
+            if groups is not None:
+                keep &= self.groups[name] == np.asarray(groups)[batch][query]
+            table = pd.DataFrame({'query': query[keep] + start,
+                                  'position': name[keep],
+                                  'score': score[keep]})
+            tables.append(table.sort_values(['query', 'score'],
+                                            ascending=[True, False],
+                                            kind='stable')
+                          .drop_duplicates('query'))
+
+        if not tables:
+            best = pd.DataFrame({'query': [], 'position': [], 'score': []})
+            best = best.astype({'query': 'int64', 'position': 'int64'})
+        else:
+            best = pd.concat(tables, ignore_index=True)
+        best['name'] = self.names[best['position']]
+        best['id'] = self.ids[best['position']]
+        return best[['query', 'name', 'id', 'score']]
@@ -0,0 +1,269 @@
+# On-disk cache for the geometry prepared in eu_witch_trials.py.
+
+# Parsing ~7 MB of GeoJSON and re-filtering the coastlines on every run is the
+# slowest part of the script, while the results only change when a source file
+# does. Each cache entry is a folder of plain .npy arrays (memory-mapped on
+# load) plus a meta.json with the content hashes of the files it was built
+# from, so changing one GeoJSON only rebuilds the entries that depend on it.
+# The key also has the content hashes of the modules that build the entries
+# (BUILDER_MODULES), so changing their code rebuilds the cache as well.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+CACHE_VERSION = 2
+
+# The code the entries are built with (modules next to this one):
+BUILDER_MODULES = ('geo_cache', 'geo_prep', 'spatial', 'simplify', 'fuzzy',
+                   'loading')
+
+# Geometry kinds in a packed feature collection:
+LINE, POLYGON, MULTIPOLYGON, MULTILINE = 0, 1, 2, 3
+KIND_NAMES = {LINE: 'LineString', POLYGON: 'Polygon', MULTIPOLYGON: 'MultiPolygon',
+              MULTILINE: 'MultiLineString'}
+KIND_CODES = {name: code for code, name in KIND_NAMES.items()}
+
+
+# HASHING *********************************************************************
+
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a source file (not its mtime, so copies hit the cache)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# PACKING FEATURES INTO FLAT ARRAYS *******************************************
+
+# A feature collection becomes a handful of flat arrays (the same layout
+# GeoArrow uses): all vertices in one (n, 2) float64 array, plus offsets
+# telling where each ring, polygon and feature starts. Lines are stored as
+# polygons with a single ring, one per part.
+
+def pack_features(features):
+    coords = []
+    ring_offsets = [0]
+    poly_offsets = [0]
+    feat_offsets = [0]
+    kinds = []
+    ids = []
+
+    def add_ring(ring):
+        coords.extend(ring)
+        ring_offsets.append(len(coords))
+
+    def add_polygon(rings):
+        for ring in rings:
+            add_ring(ring)
+        poly_offsets.append(len(ring_offsets) - 1)
+
+    for feature in features:
+        geometry = feature['geometry']
+        kind = KIND_CODES[geometry['type']]
+        if kind == LINE:
+            add_polygon([geometry['coordinates']])
+        elif kind == MULTILINE:
+            for line in geometry['coordinates']:
+                add_polygon([line])
+        elif kind == POLYGON:
+            add_polygon(geometry['coordinates'])
+        else:
+            for rings in geometry['coordinates']:
+                add_polygon(rings)
+        feat_offsets.append(len(poly_offsets) - 1)
+        kinds.append(kind)
+        ids.append(feature['id'])
+
+    return {
+        'coords': np.asarray(coords, dtype='float64').reshape(-1, 2),
+        'ring_offsets': np.asarray(ring_offsets, dtype='int64'),
+        'poly_offsets': np.asarray(poly_offsets, dtype='int64'),
+        'feat_offsets': np.asarray(feat_offsets, dtype='int64'),
+        'kinds': np.asarray(kinds, dtype='uint8'),
+        'ids': np.asarray(ids),
+    }
+
+
+def unpack_features(packed):
+    """Rebuild GeoJSON feature dicts (id + geometry) from packed arrays."""
+    coords = np.asarray(packed['coords']).tolist()
+    ring_offsets = packed['ring_offsets'].tolist()
+    poly_offsets = packed['poly_offsets'].tolist()
+    feat_offsets = packed['feat_offsets'].tolist()
+
+    rings = [coords[a:b] for a, b in zip(ring_offsets[:-1], ring_offsets[1:])]
+    polygons = [rings[a:b] for a, b in zip(poly_offsets[:-1], poly_offsets[1:])]
+
+    features = []
+    for i, (kind, idx) in enumerate(zip(packed['kinds'].tolist(),
+                                        packed['ids'].tolist())):
+        parts = polygons[feat_offsets[i]:feat_offsets[i + 1]]
+        if kind == LINE:
+            coordinates = parts[0][0]
+        elif kind == MULTILINE:
+            coordinates = [rings[0] for rings in parts]
+        elif kind == POLYGON:
+            coordinates = parts[0]
+        else:
+            coordinates = parts
+        features.append({
+            'type': 'Feature',
+            'id': idx,
+            'geometry': {'type': KIND_NAMES[kind], 'coordinates': coordinates},
+        })
+    return features
+
+
+def ranges(starts, ends):
+    """np.arange(start, end) for every pair, concatenated."""
+    lengths = np.asarray(ends) - np.asarray(starts)
+    return np.repeat(np.asarray(starts) - np.cumsum(lengths) + lengths,
+                     lengths) + np.arange(lengths.sum())
+
+
+def select_features(packed, ids):
+    """The packed features whose ids are in `ids` (compared as strings),
+    in their original order."""
+    keep = np.flatnonzero(np.isin(np.asarray(packed['ids']).astype(str),
+                                  np.asarray(ids).astype(str)))
+    feat_offsets = np.asarray(packed['feat_offsets'])
+    poly_offsets = np.asarray(packed['poly_offsets'])
+    ring_offsets = np.asarray(packed['ring_offsets'])
+    polygons = ranges(feat_offsets[keep], feat_offsets[keep + 1])
+    rings = ranges(poly_offsets[polygons], poly_offsets[polygons + 1])
+    points = ranges(ring_offsets[rings], ring_offsets[rings + 1])
+    return {
+        'coords': np.asarray(packed['coords'])[points],
+        'ring_offsets': np.r_[0, np.cumsum(np.diff(ring_offsets)[rings])],
+        'poly_offsets': np.r_[0, np.cumsum(np.diff(poly_offsets)[polygons])],
+        'feat_offsets': np.r_[0, np.cumsum(np.diff(feat_offsets)[keep])],
+        'kinds': np.asarray(packed['kinds'])[keep],
+        'ids': np.asarray(packed['ids'])[keep],
+    }
+
+
+def feature_collection(packed):
+    return {'type': 'FeatureCollection', 'features': unpack_features(packed)}
+
+
+def line_arrays(packed):
+    """{id: (lon, lat)} for a packed line collection: views into the
+    coordinates for single lines, NaN-separated copies for multi-part ones."""
+    coords = packed['coords']
+    ring_offsets = packed['ring_offsets']
+    feat_offsets = packed['feat_offsets']
+    lines = {}
+    for i, idx in enumerate(packed['ids'].tolist()):
+        parts = [coords[ring_offsets[ring]:ring_offsets[ring + 1]]
+                 for ring in range(feat_offsets[i], feat_offsets[i + 1])]
+        line = parts[0]
+        if len(parts) > 1:
+            gap = np.full((1, 2), np.nan)
+            joined = [line]
+            for part in parts[1:]:
+                joined.extend([gap, part])
+            line = np.concatenate(joined)
+        lines[idx] = (line[:, 0], line[:, 1])
+    return lines
+
+
+# THE CACHE *******************************************************************
+
+class GeoCache:
+    """A folder of named entries, each a dict of NumPy arrays.
+
+    `get(name, sources, build, params)` returns the stored arrays when the
+    content hashes of `sources` and the `params` match what the entry was
+    built from, and otherwise calls `build()` and stores its result.
+    """
+
+    def __init__(self, root='.geo_cache', enabled=True, profiler=None,
+                 builders=BUILDER_MODULES):
+        self.root = root
+        self.enabled = enabled
+        self.profiler = profiler  # a profiling.Profiler, or None
+        folder = os.path.dirname(os.path.abspath(__file__))
+        self.code = [os.path.join(folder, name + '.py') for name in builders]
+        self._digests = {}
+
+    def digest(self, path):
+        if path not in self._digests:
+            self._digests[path] = file_digest(path)
+        return self._digests[path]
+
+    def _key(self, sources, params):
+        return {
+            'version': CACHE_VERSION,
+            'code': {os.path.basename(path): self.digest(path)
+                     for path in self.code if os.path.exists(path)},
+            'sources': {path: self.digest(path) for path in sources},
+            'params': params or {},
+        }
+
+    def _load(self, folder, key):
+        try:
+            with open(os.path.join(folder, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('key') != json.loads(json.dumps(key)):
+            return None
+        try:
+            return {name: np.load(os.path.join(folder, name + '.npy'),
+                                  mmap_mode='r', allow_pickle=False)
+                    for name in meta['arrays']}
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, folder, key, arrays):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(array),
+                        allow_pickle=False)
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'key': key, 'arrays': list(arrays)}, f, indent=1)
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(tmp, folder)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def get(self, name, sources, build, params=None):
+        if self.profiler is None:
+            return self._get(name, sources, build, params)
+        label = 'geo_cache:' + name
+        built = []
+
+        def measured_build():
+            built.append(name)
+            return build()
+
+        with self.profiler.measure(label) as record:
+            arrays = self._get(name, sources, measured_build, params)
+        record['status'] = 'built' if built else 'cached'
+        self.profiler.count(label, arrays)
+        return arrays
+
+    def _get(self, name, sources, build, params):
+        if not self.enabled:
+            return build()
+        folder = os.path.join(self.root, name)
+        key = self._key(sources, params)
+        arrays = self._load(folder, key)
+        if arrays is None:
+            self._store(folder, key, build())
+            arrays = self._load(folder, key)
+        return arrays
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,211 @@
+# Preparing the GeoJSON layers for the map (see "TRANSFORMING THE GEOJSON
+# FILES" in eu_witch_trials.py for the reasoning behind each step).
+
+# Every function here returns packed arrays (geo_cache.pack_features) so that
+# the results can be stored in the geometry cache and the next run doesn't
+# need to parse any JSON.
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from fuzzy import NameIndex
+from geo_cache import pack_features
+from loading import load_json
+from simplify import LOD_TOLERANCES, build_pyramid
+from spatial import BoundsIndex, clip_to_mask, from_shapely, to_shapely
+
+
+COAST_FILE = 'geo/coast_10_2016.geojson'
+NUTS_POLYGONS_FILE = 'geo/eu_polygons_10_2021.geojson'
+NUTS_DOTS_FILE = 'geo/eu_dots_10_2021.geojson'
+EUROPE_FILE = 'geo/europe.geojson'
+
+# Area of interest for the coastlines as (minx, miny, maxx, maxy), i.e.
+# approximately -28:30 by longitude and 32:74 by latitude:
+COAST_WINDOW = (-28, 32, 30, 74)
+
+# Europe without Africa and Asia, as (lon, lat) vertices. The coastlines are
+# clipped to it, so the edge runs through the sea everywhere the continents
+# meet: the Strait of Gibraltar, between the Maghreb and Spain, Sardinia and
+# Sicily, south of Crete, up the Aegean between the Greek islands and Anatolia,
+# through the Dardanelles and the Bosporus, across the Black Sea to Odesa, and
+# then overland to the Kola Peninsula (leaving out the White Sea).
+EUROPE_MASK = [
+    (-32, 75), (-32, 32), (-12, 32),
+    (-6.3, 35.95), (-5.6, 35.92), (-5.3, 36.0), (-4.5, 36.0),
+    (-2, 36.3), (-1, 36.7), (1, 37.5), (5, 37.5), (11.3, 37.6),
+    (11.8, 36.5), (12.2, 35.0), (20, 34.0), (27, 34.3),
+    (28.6, 35.5), (28.45, 36.3), (27.3, 36.6), (27.2, 36.93),
+    (27.1, 37.3), (27.05, 37.5), (26.5, 38.1),
+    (26.2, 38.25), (26.22, 38.45), (26.25, 38.75), (26.68, 39.1),
+    (26.5, 39.42), (26.1, 39.42), (25.9, 39.55), (26.05, 39.95),
+    (26.2, 40.03), (26.33, 40.07), (26.378, 40.15), (26.41, 40.2),
+    (26.5, 40.24), (26.65, 40.355), (26.73, 40.425), (27.0, 40.47),
+    (27.6, 40.65), (28.5, 40.75), (28.93, 40.97), (28.98, 41.09),
+    (29.1, 41.21), (29.3, 41.35), (30.0, 42.5), (30.55, 46.0),
+    (31.8, 67.3), (35.2, 68.9), (35.2, 75),
+]
+
+# Land masses smaller than this (in square degrees) count as islands: the mask
+# never cuts them, they're either kept or dropped whole.
+ISLAND_AREA = 1.0
+
+
+def prefixed(arrays, prefix):
+    return {prefix + name: array for name, array in arrays.items()}
+
+
+def unprefixed(arrays, prefix):
+    return {name[len(prefix):]: array for name, array in arrays.items()
+            if name.startswith(prefix)}
+
+
+# COASTLINES ******************************************************************
+
+def build_coast(path=COAST_FILE, window=COAST_WINDOW, mask=EUROPE_MASK,
+                island_area=ISLAND_AREA):
+    """Coastline lines and polygons within `window`, clipped to `mask` (a
+    bbox or a list of vertices), packed under 'lines.' and 'polygons.'."""
+    json_coast_p = load_json(path)
+    features = json_coast_p['features']
+
+    # Filtering out all the elements that don't fall into our area of
+    # interest, with one query against the outer rings' bounding boxes:
+
+    lines = pack_features([{
+        'id': p['id'],
+        'geometry': {'type': 'LineString',
+                     'coordinates': p['geometry']['coordinates'][0]},
+    } for p in features])
+    keep = BoundsIndex.from_packed(lines).query(window)
+
+    polygons = to_shapely(pack_features([features[i] for i in keep]))
+    lines = to_shapely(lines)[keep]
+    ids = np.asarray([features[i]['id'] for i in keep])
+
+    # Cutting Eurasia-Africa (and anything else crossing the mask) down to
+    # its European part; islands are kept or dropped whole depending on
+    # which side of the mask they are on:
+
+    islands = shapely.area(polygons) < island_area
+    anchors = shapely.point_on_surface(polygons)
+
+    keep_p, polygons = clip_to_mask(polygons, mask, islands, anchors)
+    keep_l, lines = clip_to_mask(lines, mask, islands, anchors)
+
+    # (the polygons and their outlines should survive together)
+    both = np.intersect1d(keep_p, keep_l)
+    polygons = polygons[np.searchsorted(keep_p, both)]
+    lines = lines[np.searchsorted(keep_l, both)]
+
+    return {**prefixed(from_shapely(lines, ids[both]), 'lines.'),
+            **prefixed(from_shapely(polygons, ids[both]), 'polygons.')}
+
+
+def build_coast_pyramid(coast, tolerances=LOD_TOLERANCES):
+    """Level-of-detail pyramid (see simplify.py) for both parts of the coast
+    entry."""
+    return {**prefixed(build_pyramid(unprefixed(coast, 'lines.'), tolerances),
+                       'lines.'),
+            **prefixed(build_pyramid(unprefixed(coast, 'polygons.'),
+                                     tolerances), 'polygons.')}
+
+
+# COUNTRY BOUNDARIES **********************************************************
+
+def build_boundaries(path=NUTS_POLYGONS_FILE, path_add=EUROPE_FILE):
+    """NUTS polygons + Ukraine's, Belarus's and Russia's borders, packed."""
+    geojson = load_json(path)
+    geojson_add = load_json(path_add)
+
+    # The EU file misses the data on Ukraine's, Belarus's, and Russia's
+    # borders, so let's extract them from another GeoJSON and append:
+
+    for feature in geojson_add['features']:
+        feature['id'] = feature['properties']['ISO2']
+        if feature['id'] in ['BY', 'RU', 'UA']:
+            geojson['features'].append(feature)
+
+    # + I'll delete one Norwegian island that ruins the view:
+
+    geojson['features'][1984]['geometry']['coordinates'] = geojson['features'][
+        1984]['geometry']['coordinates'][:-1]
+
+    return pack_features(geojson['features'])
+
+
+# NUTS REGIONS ****************************************************************
+
+def build_nuts_regions(path=NUTS_POLYGONS_FILE, level=3):
+    """The NUTS polygons of one level, packed, with their codes as ids."""
+    features = load_json(path)['features']
+    return pack_features([feature for feature in features
+                          if feature['properties']['LEVL_CODE'] == level])
+
+
+# NUTS CENTROIDS **************************************************************
+
+CENTROID_COLUMNS = ['id', 'CNTR_CODE', 'LEVL_CODE', 'NAME_LATN', 'lon', 'lat']
+
+
+def build_centroids(path=NUTS_DOTS_FILE):
+    """The NUTS centroids as columns (CENTROID_COLUMNS), in the file's
+    order: the points' coordinates go into one float32 array, the
+    properties into a table of just the three that are used."""
+    features = load_json(path)['features']
+    props = pd.DataFrame.from_records(
+        [f['properties'] for f in features],
+        columns=['CNTR_CODE', 'LEVL_CODE', 'NAME_LATN'])
+    coords = np.array([f['geometry']['coordinates'] for f in features],
+                      dtype='float32').reshape(-1, 2)
+    return {
+        'id': np.array([f['id'] for f in features]).astype('U'),
+        'CNTR_CODE': props['CNTR_CODE'].to_numpy().astype('U'),
+        'LEVL_CODE': props['LEVL_CODE'].to_numpy().astype('int8'),
+        'NAME_LATN': props['NAME_LATN'].to_numpy().astype('U'),
+        'lon': coords[:, 0],
+        'lat': coords[:, 1],
+    }
+
+
+class Centroids:
+    """The NUTS centroid table, indexed by NUTS id, in the file's order.
+    Any set of (country, level) pairs is picked with one take."""
+
+    def __init__(self, arrays):
+        ids = pd.Index(np.asarray(arrays['id']), name='id')
+        self.table = pd.DataFrame({name: np.asarray(arrays[name])
+                                   for name in CENTROID_COLUMNS[1:]},
+                                  index=ids)
+        self.levels = np.asarray(arrays['LEVL_CODE'])
+        self.groups = np.char.add(np.asarray(arrays['CNTR_CODE']),
+                                  self.levels.astype(str))  # e.g. 'UK2'
+
+    def __len__(self):
+        return len(self.table)
+
+    def take(self, ids):
+        """The rows of the given NUTS ids."""
+        positions = self.table.index.get_indexer(ids)
+        if (positions < 0).any():
+            raise KeyError('unknown NUTS ids: %s' % list(
+                np.asarray(ids)[positions < 0][:10]))
+        return self.table.take(positions)
+
+    def select(self, pairs):
+        """The rows of the given (country code, level) pairs, by level and
+        then in the file's order."""
+        wanted = np.array(['%s%d' % pair for pair in pairs], dtype='U')
+        positions = np.flatnonzero(np.isin(self.groups, wanted))
+        order = np.argsort(self.levels[positions], kind='stable')
+        return self.table.take(positions[order])
+
+
+def build_name_index(path=NUTS_DOTS_FILE):
+    """The n-gram index (fuzzy.NameIndex) of the NUTS names, grouped by
+    country code and level (e.g. 'UK2'), as arrays."""
+    arrays = build_centroids(path)
+    groups = np.char.add(arrays['CNTR_CODE'], arrays['LEVL_CODE'].astype(str))
+    return NameIndex.from_names(arrays['NAME_LATN'], arrays['id'],
+                                groups).to_arrays()
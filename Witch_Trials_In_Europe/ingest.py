@@ -0,0 +1,158 @@
+# Reading the witch trials dataset with an explicit schema.
+
+# pd.read_csv infers every dtype from the text, keeps the place names and
+# sources as Python strings and parses the whole file again on every run. Here
+# the columns have fixed dtypes (categories for the repetitive strings, small
+# ints for the counts), only the columns the pipeline uses are kept, and the
+# first read also writes a Parquet copy of the file (in .data_cache/, named
+# after the CSV's content hash) that the later runs read instead.
+
+# For datasets that don't fit in memory, iter_trials() yields the rows in
+# typed chunks, drop_seen() removes the duplicates across chunks (comparing
+# the rows as the clean stage does, with missing deaths counted as 0) and
+# sum_chunks() adds up per-group totals chunk by chunk, e.g.
+#   geo = ewt.pipeline.run('load_geo')
+#   unique = drop_seen(iter_trials(path), fillna={'deaths': 0})
+#   chunks = (ewt.clean(chunk, ewt.locate(chunk, geo), geo,
+#                       **ewt.name_matching) for chunk in unique)
+#   per_decade = sum_chunks(chunks, ['map_id', 'decade'],
+#                           ['tried', 'executed'])
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from geo_cache import file_digest
+from pipeline import parquet_available
+
+
+TRIALS_FILE = 'data/trials.csv'
+
+TRIALS_SCHEMA = {
+    'year': 'Int16',  # nullable
+    'decade': 'int16',
+    'century': 'int16',
+    'tried': 'int16',
+    'deaths': 'Int16',  # nullable
+    'city': 'category',
+    'gadm.adm2': 'category',
+    'gadm.adm1': 'category',
+    'gadm.adm0': 'category',
+    'lon': 'float32',
+    'lat': 'float32',
+    'record.source': 'category',
+}
+
+# The columns the pipeline reads: century is the decade rounded down, year
+# and record.source only tell apart records that would otherwise be
+# duplicates, and lon/lat place the rows whose regions don't resolve.
+TRIALS_COLUMNS = ['year', 'decade', 'tried', 'deaths', 'city', 'gadm.adm2',
+                  'gadm.adm1', 'gadm.adm0', 'lon', 'lat', 'record.source']
+
+CHUNK_SIZE = 1_000_000
+
+
+# READING *********************************************************************
+
+def read_csv(path, columns=TRIALS_COLUMNS, **kwargs):
+    return pd.read_csv(path, usecols=columns,
+                       dtype={name: TRIALS_SCHEMA[name] for name in columns},
+                       **kwargs)
+
+
+def parquet_path(path, cache_dir='.data_cache'):
+    """Where the Parquet copy of the CSV file `path` goes."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, '%s.%s.parquet' % (name, file_digest(path)))
+
+
+def to_parquet(path, target, chunksize=CHUNK_SIZE):
+    """Convert the whole CSV (all the columns, typed) into Parquet, one chunk
+    at a time."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    tmp = target + '.tmp'
+    writer = None
+    try:
+        for chunk in read_csv(path, list(TRIALS_SCHEMA), chunksize=chunksize):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                # the chunks' categories differ, so their dictionaries get
+                # the widest index type
+                widest = pa.dictionary(pa.int32(), pa.string())
+                schema = pa.schema(
+                    [field.with_type(widest)
+                     if pa.types.is_dictionary(field.type) else field
+                     for field in table.schema],
+                    metadata=table.schema.metadata)
+                writer = pq.ParquetWriter(tmp, schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp, target)
+
+
+def read_trials(path=TRIALS_FILE, columns=TRIALS_COLUMNS,
+                cache_dir='.data_cache'):
+    """The trials table, from the Parquet copy when there's one (it's written
+    on the first call) and from the CSV otherwise."""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    if not parquet_available():
+        return read_csv(path, columns)
+    target = parquet_path(path, cache_dir)
+    if not os.path.exists(target):
+        to_parquet(path, target)
+    return pd.read_parquet(target, columns=columns)
+
+
+# STREAMING *******************************************************************
+
+def iter_trials(path=TRIALS_FILE, columns=TRIALS_COLUMNS,
+                chunksize=CHUNK_SIZE):
+    """The trials in chunks of about `chunksize` rows, from a Parquet file
+    (row group by row group) or a CSV file, with the same dtypes as
+    read_trials(). The categories can differ from chunk to chunk."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize,
+                                                       columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from read_csv(path, columns, chunksize=chunksize)
+
+
+def drop_seen(chunks, fillna=None):
+    """drop_duplicates() across chunks: only the first of identical rows is
+    kept, with the missing values filled with `fillna` (as in
+    chunk.fillna(fillna)) for the comparison. Memory grows with the number
+    of distinct rows, by the 8 bytes of their hash, not by the rows
+    themselves."""
+    seen = np.empty(0, dtype='uint64')
+    for chunk in chunks:
+        compared = chunk if fillna is None else chunk.fillna(fillna)
+        # (categories are hashed by value, whatever the chunk's categories)
+        hashes = pd.util.hash_pandas_object(compared, index=False).to_numpy()
+        _, first = np.unique(hashes, return_index=True)
+        new = np.zeros(len(chunk), dtype=bool)
+        new[first] = True
+        new &= ~np.isin(hashes, seen)
+        seen = np.union1d(seen, hashes[new])
+        yield chunk[new]
+
+
+def sum_chunks(chunks, keys, values):
+    """groupby(keys)[values].sum() over all the chunks, keeping only the
+    running totals in memory."""
+    total = None
+    for chunk in chunks:
+        part = chunk.groupby(keys, observed=True)[values].sum()
+        total = part if total is None else total.add(part, fill_value=0)
+    if total is None:
+        return pd.DataFrame(columns=keys + values)
+    return total.astype('int64').reset_index()
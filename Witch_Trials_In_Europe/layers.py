@@ -0,0 +1,91 @@
+# Builders for the figure's layers (see "DRAWING THE MAP" in
+# eu_witch_trials.py).
+
+import base64
+
+import numpy as np
+
+
+def merge_lines(lines):
+    """Concatenate (lon, lat) line segments into a single pair of arrays,
+    with NaN between segments so that Plotly breaks the line there."""
+    lons, lats = [], []
+    gap = np.array([np.nan])
+    for lon, lat in lines:
+        lons.extend([np.asarray(lon, dtype='float64'), gap])
+        lats.extend([np.asarray(lat, dtype='float64'), gap])
+    if not lons:
+        return np.array([]), np.array([])
+    return np.concatenate(lons[:-1]), np.concatenate(lats[:-1])
+
+
+def add_line_layers(fig, lines, widths, colors):
+    """One scattergeo trace per stroke style (width, color) for all the lines
+    together, instead of one trace per line and style: the styles are still
+    stacked in the same order, and the figure stays small however many
+    segments there are."""
+    lon, lat = merge_lines(lines)
+    for width, color in zip(widths, colors):
+        fig.add_scattergeo(lat=lat,
+                           lon=lon,
+                           mode='lines',
+                           line=dict(width=width, color=color),
+                           hoverinfo='none')
+
+
+def typed_array(values, dtype='f4'):
+    """A numeric array in the base64 typed-array form plotly.js (>= 2.28)
+    decodes natively: 4 bytes per float32 instead of ~18 characters of
+    JSON. 2-D arrays keep their shape."""
+    little_endian = np.dtype(dtype).newbyteorder('<')
+    values = np.ascontiguousarray(values, dtype=little_endian)
+    spec = {'dtype': dtype,
+            'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
+    if values.ndim > 1:
+        spec['shape'] = ','.join(str(n) for n in values.shape)
+    return spec
+
+
+# TOOLTIPS ********************************************************************
+
+# The tooltip of a place (Layer 6): its name and country are the point's
+# text, the whole numbers, in the order of TOOLTIP_FIELDS, its customdata,
+# and the share of the tried who were killed its marker color (on a
+# colorscale that is transparent all along, so the markers stay invisible).
+TOOLTIP_TEMPLATE = (
+    '<extra></extra><b>%{text}'
+    '<br><br><span style="color:#c66a0e;font-size:27">'
+    '%{customdata[0]}-%{customdata[1]}</span>'
+    '<br><br><span style="color:#c66a0e;font-size:27">'
+    '%{customdata[2]:,.0f}</span> people were tried for witchcraft'
+    '<br><span style="color:#c66a0e;font-size:27">'
+    '%{customdata[3]:,.0f} (%{marker.color:,.0%})</span> of them were '
+    'killed</b>')
+
+TOOLTIP_FIELDS = ['min_decade', 'max_decade', 'tried', 'executed']
+
+TOOLTIP_COLORSCALE = [[0, 'rgba(0,0,0,0)'], [1, 'rgba(0,0,0,0)']]
+
+
+def tooltip_text(places):
+    """'name | country' for every place (row of `places`)."""
+    country = places['country'].astype(object).fillna('')
+    return (places['NAME_LATN'].astype(object) + ' | ' + country).tolist()
+
+
+def tooltip_data(table):
+    """Layer 6's per-point arrays for the places of `table` (laid out like
+    df_scatter_total) that had any trials: lat, lon, text, customdata (an
+    int32 matrix of the TOOLTIP_FIELDS) and the marker's size (rounded to a
+    tenth of a pixel) and color (the mortality, see TOOLTIP_TEMPLATE)."""
+    shown = table[table['tried'] > 0]
+    return {
+        'lat': shown['lat'].to_numpy(dtype='float64'),
+        'lon': shown['lon'].to_numpy(dtype='float64'),
+        'marker': {'size': np.round(shown['size1'].to_numpy(
+                       dtype='float64') * 2, 1),
+                   'color': shown['mortality'].to_numpy(dtype='float64'),
+                   'colorscale': TOOLTIP_COLORSCALE, 'cmin': 0, 'cmax': 1},
+        'text': tooltip_text(shown),
+        'customdata': shown[TOOLTIP_FIELDS].to_numpy(dtype='int32'),
+    }
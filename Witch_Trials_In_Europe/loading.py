@@ -0,0 +1,53 @@
+# Reading the input files.
+
+# Each file is read from disk exactly once into a bytes buffer. The encoding
+# is then guessed cheaply: a byte order mark if there is one, otherwise a
+# strict UTF-8 decode (which is what all our GeoJSON files are), and only if
+# that fails, chardet on a small sample instead of the whole file.
+
+import codecs
+import json
+
+
+CHARDET_SAMPLE_SIZE = 64 * 1024
+
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def bom_encoding(raw):
+    for bom, encoding in BOMS:  # UTF-32 first: its LE BOM starts like UTF-16's
+        if raw.startswith(bom):
+            return encoding
+    return None
+
+
+def sniff_encoding(raw):
+    import chardet  # only needed for files that aren't UTF-8
+
+    return chardet.detect(raw[:CHARDET_SAMPLE_SIZE])['encoding'] or 'latin-1'
+
+
+def decode(raw):
+    """Bytes --> text, decoding the buffer once in the common (UTF-8) case."""
+    encoding = bom_encoding(raw)
+    if encoding is not None:
+        return raw.decode(encoding)
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode(sniff_encoding(raw))
+
+
+def load_json(path):
+    return json.loads(decode(read_bytes(path)))
@@ -0,0 +1,319 @@
+# Named stages for eu_witch_trials.py, with their outputs memoized on disk.
+
+# The script used to run top to bottom, so changing a font size re-ran the
+# loading, cleaning and aggregation as well. Each stage now declares the
+# stages it takes its inputs from, the files it reads and its parameters. Its
+# output is stored in .stage_cache/<stage>/ as Parquet (a DataFrame) or .npz
+# (a dict of NumPy arrays), keyed by a hash of all of those plus the stage's
+# code, so a stage only reruns when something it depends on has changed.
+
+# A stage's code is its function's and, recursively, that of the functions
+# and classes of the project (the stage's folder) it refers to by name, a
+# module's attribute included (`simplify.pick_level`), with their default
+# arguments and the plain constants they read (PIXEL_TOLERANCE). A project
+# module imported within a function (`import raster`) is hashed as a file.
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+import numpy as np
+import pandas as pd
+
+from geo_cache import file_digest
+
+
+PIPELINE_VERSION = 1
+
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401 (pandas' Parquet engine)
+    except ImportError:
+        return False
+    return True
+
+
+def hash_code(code, h):
+    """Feed a function's bytecode, constants and names to `h`. Unlike its
+    source text, this doesn't change with comments or line numbers, and it
+    works for functions defined in a notebook too."""
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):  # lambdas, comprehensions
+            hash_code(const, h)
+        elif isinstance(const, frozenset):
+            h.update(repr(sorted(const, key=repr)).encode())
+        else:
+            h.update(repr(const).encode())
+
+
+def code_names(code):
+    """The names a code object and the ones nested in it refer to, in
+    order."""
+    names = dict.fromkeys(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(dict.fromkeys(code_names(const)))
+    return list(names)
+
+
+def constant_repr(value):
+    """repr() of a plain constant (numbers, strings and containers of
+    them), None for anything else."""
+    if value is None or isinstance(value, (bool, int, float, complex, str,
+                                           bytes, range)):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        items = [constant_repr(item) for item in value]
+        if None not in items:
+            return '%s(%s)' % (type(value).__name__, ', '.join(items))
+    elif isinstance(value, (set, frozenset)):
+        items = [constant_repr(item) for item in value]
+        if None not in items:
+            return 'set(%s)' % ', '.join(sorted(items))
+    elif isinstance(value, dict):
+        items = [(constant_repr(k), constant_repr(v))
+                 for k, v in value.items()]
+        if all(None not in item for item in items):
+            return 'dict(%s)' % ', '.join('%s: %s' % item for item in items)
+    return None
+
+
+class CodeHasher:
+    """Hashes functions along with the project code they refer to. `root`
+    is the project's folder: what's defined outside of it (the standard
+    library, NumPy, pandas...) isn't followed."""
+
+    def __init__(self, root, h):
+        self.root = os.path.abspath(root)
+        self.h = h
+        self.seen = set()
+
+    def in_project(self, path):
+        return bool(path) and os.path.abspath(path).startswith(
+            self.root + os.sep)
+
+    def function(self, func, follow_only=False):
+        """Hash a function (unless `follow_only`), its default arguments
+        and what it refers to, once."""
+        code = func.__code__
+        if code in self.seen:
+            return
+        self.seen.add(code)
+        if not follow_only:
+            hash_code(code, self.h)
+        for defaults in (func.__defaults__, func.__kwdefaults__):
+            self.h.update(repr(constant_repr(defaults)).encode())
+        names = code_names(code)
+        for name in names:
+            if name in func.__globals__:
+                self.reference(func.__globals__[name], names)
+                continue
+            # a module imported within the function (or just an attribute)
+            path = os.path.join(os.path.dirname(code.co_filename),
+                                name + '.py')
+            if path not in self.seen and os.path.exists(path):
+                self.seen.add(path)
+                self.h.update(file_digest(path).encode())
+
+    def reference(self, value, names=()):
+        """Whatever a global name (or a class or module attribute) refers
+        to: project functions, classes and modules are followed, plain
+        constants are hashed, anything else is left out."""
+        value = getattr(value, '__func__', value)  # static/class methods
+        if isinstance(value, types.FunctionType):
+            if self.in_project(value.__code__.co_filename):
+                self.function(value)
+        elif isinstance(value, types.ModuleType):
+            if self.in_project(getattr(value, '__file__', None)):
+                for name in names:  # its attributes the function may use
+                    attribute = vars(value).get(name)
+                    if not isinstance(attribute, types.ModuleType):
+                        self.reference(attribute)
+        elif isinstance(value, type):
+            module = sys.modules.get(value.__module__)
+            if value not in self.seen and \
+                    self.in_project(getattr(module, '__file__', None)):
+                self.seen.add(value)
+                for name, attribute in vars(value).items():
+                    if isinstance(attribute, property):
+                        for accessor in (attribute.fget, attribute.fset):
+                            self.reference(accessor)
+                    elif not name.startswith('__') or name == '__init__':
+                        self.reference(attribute)
+        else:
+            constant = constant_repr(value)
+            if constant is not None:
+                self.h.update(constant.encode())
+
+
+class Stage:
+
+    def __init__(self, name, func, inputs, sources, params, outputs, store,
+                 uses):
+        self.name = name
+        self.func = func
+        self.uses = list(uses)  # helpers not referred to by name (lambdas)
+        self.inputs = list(inputs)  # names of the upstream stages
+        self.sources = list(sources)  # files read by the stage
+        self.params = dict(params or {})  # passed as keyword arguments
+        self.outputs = list(outputs)  # files written by the stage
+        self.store = store  # False for outputs that don't go to disk
+
+    def code_digest(self):
+        h = hashlib.blake2b(digest_size=16)
+        root = os.path.dirname(os.path.abspath(self.func.__code__.co_filename))
+        hasher = CodeHasher(root, h)
+        for func in [self.func] + self.uses:
+            hash_code(func.__code__, h)
+            hasher.function(func, follow_only=True)
+        return h.hexdigest()
+
+
+class Pipeline:
+    """A DAG of stages. `run(name)` takes a stage's output from the disk
+    cache when its key (inputs' keys, source file hashes, params and code)
+    matches, and otherwise runs it after its inputs. Each stage runs at most
+    once per process.
+
+    Stages that return None are run for their side effects (`outputs`): they
+    are skipped while the key matches and the output files still exist.
+    """
+
+    def __init__(self, root='.stage_cache', enabled=True, profiler=None):
+        self.root = root
+        self.enabled = enabled
+        self.profiler = profiler  # a profiling.Profiler, or None
+        self.stages = {}
+        self.results = {}
+        self.executed = []  # stages that actually ran, in order
+        self._keys = {}
+        self._digests = {}
+
+    def stage(self, inputs=(), sources=(), params=None, outputs=(),
+              store=True, uses=(), name=None):
+        def register(func):
+            stage_name = name or func.__name__
+            self.stages[stage_name] = Stage(stage_name, func, inputs, sources,
+                                            params, outputs, store, uses)
+            return func
+        return register
+
+    # KEYS ********************************************************************
+
+    def digest(self, path):
+        if path not in self._digests:
+            self._digests[path] = file_digest(path)
+        return self._digests[path]
+
+    def key(self, name):
+        if name not in self._keys:
+            stage = self.stages[name]
+            key = {
+                'version': PIPELINE_VERSION,
+                'stage': name,
+                'code': stage.code_digest(),
+                'inputs': {dep: self.key(dep) for dep in stage.inputs},
+                'sources': {path: self.digest(path) for path in stage.sources},
+                'params': stage.params,
+            }
+            blob = json.dumps(key, sort_keys=True, default=str).encode()
+            self._keys[name] = hashlib.blake2b(blob,
+                                               digest_size=16).hexdigest()
+        return self._keys[name]
+
+    # STORAGE *****************************************************************
+
+    def _load(self, folder, key, stage):
+        try:
+            with open(os.path.join(folder, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None, False
+        if meta.get('key') != key:
+            return None, False
+        if not all(os.path.exists(path) for path in stage.outputs):
+            return None, False
+        try:
+            if meta['format'] == 'parquet':
+                return pd.read_parquet(os.path.join(folder,
+                                                    'frame.parquet')), True
+            if meta['format'] == 'npz':
+                with np.load(os.path.join(folder, 'arrays.npz'),
+                             allow_pickle=False) as npz:
+                    return {name: npz[name] for name in npz.files}, True
+        except (OSError, ValueError, ImportError):
+            return None, False
+        return None, True  # 'none': a side-effect stage
+
+    def _store(self, folder, key, result):
+        if isinstance(result, pd.DataFrame):
+            if not parquet_available():
+                return
+            fmt = 'parquet'
+        elif isinstance(result, dict):
+            fmt = 'npz'
+        elif result is None:
+            fmt = 'none'
+        else:
+            raise TypeError('stage outputs go to disk as a DataFrame, a dict '
+                            'of arrays or None, not %s' % type(result))
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            if fmt == 'parquet':
+                result.to_parquet(os.path.join(tmp, 'frame.parquet'))
+            elif fmt == 'npz':
+                np.savez(os.path.join(tmp, 'arrays.npz'),
+                         **{name: np.asarray(array)
+                            for name, array in result.items()})
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'key': key, 'format': fmt}, f, indent=1)
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(tmp, folder)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    # RUNNING *****************************************************************
+
+    def run(self, name):
+        if name in self.results:
+            return self.results[name]
+        stage = self.stages[name]
+        cached = stage.store and self.enabled
+        folder = os.path.join(self.root, name)
+        key = self.key(name)
+        with self._measure(name):
+            result, hit = (self._load(folder, key, stage) if cached
+                           else (None, False))
+        if not hit:
+            # the inputs are only needed (and loaded) when the stage reruns
+            args = [self.run(dep) for dep in stage.inputs]
+            with self._measure(name):
+                result = stage.func(*args, **stage.params)
+                if cached:
+                    self._store(folder, key, result)
+            self.executed.append(name)
+
+        if self.profiler is not None:
+            self.profiler.records[name]['status'] = 'cached' if hit else 'ran'
+            self.profiler.count(name, result)
+        self.results[name] = result
+        return result
+
+    def _measure(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.measure(name)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
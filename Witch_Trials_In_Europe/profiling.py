@@ -0,0 +1,192 @@
+# Opt-in timing and memory profile of the pipeline's stages.
+
+# Off unless asked for: set WITCH_TRIALS_PROFILE (to 1 or to the path of the
+# report) before running any of the scripts, or run
+#   python eu_witch_trials.py --profile [PATH]
+# Switched off, the pipeline and the geometry cache only check that their
+# `profiler` is None.
+
+# For every stage (and every geometry cache entry, as geo_cache:<name>,
+# within load_geo) the profiler records the wall and CPU time, whether it
+# ran or came from the cache, the peak of the memory it allocated on top of
+# what was allocated when it started (tracemalloc, which slows the run down
+# while it's on), the process' peak RSS so far, and the size of its result:
+# rows of a table, features and vertices of packed geometries and
+# topologies, traces, features and vertices of a figure. A stage's time
+# doesn't include its inputs' stages (but load_geo's includes its cache
+# entries). The records go to a JSON report and a short table is printed.
+
+import atexit
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+PROFILE_ENV = 'WITCH_TRIALS_PROFILE'
+REPORT_FILE = 'stage_profile.json'
+
+
+def max_rss():
+    """Peak resident memory of the process so far in bytes (None where the
+    resource module doesn't exist)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # Linux: KiB
+
+
+# SIZES ***********************************************************************
+
+def figure_counts(fig):
+    traces = fig.data
+    vertices = sum(len(trace.lon) for trace in traces
+                   if getattr(trace, 'lon', None) is not None)
+    features = sum(len(trace.geojson.get('features', ()))
+                   for trace in traces
+                   if isinstance(getattr(trace, 'geojson', None), dict))
+    return {'traces': len(traces), 'features': features,
+            'vertices': vertices}
+
+
+def array_counts(arrays):
+    """Features and vertices of the packed geometries and topologies in a
+    dict of arrays (names like 'coast.coords' or '0.arcs'), rows of the
+    tables, summed over the nested dicts."""
+    counts = {}
+
+    def add(name, n):
+        counts[name] = counts.get(name, 0) + int(n)
+
+    for key, value in arrays.items():
+        if isinstance(value, (dict, pd.DataFrame)):
+            for name, n in result_counts(value).items():
+                add(name, n)
+            continue
+        field = str(key).rsplit('.', 1)[-1]
+        if field in ('coords', 'arcs'):
+            add('vertices', len(value))
+        elif field == 'feat_offsets':
+            add('features', max(len(value) - 1, 0))
+    return counts
+
+
+def result_counts(result):
+    """The size of a stage's result, as a dict of counts."""
+    if isinstance(result, pd.DataFrame):
+        return {'rows': len(result)}
+    if isinstance(result, dict):
+        return array_counts(result)
+    if isinstance(result, np.ndarray):
+        return {'rows': len(result)}
+    try:
+        from plotly.basedatatypes import BaseFigure
+    except ImportError:
+        return {}
+    if isinstance(result, BaseFigure):
+        return figure_counts(result)
+    return {}
+
+
+# PROFILER ********************************************************************
+
+class Profiler:
+    """Records of the stages measured, by name, in the order they finished.
+    A name measured more than once (a stage's cache lookup, then its run)
+    adds up into the same record."""
+
+    def __init__(self, path=REPORT_FILE, trace_memory=True):
+        self.path = path
+        self.trace_memory = trace_memory
+        self.records = {}
+        self.started = time.perf_counter()
+        self.finished = False
+        self._peaks = []  # the peak traced memory of each open measurement
+
+    @contextmanager
+    def measure(self, name):
+        record = self.records.setdefault(name, {
+            'stage': name, 'status': None, 'wall': 0.0, 'cpu': 0.0,
+            'memory_peak': None, 'max_rss': None})
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if self._peaks:  # keep the enclosing measurement's peak
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self._peaks.append(current)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] += time.perf_counter() - wall
+            record['cpu'] += time.process_time() - cpu
+            if self.trace_memory:
+                peak = max(self._peaks.pop(),
+                           tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                record['memory_peak'] = max(record['memory_peak'] or 0,
+                                            peak - current)
+            record['max_rss'] = max_rss()
+            # listed in the order they finish: a stage after its inputs
+            self.records[name] = self.records.pop(name)
+
+    def count(self, name, result):
+        self.records[name].update(result_counts(result))
+
+    # REPORT ******************************************************************
+
+    def report(self):
+        return {'date': datetime.now().isoformat(timespec='seconds'),
+                'command': sys.argv,
+                'wall': time.perf_counter() - self.started,
+                'max_rss': max_rss(),
+                'stages': list(self.records.values())}
+
+    def summary(self):
+        lines = ['%-28s %-6s %8s %8s %9s  %s' % (
+            'stage', '', 'wall s', 'cpu s', 'peak MB', 'size')]
+        for r in self.records.values():
+            size = ', '.join('{:,} {}'.format(r[name], name) for name in
+                             ('rows', 'features', 'traces', 'vertices')
+                             if r.get(name))
+            peak = ('%9.1f' % (r['memory_peak'] / 2**20)
+                    if r['memory_peak'] is not None else '%9s' % '-')
+            lines.append('%-28s %-6s %8.3f %8.3f %s  %s' % (
+                r['stage'], r['status'] or '', r['wall'], r['cpu'], peak,
+                size))
+        rss = max_rss()
+        if rss is not None:
+            lines.append('peak RSS %.0f MB' % (rss / 2**20))
+        return '\n'.join(lines)
+
+    def finish(self):
+        """Write the report and print the summary (once)."""
+        if self.finished:
+            return
+        self.finished = True
+        with open(self.path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        print(self.summary())
+        print('profile written to %s' % self.path)
+
+
+def from_environment(environ=os.environ):
+    """A Profiler reporting at exit if PROFILE_ENV is set (to a path, or to
+    1 for REPORT_FILE), None otherwise."""
+    value = environ.get(PROFILE_ENV, '')
+    if value in ('', '0'):
+        return None
+    profiler = Profiler(REPORT_FILE if value == '1' else value)
+    atexit.register(profiler.finish)
+    return profiler
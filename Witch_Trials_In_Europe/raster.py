@@ -0,0 +1,736 @@
+# Drawing the map straight to a PNG, without Kaleido.
+
+# pio.write_image() hands the figure as JSON to a headless Chromium, which
+# lays out and paints the whole SVG: seconds and hundreds of MB per picture.
+# Here the same figure (a go.Figure or its dict, e.g. batch.py's variants) is
+# painted with NumPy and Pillow:
+# - the geo subplot's Miller projection is computed in NumPy and fitted into
+#   the subplot's domain, and clipped, the way plotly.js fits the lon/lat
+#   ranges;
+# - the land fill, the boundaries and the coastline strokes are drawn into
+#   coverage masks SUPERSAMPLE times larger than the picture and reduced
+#   (anti-aliasing), then each trace is blended over the picture with its
+#   color and opacity, once per trace as the browser does with a path (the
+#   coverage of the same lines at the same width, as in the coastline's
+#   glow, is computed once);
+# - the circles (with their radial gradient) and their centers are blended
+#   one by one over their bounding boxes, with an anti-aliased edge;
+# - the legend, the annotations and the title use the same text layout
+#   rules as plotly.js (1.3em lines, anchors at the closest side).
+# Only what eu_witch_trials.figure uses is supported: choropleth,
+# scattergeo and scatter traces, a Miller geo subplot, annotations and the
+# title; anything else raises UnsupportedFigure (a ValueError), and
+# eu_witch_trials.render then uses Kaleido instead. The fonts are looked up
+# by family name among the system fonts; a family that isn't installed is
+# unsupported as well (a wider fallback font would clip the footer), unless
+# DejaVu Sans is explicitly allowed to stand in for it (font_fallback).
+# pixel_difference() and `--compare` check the picture against Kaleido's.
+
+# python raster.py [--out proportional_symbols_raster.png] [--font-fallback]
+#                  [--compare eu_witch_trials.png]
+
+import argparse
+import re
+import warnings
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from geo_cache import pack_features
+
+
+OUTPUT_FILE = 'proportional_symbols_raster.png'
+
+SUPERSAMPLE = 4  # pixels per picture pixel (in each direction) of the masks
+SHARP_TURN = 0.8  # cosine of the turn from which a stroke gets a round join
+
+# plotly.js text layout, in ems:
+LINE_SPACING = 1.3
+MID_SHIFT = 0.35  # a centered line's baseline below its middle
+TEXT_PAD = 2  # px around an annotation's text (border and padding)
+
+# plotly.js's default marker opacity when the sizes are per point:
+BUBBLE_OPACITY = 0.7
+
+FALLBACK_FONTS = {False: ['DejaVuSans.ttf'], True: ['DejaVuSans-Bold.ttf',
+                                                    'DejaVuSans.ttf']}
+GENERIC_FAMILIES = {'serif', 'sans-serif', 'monospace', 'cursive', 'fantasy'}
+
+# How far the picture may be from Kaleido's (see pixel_difference): the
+# glyphs are anti-aliased differently, everything else matches to a level
+# or two.
+MAX_MEAN_DIFFERENCE = 2.5  # levels (0-255), over all the channels
+MAX_OFF_SHARE = 0.02  # of the pixels more than OFF_LEVELS off
+OFF_LEVELS = 16
+
+
+class UnsupportedFigure(ValueError):
+    """The figure has something this module doesn't draw."""
+
+
+# COLORS **********************************************************************
+
+def parse_color(color):
+    """(red, green, blue, alpha) of a CSS color ('#rrggbb', 'rgb(...)',
+    'rgba(...)'), with the channels 0-255 and alpha 0-1."""
+    color = str(color).strip()
+    if color.startswith('#'):
+        digits = color[1:]
+        if len(digits) == 3:
+            digits = ''.join(c * 2 for c in digits)
+        return (int(digits[0:2], 16), int(digits[2:4], 16),
+                int(digits[4:6], 16), 1.0)
+    match = re.match(r'rgba?\(([^)]*)\)', color.replace(' ', ''))
+    if not match:
+        raise ValueError('unsupported color %r' % color)
+    values = [float(v) for v in match.group(1).split(',')]
+    return tuple(values[:3]) + ((values[3] if len(values) > 3 else 1.0),)
+
+
+def fade(color, opacity):
+    """`color` with its alpha multiplied by `opacity`."""
+    return color[:3] + (color[3] * opacity,)
+
+
+def scale_color(colorscale, z, zmin, zmax):
+    """The colorscale's color at z, interpolated between its stops (the
+    middle color when all the z are the same, as plotly.js does)."""
+    t = 0.5 if zmax == zmin else (z - zmin) / (zmax - zmin)
+    stops = [(float(s), parse_color(c)) for s, c in colorscale]
+    for (s0, c0), (s1, c1) in zip(stops[:-1], stops[1:]):
+        if t <= s1:
+            f = 0.0 if s1 == s0 else (t - s0) / (s1 - s0)
+            return tuple(a + (b - a) * f for a, b in zip(c0, c1))
+    return stops[-1][1]
+
+
+# PROJECTION ******************************************************************
+
+def miller(lon, lat):
+    """Miller cylindrical projection, in radians (y up)."""
+    lon = np.radians(np.asarray(lon, dtype='float64'))
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    return lon, 1.25 * np.log(np.tan(np.pi / 4 + 0.4 * lat))
+
+
+class MapFrame:
+    """The geo subplot as plotly.js lays it out: the lon/lat ranges' box,
+    projected and scaled to fit the subplot's domain and centered in it, is
+    the clip box; the projection is then shifted so that the middle of the
+    ranges (in degrees, not in projected units) is at the middle of that
+    box. With Miller's stretched latitudes the map is drawn higher than
+    the box (the north is cut, and the box's bottom is filled further
+    south)."""
+
+    def __init__(self, lon_range, lat_range, left, top, width, height):
+        x, y = miller(lon_range, lat_range)
+        self.scale = min(width / (x[1] - x[0]), height / (y[1] - y[0]))
+        mx, my = miller(np.mean(lon_range), np.mean(lat_range))
+        cx, cy = left + width / 2, top + height / 2
+        self.x0 = cx - self.scale * mx
+        self.y0 = cy + self.scale * my
+        half_width = self.scale * (x[1] - x[0]) / 2
+        half_height = self.scale * (y[1] - y[0]) / 2
+        self.box = (cx - half_width, cy - half_height, cx + half_width,
+                    cy + half_height)  # left, top, right, bottom
+
+    @classmethod
+    def from_layout(cls, layout, plot):
+        geo = layout.get('geo', {})
+        projection = geo.get('projection', {}).get('type', 'miller')
+        if projection != 'miller':
+            raise UnsupportedFigure('only the Miller projection is drawn, '
+                                    'not %r' % projection)
+        domain = geo.get('domain', {})
+        dx, dy = domain.get('x', [0, 1]), domain.get('y', [0, 1])
+        left, top, width, height = plot
+        return cls(geo['lonaxis']['range'], geo['lataxis']['range'],
+                   left + dx[0] * width, top + (1 - dy[1]) * height,
+                   (dx[1] - dx[0]) * width, (dy[1] - dy[0]) * height)
+
+    def __call__(self, lon, lat):
+        """Picture coordinates (px from the top left) of lon/lat."""
+        x, y = miller(lon, lat)
+        return self.x0 + self.scale * x, self.y0 - self.scale * y
+
+
+# CANVAS **********************************************************************
+
+class Canvas:
+    """The picture as a float RGB array, painted layer by layer."""
+
+    def __init__(self, width, height, background='#ffffff'):
+        self.width, self.height = width, height
+        red, green, blue, _ = parse_color(background)
+        self.pixels = np.empty((height, width, 3), dtype='float32')
+        self.pixels[:] = (red, green, blue)
+
+    def blend(self, coverage, color, clip=None, origin=(0, 0)):
+        """Paint `color` (r, g, b, a) over the pixels, weighted by
+        `coverage` (0-1, placed at `origin` = (x, y)), inside `clip` (a
+        left, top, right, bottom box) only."""
+        red, green, blue, alpha = color
+        if alpha <= 0:
+            return
+        x, y = origin
+        h, w = coverage.shape
+        x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, self.width), \
+            min(y + h, self.height)
+        if clip is not None:
+            x0, y0 = max(x0, int(np.floor(clip[0]))), max(
+                y0, int(np.floor(clip[1])))
+            x1, y1 = min(x1, int(np.ceil(clip[2]))), min(
+                y1, int(np.ceil(clip[3])))
+        if x0 >= x1 or y0 >= y1:
+            return
+        weight = coverage[y0 - y:y1 - y, x0 - x:x1 - x] * np.float32(alpha)
+        target = self.pixels[y0:y1, x0:x1]
+        rgb = np.array([red, green, blue], dtype='float32')
+        covered = np.flatnonzero(weight)
+        if len(covered) < weight.size // 2:  # strokes: only the few covered
+            rows, cols = np.divmod(covered, weight.shape[1])
+            pixels = target[rows, cols]
+            pixels += (rgb - pixels) * weight.ravel()[covered, None]
+            target[rows, cols] = pixels
+        else:
+            target += (rgb - target) * weight[..., None]
+
+    def mask(self, clip=None):
+        """An empty Mask over `clip` (or the whole picture)."""
+        left, top, right, bottom = (0, 0, self.width, self.height)
+        if clip is not None:
+            left, top = max(left, int(np.floor(clip[0]))), max(
+                top, int(np.floor(clip[1])))
+            right, bottom = min(right, int(np.ceil(clip[2]))), min(
+                bottom, int(np.ceil(clip[3])))
+        return Mask((left, top, max(right, left), max(bottom, top)))
+
+    def paint(self, mask, color, clip=None):
+        """Blend `color` over the pixels covered by a Mask."""
+        coverage, origin = mask.coverage()
+        if coverage is not None:
+            self.blend(coverage, color, clip, origin)
+
+    def image(self):
+        return Image.fromarray(np.clip(np.round(self.pixels), 0, 255)
+                               .astype('uint8'), 'RGB')
+
+
+class Mask:
+    """The coverage of the paths drawn into a box of the picture (left,
+    top, right, bottom), SUPERSAMPLE times larger."""
+
+    def __init__(self, box):
+        self.left, self.top = box[0], box[1]
+        self.image = Image.new('L', ((box[2] - box[0]) * SUPERSAMPLE,
+                                     (box[3] - box[1]) * SUPERSAMPLE))
+        self.draw = ImageDraw.Draw(self.image)
+
+    def scaled(self, points):
+        """Picture coordinates --> the mask's."""
+        return (np.asarray(points) - (self.left, self.top)) * SUPERSAMPLE
+
+    def polygon(self, points, fill=255):
+        self.draw.polygon(self.scaled(points).ravel().tolist(), fill=fill)
+
+    def stroke(self, lines, width):
+        """Lines ((n, 2) arrays) of `width` picture pixels."""
+        px = max(int(round(width * SUPERSAMPLE)), 1)
+        lines = [line for line in lines if len(line) > 1]
+        if not lines:
+            return
+        points = self.scaled(np.vstack(lines))
+        flat = points.ravel().tolist()
+        ends = np.cumsum([len(line) for line in lines])
+        starts = np.r_[0, ends[:-1]]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.draw.line(flat[2 * start:2 * end], fill=255, width=px)
+        # round joins (Pillow's joint='curve' draws one at every vertex)
+        # where a line turns enough for the gap to show
+        if px > SUPERSAMPLE and len(points) > 2:
+            before = points[1:-1] - points[:-2]
+            after = points[2:] - points[1:-1]
+            cos = (before * after).sum(axis=1) / np.maximum(
+                np.hypot(*before.T) * np.hypot(*after.T), 1e-9)
+            inner = np.ones(len(points), dtype=bool)
+            inner[starts] = inner[ends - 1] = False
+            sharp = points[1:-1][(cos < SHARP_TURN) & inner[1:-1]]
+            r = px / 2
+            for cx, cy in sharp.tolist():
+                self.draw.ellipse((cx - r, cy - r, cx + r, cy + r), fill=255)
+
+    def coverage(self):
+        """The coverage (0-1) of the pixels around what was drawn, and
+        their top left pixel (None, None if nothing was)."""
+        box = self.image.getbbox()
+        if box is None:
+            return None, None
+        # out to whole picture pixels
+        x0, y0 = (edge // SUPERSAMPLE * SUPERSAMPLE for edge in box[:2])
+        x1, y1 = (-(-edge // SUPERSAMPLE) * SUPERSAMPLE for edge in box[2:])
+        reduced = self.image.reduce(SUPERSAMPLE, (x0, y0, x1, y1))
+        return (np.asarray(reduced, dtype='float32') / 255,
+                (self.left + x0 // SUPERSAMPLE, self.top + y0 // SUPERSAMPLE))
+
+
+def runs(x, y):
+    """The runs of finite points of NaN-separated lines, as (n, 2)
+    arrays."""
+    points = np.column_stack([x, y])
+    finite = np.isfinite(points).all(axis=1)
+    edges = np.flatnonzero(np.diff(np.r_[0, finite.astype(int), 0]))
+    return [points[a:b] for a, b in zip(edges[::2], edges[1::2])]
+
+
+def gradient_circles(canvas, x, y, diameters, color, center_color=None,
+                     clip=None):
+    """Filled circles, one after the other; with `center_color`, a radial
+    gradient from it at the center to `color` at the edge (the channels
+    and the alpha interpolated separately, as Chromium does an SVG
+    gradient)."""
+    edge = np.array(color, dtype='float64')
+    center = edge if center_color is None else np.array(center_color,
+                                                        dtype='float64')
+    for cx, cy, d in zip(x.tolist(), y.tolist(), diameters.tolist()):
+        r = d / 2
+        if not r > 0 or not np.isfinite(cx + cy):
+            continue
+        x0, y0 = int(np.floor(cx - r)), int(np.floor(cy - r))
+        x1, y1 = int(np.ceil(cx + r)) + 1, int(np.ceil(cy + r)) + 1
+        gx = np.arange(x0, x1) + 0.5 - cx
+        gy = np.arange(y0, y1) + 0.5 - cy
+        dist = np.hypot(gx[None, :], gy[:, None])
+        coverage = np.clip(r - dist + 0.5, 0, 1)
+        t = np.clip(dist / r, 0, 1)[..., None]
+        layer = center + (edge - center) * t
+        blend_rgba(canvas, layer, coverage, (x0, y0), clip)
+
+
+def blend_rgba(canvas, layer, coverage, origin, clip):
+    """Blend a per-pixel color (h, w, 4) over the canvas at `origin`."""
+    x, y = origin
+    h, w = coverage.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, canvas.width), min(y + h, canvas.height)
+    if clip is not None:
+        x0, y0 = max(x0, int(np.floor(clip[0]))), max(y0,
+                                                     int(np.floor(clip[1])))
+        x1, y1 = min(x1, int(np.ceil(clip[2]))), min(y1,
+                                                    int(np.ceil(clip[3])))
+    if x0 >= x1 or y0 >= y1:
+        return
+    part = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    weight = (coverage[part] * layer[part][..., 3])[..., None]
+    target = canvas.pixels[y0:y1, x0:x1]
+    target += (layer[part][..., :3].astype('float32') - target) * weight
+
+
+# TEXT ************************************************************************
+
+_fonts = {}
+
+
+def font_files(family, bold):
+    """The TrueType file names a plotly font family (a comma-separated
+    list) is looked up by, in order."""
+    names = []
+    for name in str(family or '').split(','):
+        name = name.strip().strip('"\'').replace(' ', '')
+        if name:
+            names += ([name + '-Bold.ttf'] if bold else []) + [
+                name + '-Regular.ttf', name + '.ttf']
+    return names
+
+
+def font_installed(family):
+    """Whether a font of the family list is installed (a generic family,
+    such as sans-serif, always is)."""
+    names = [name.strip().strip('"\'').lower()
+             for name in str(family).split(',')]
+    if any(name in GENERIC_FAMILIES for name in names):
+        return True
+    for name in font_files(family, False):
+        try:
+            ImageFont.truetype(name, 12)
+            return True
+        except OSError:
+            continue
+    return False
+
+
+def figure_fonts(fig):
+    """The font families the layout and the traces' texts use."""
+    families = set()
+
+    def collect(value):
+        if isinstance(value, dict):
+            for name, item in value.items():
+                if name == 'family' and isinstance(item, str):
+                    families.add(item)
+                else:
+                    collect(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+
+    collect(fig.get('layout', {}))
+    for trace in fig.get('data', []):
+        collect(trace.get('textfont', {}))
+    return families
+
+
+def load_font(family, size, bold):
+    """The TrueType font of a plotly font family (the first one of the
+    comma-separated list that's installed), or DejaVu Sans."""
+    key = (family, size, bold)
+    if key not in _fonts:
+        for name in font_files(family, bold) + FALLBACK_FONTS[bold]:
+            try:
+                _fonts[key] = ImageFont.truetype(name, size)
+                break
+            except OSError:
+                continue
+        else:
+            _fonts[key] = ImageFont.load_default(size)
+    return _fonts[key]
+
+
+def text_lines(text):
+    """The lines of a plotly text ('<br>'-separated), without the tags, and
+    whether it's bold."""
+    bold = '<b>' in text
+    text = re.sub(r'\s*\n\s*', ' ', text)
+    lines = re.split(r'<br\s*/?>', text)
+    lines = [re.sub(r'<[^>]+>', '', line) for line in lines]
+    while len(lines) > 1 and not lines[-1].strip():
+        lines.pop()  # a trailing <br> doesn't add a line
+    return lines, bold
+
+
+def draw_text(canvas, text, font, x, y, xanchor='left', yanchor='top',
+              align=None, baseline=False):
+    """Write a (multi-line) text block: anchored at (x, y) by its box, or
+    with its first baseline at y if `baseline`."""
+    lines, bold = text_lines(text)
+    face = load_font(font.get('family'), float(font.get('size', 12)), bold)
+    size = float(font.get('size', 12))
+    ascent, descent = face.getmetrics()
+    height = (len(lines) - 1) * LINE_SPACING * size + ascent + descent
+    if baseline:
+        first = y
+    else:
+        top = {'top': y, 'middle': y - height / 2,
+               'bottom': y - height}[yanchor]
+        first = top + ascent
+
+    widths = [face.getlength(line) for line in lines]
+    block = max(widths)
+    left = {'left': x, 'center': x - block / 2, 'right': x - block}[xanchor]
+    align = align or xanchor
+
+    image = Image.new('L', (canvas.width, canvas.height))
+    draw = ImageDraw.Draw(image)
+    for i, (line, width) in enumerate(zip(lines, widths)):
+        offset = {'left': 0, 'center': (block - width) / 2,
+                  'right': block - width}[align]
+        draw.text((left + offset, first + i * LINE_SPACING * size), line,
+                  font=face, fill=255, anchor='ls')
+    canvas.blend(np.asarray(image, dtype='float32') / 255,
+                 parse_color(font.get('color', '#444')))
+
+
+def auto_anchor(value, anchor, names):
+    """plotly.js' 'auto' anchor for paper-positioned text: the closest
+    side."""
+    if anchor not in (None, 'auto'):
+        return anchor
+    return names[0] if value <= 1 / 3 else names[2] if value >= 2 / 3 \
+        else names[1]
+
+
+# FIGURE **********************************************************************
+
+def values(value, n=None):
+    """A trace attribute as a NumPy array (a scalar repeated n times)."""
+    if value is None:
+        return None
+    array = np.asarray(value)
+    if array.ndim == 0 and n is not None:
+        return np.full(n, array.item())
+    return array
+
+
+class Renderer:
+    """Paints one figure dict onto a Canvas."""
+
+    def __init__(self, fig, width=None, height=None, font_fallback=False):
+        self.fig = fig if isinstance(fig, dict) else fig.to_plotly_json()
+        self.layout = self.fig.get('layout', {})
+        missing = sorted(family for family in figure_fonts(self.fig)
+                         if not font_installed(family))
+        if missing and not font_fallback:
+            raise UnsupportedFigure('fonts not installed: %s'
+                                    % ', '.join(missing))
+        if missing:
+            warnings.warn('fonts not installed, drawn with DejaVu Sans: %s'
+                          % ', '.join(missing))
+        self.width = int(width or self.layout.get('width', 700))
+        self.height = int(height or self.layout.get('height', 450))
+        margin = {'l': 80, 'r': 80, 't': 100, 'b': 80}
+        margin.update(self.layout.get('margin', {}))
+        self.plot = (margin['l'], margin['t'],
+                     self.width - margin['l'] - margin['r'],
+                     self.height - margin['t'] - margin['b'])
+        self.canvas = Canvas(self.width, self.height,
+                             self.layout.get('paper_bgcolor', '#ffffff'))
+        self.frame = (MapFrame.from_layout(self.layout, self.plot)
+                      if 'geo' in self.layout else None)
+        self.strokes = {}  # (width, lon, lat) --> Mask.coverage()
+
+    def render(self):
+        traces = self.fig.get('data', [])
+        # plotly.js stacks the geo subplot over the cartesian one
+        for trace in traces:
+            if trace.get('type', 'scatter') == 'scatter':
+                self.scatter(trace)
+        for trace in traces:
+            kind = trace.get('type', 'scatter')
+            if kind == 'choropleth':
+                self.choropleth(trace)
+            elif kind == 'scattergeo':
+                self.scattergeo(trace)
+            elif kind != 'scatter':
+                raise UnsupportedFigure('%s traces are not drawn' % kind)
+        for annotation in self.layout.get('annotations', []):
+            self.annotation(annotation)
+        self.title()
+        return self.canvas.image()
+
+    # TRACES ******************************************************************
+
+    def choropleth(self, trace):
+        features = pack_features(trace['geojson']['features'])
+        positions = {idx: i for i, idx in enumerate(features['ids'].tolist())}
+        locations = list(values(trace['locations']))
+        z = values(trace['z']).astype('float64')
+        zmin = trace.get('zmin', z.min() if len(z) else 0)
+        zmax = trace.get('zmax', z.max() if len(z) else 0)
+        x, y = self.frame(features['coords'][:, 0], features['coords'][:, 1])
+        points = np.column_stack([x, y])
+
+        def rings(feature):
+            rings = features['ring_offsets']
+            polys = features['poly_offsets']
+            feats = features['feat_offsets']
+            for p in range(feats[feature], feats[feature + 1]):
+                yield [points[rings[r]:rings[r + 1]]
+                       for r in range(polys[p], polys[p + 1])]
+
+        # the fill, by color (the holes cut out of their polygon)
+        fills = {}
+        for location, value in zip(locations, z.tolist()):
+            if location in positions:
+                color = scale_color(trace['colorscale'], value, zmin, zmax)
+                fills.setdefault(color, []).append(positions[location])
+        for color, feature_list in fills.items():
+            if color[3] <= 0:
+                continue
+            mask = self.canvas.mask(self.frame.box)
+            for feature in feature_list:
+                for polygon in rings(feature):
+                    mask.polygon(polygon[0])
+                    for hole in polygon[1:]:
+                        mask.polygon(hole, fill=0)
+            self.canvas.paint(mask, color, self.frame.box)
+
+        # the outlines
+        line = trace.get('marker', {}).get('line', {})
+        color = parse_color(line.get('color', '#444'))
+        if color[3] > 0 and line.get('width', 1) > 0:
+            mask = self.canvas.mask(self.frame.box)
+            outlines = [np.vstack([ring, ring[:1]])
+                        for location in locations if location in positions
+                        for polygon in rings(positions[location])
+                        for ring in polygon]
+            mask.stroke(outlines, line.get('width', 1))
+            self.canvas.paint(mask, color, self.frame.box)
+
+    def scattergeo(self, trace):
+        lon = values(trace.get('lon'))
+        lat = values(trace.get('lat'))
+        if lon is None or not len(lon):
+            return
+        x, y = self.frame(lon.astype('float64'), lat.astype('float64'))
+        mode = trace.get('mode', 'markers')
+        if 'lines' in mode:
+            line = trace.get('line', {})
+            color = parse_color(line.get('color', '#444'))
+            if color[3] > 0:
+                # the layers of a glow are the same lines, some of them
+                # with the same width: their coverage is computed once
+                width = line.get('width', 2)
+                key = (width, lon.tobytes(), lat.tobytes())
+                if key not in self.strokes:
+                    mask = self.canvas.mask(self.frame.box)
+                    mask.stroke(runs(x, y), width)
+                    self.strokes[key] = mask.coverage()
+                coverage, origin = self.strokes[key]
+                if coverage is not None:
+                    self.canvas.blend(coverage, color, self.frame.box,
+                                      origin)
+        if 'markers' in mode:
+            self.markers(trace.get('marker', {}), x, y, self.frame.box)
+
+    def scatter(self, trace):
+        xaxis = self.layout.get('xaxis', {})
+        yaxis = self.layout.get('yaxis', {})
+        (x0, x1), (y0, y1) = xaxis.get('range', [0, 1]), yaxis.get('range',
+                                                                   [0, 1])
+        left, top, width, height = self.plot
+        x = left + (values(trace['x']).astype('float64') - x0) / (x1 - x0) \
+            * width
+        y = top + (1 - (values(trace['y']).astype('float64') - y0)
+                   / (y1 - y0)) * height
+        mode = trace.get('mode', 'markers')
+        marker = trace.get('marker', {})
+        if 'markers' in mode:
+            self.markers(marker, x, y)
+        if 'text' in mode:
+            position = trace.get('textposition', 'middle center')
+            vertical, horizontal = position.split()
+            sizes = values(marker.get('size', 6), len(x)).astype('float64')
+            for text, tx, ty, size in zip(values(trace['text'], len(x)),
+                                          x, y, sizes):
+                self.point_text(str(text), tx, ty, size, vertical,
+                                horizontal, trace.get('textfont', {}))
+
+    def markers(self, marker, x, y, clip=None):
+        color = marker.get('color', '#1f77b4')
+        if not isinstance(color, str):  # numbers on a colorscale
+            stops = [parse_color(c) for _, c in marker.get('colorscale', [])]
+            if not stops or any(stop[3] > 0 for stop in stops):
+                raise UnsupportedFigure('markers colored by a colorscale '
+                                        'are not drawn')
+            return  # transparent all along (Layer 6)
+        size = marker.get('size', 6)
+        sizes = values(size, len(x)).astype('float64')
+        opacity = marker.get('opacity',
+                             BUBBLE_OPACITY if np.ndim(size) else 1)
+        color = fade(parse_color(color), opacity)
+        gradient = marker.get('gradient', {})
+        center = (fade(parse_color(gradient['color']), opacity)
+                  if gradient.get('type') == 'radial' else None)
+        if color[3] <= 0 and (center is None or center[3] <= 0):
+            return
+        gradient_circles(self.canvas, x, y, sizes, color, center, clip)
+
+    # TEXT ********************************************************************
+
+    def point_text(self, text, x, y, size, vertical, horizontal, font):
+        """A marker's text, beside it as plotly.js puts it."""
+        lines, _ = text_lines(text)
+        font_size = float(font.get('size', 12))
+        shift = size / 2 + 1 if size else 0
+        xanchor = {'left': 'right', 'right': 'left'}.get(horizontal,
+                                                         'center')
+        tx = x + {'left': -shift, 'right': shift}.get(horizontal, 0)
+        n = len(lines) - 1
+        first = {'top': y - shift - n * LINE_SPACING * font_size,
+                 'bottom': y + shift + font_size}.get(
+            vertical, y - n * LINE_SPACING * font_size / 2)
+        if vertical not in ('top', 'bottom'):
+            first += MID_SHIFT * font_size
+        draw_text(self.canvas, text, font, tx, first, xanchor,
+                  baseline=True)
+
+    def annotation(self, annotation):
+        left, top, width, height = self.plot
+        x, y = annotation.get('x', 0.5), annotation.get('y', 0.5)
+        if annotation.get('xref', 'paper') not in ('paper', 'x domain') or \
+                annotation.get('yref', 'paper') not in ('paper', 'y domain'):
+            raise UnsupportedFigure('only paper- and domain-positioned '
+                                    'annotations are drawn')
+        xanchor = auto_anchor(x, annotation.get('xanchor'),
+                              ['left', 'center', 'right'])
+        yanchor = auto_anchor(y, annotation.get('yanchor'),
+                              ['bottom', 'middle', 'top'])
+        px = left + x * width + {'left': TEXT_PAD, 'right': -TEXT_PAD}.get(
+            xanchor, 0)
+        py = top + (1 - y) * height + {'top': TEXT_PAD,
+                                       'bottom': -TEXT_PAD}.get(yanchor, 0)
+        draw_text(self.canvas, annotation.get('text', ''),
+                  annotation.get('font', {}), px, py, xanchor, yanchor,
+                  annotation.get('align', 'center'))
+
+    def title(self):
+        title = self.layout.get('title', {})
+        if isinstance(title, str):
+            title = {'text': title}
+        if not title.get('text'):
+            return
+        x = title.get('x', 0.5) * self.width
+        # plotly.js puts the first baseline at y (of the whole picture)
+        y = (1 - title.get('y', 0.95)) * self.height
+        xanchor = auto_anchor(title.get('x', 0.5), title.get('xanchor'),
+                              ['left', 'center', 'right'])
+        draw_text(self.canvas, title['text'], title.get('font', {}), x, y,
+                  xanchor, align='center', baseline=True)
+
+
+def render_figure(fig, width=None, height=None, font_fallback=False):
+    """The figure painted as a PIL image. A font that isn't installed is
+    UnsupportedFigure, or DejaVu Sans (with a warning) if
+    `font_fallback`."""
+    return Renderer(fig, width, height, font_fallback).render()
+
+
+def write_png(fig, path, width=None, height=None, font_fallback=False):
+    render_figure(fig, width, height, font_fallback).save(path)
+    return path
+
+
+def pixel_difference(image, reference):
+    """The mean absolute difference of two pictures of the same size (in
+    levels, 0-255) and the share of the pixels more than OFF_LEVELS off in
+    any channel."""
+    a = np.asarray(image.convert('RGB'), dtype='int16')
+    b = np.asarray(reference.convert('RGB'), dtype='int16')
+    if a.shape != b.shape:
+        raise ValueError('the pictures are %s and %s'
+                         % (a.shape[1::-1], b.shape[1::-1]))
+    difference = np.abs(a - b)
+    return (float(difference.mean()),
+            float((difference.max(axis=2) > OFF_LEVELS).mean()))
+
+
+# COMMAND LINE ****************************************************************
+
+def main():
+    import eu_witch_trials as ewt
+
+    parser = argparse.ArgumentParser(description='Draw the map to a PNG '
+                                     'without Kaleido.')
+    parser.add_argument('--out', default=OUTPUT_FILE)
+    parser.add_argument('--font-fallback', action='store_true',
+                        help="draw the fonts that aren't installed with "
+                        'DejaVu Sans')
+    parser.add_argument('--compare', metavar='PNG',
+                        help="the same map drawn by Kaleido, e.g. "
+                        'eu_witch_trials.png')
+    args = parser.parse_args()
+    print(write_png(ewt.pipeline.run('figure'), args.out,
+                    ewt.view['width'], ewt.view['height'],
+                    args.font_fallback))
+    if args.compare:
+        mean, off = pixel_difference(Image.open(args.out),
+                                     Image.open(args.compare))
+        print('mean difference %.2f levels (at most %.1f), %.2f%% of the '
+              'pixels more than %d off (at most %.0f%%)'
+              % (mean, MAX_MEAN_DIFFERENCE, off * 100, OFF_LEVELS,
+                 MAX_OFF_SHARE * 100))
+        if mean > MAX_MEAN_DIFFERENCE or off > MAX_OFF_SHARE:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
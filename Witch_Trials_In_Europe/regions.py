@@ -0,0 +1,161 @@
+# Resolving the trials' (country, region, county) to NUTS regions.
+
+# All the mappings (merged regions, the level of detail per country, NUTS
+# codes and country names) live in one versioned CSV file, data/
+# region_map_v1.csv, so a new regional mapping is a new line there rather
+# than a code change. The rules are only evaluated once per distinct
+# (country, adm1, adm2) combination; the rows then get their result through
+# the combination's integer code.
+
+import numpy as np
+import pandas as pd
+
+from cleaning import new_region, nuts_level
+
+
+REGION_MAP_FILE = 'data/region_map_v1.csv'
+
+KEY_COLUMNS = ['country', 'gadm.adm1', 'gadm.adm2']
+RESOLVED_COLUMNS = ['new_region', 'map_id', 'nuts_level', 'cntr_code']
+
+# The NUTS codes of the regions the trials' coordinates fall into (see the
+# locate stage in eu_witch_trials.py):
+LOCATED_COLUMNS = ['nuts_1', 'nuts_2', 'nuts_3']
+
+
+class RegionLookup:
+
+    def __init__(self, nuts_dict_1, nuts_dict_2, detail, new_id_dict,
+                 country_dict):
+        self.nuts_dict_1 = nuts_dict_1  # adm1 --> merged region
+        self.nuts_dict_2 = nuts_dict_2  # adm2 --> merged region
+        self.detail = detail  # country --> column to count its trials by
+        self.new_id_dict = new_id_dict  # region --> NUTS code
+        self.country_dict = country_dict  # NUTS country code --> name
+
+    @classmethod
+    def from_csv(cls, path=REGION_MAP_FILE):
+        table = pd.read_csv(path, comment='#', keep_default_na=False,
+                            dtype=str)
+        tables = {kind: dict(zip(rows['key'], rows['value']))
+                  for kind, rows in table.groupby('kind', sort=False)}
+        return cls(tables.get('adm1', {}), tables.get('adm2', {}),
+                   tables.get('detail', {}), tables.get('nuts', {}),
+                   tables.get('country', {}))
+
+    def compile(self, keys):
+        """new_region, map_id, nuts_level and cntr_code for a table of
+        distinct (country, gadm.adm1, gadm.adm2) combinations."""
+        table = pd.DataFrame(index=keys.index)
+        table['new_region'] = new_region(keys, self.nuts_dict_1,
+                                         self.nuts_dict_2, self.detail)
+        table['map_id'] = table['new_region'].map(self.new_id_dict)
+        table['nuts_level'] = nuts_level(table['map_id'])
+        table['cntr_code'] = table['map_id'].str[:2]
+        return table
+
+    def resolve(self, trials, keep_unresolved=False):
+        """`trials` with the RESOLVED_COLUMNS appended. Rows whose region has
+        no NUTS code are dropped unless `keep_unresolved`."""
+        keys = trials[KEY_COLUMNS]
+
+        # One integer per row for its combination: the columns' factorized
+        # codes (-1 for NaN) combined into one number. This works the same
+        # for plain string and categorical columns.
+        codes = [pd.factorize(keys[name])[0] + 1 for name in KEY_COLUMNS]
+        combined = np.ravel_multi_index(
+            codes, [code.max() + 1 if len(code) else 1 for code in codes])
+        _, first, codes = np.unique(combined, return_index=True,
+                                    return_inverse=True)
+        uniques = keys.iloc[first].astype(object)  # in the order of the codes
+
+        table = self.compile(uniques).to_numpy()
+        resolved = pd.DataFrame(table[codes], index=trials.index,
+                                columns=RESOLVED_COLUMNS)
+
+        trials = pd.concat([trials, resolved], axis=1)
+        if not keep_unresolved:
+            trials = drop_unresolved(trials)
+        return trials
+
+    def recover(self, trials, located):
+        """Fill in the map_id of the unresolved rows of resolve()'s output
+        (with keep_unresolved) from the NUTS regions their coordinates fall
+        into (`located`, LOCATED_COLUMNS on the same index), at the level
+        their country is shown at. Countries without any resolved rows
+        aren't on the map, so their rows stay unresolved. Returns the table
+        and the number of rows recovered."""
+        nuts_3 = located['nuts_3'].reindex(trials.index)
+        level = nuts_3.str[:2].map(shown_levels(trials))
+        missing = trials['map_id'].isna() & level.notna()
+
+        codes = pd.Series(np.nan, index=trials.index, dtype=object)
+        for value in level[missing].unique():
+            rows = missing & (level == value)
+            codes[rows] = nuts_3[rows].str[:2 + int(value)]
+
+        return assign(trials, missing, codes), int(missing.sum())
+
+    def match_names(self, trials, names, threshold=0.8):
+        """Proposed NUTS codes for the regions of the unresolved rows of
+        resolve()'s output (with keep_unresolved) that aren't in new_id_dict:
+        the NUTS region with the most similar name (`names`, a
+        fuzzy.NameIndex grouped by country code and level) in the same
+        country, at the level the country is shown at. One row per distinct
+        (country, new_region) matched with a score of at least `threshold`,
+        with the map_id, the NUTS name and the score."""
+        codes = {name: code for code, name in self.country_dict.items()}
+        unresolved = trials[trials['map_id'].isna()
+                            & trials['new_region'].notna()]
+        pairs = unresolved[['country', 'new_region']].astype(
+            object).drop_duplicates().reset_index(drop=True)
+
+        cntr_code = pairs['country'].map(codes)
+        level = cntr_code.map(shown_levels(trials))
+        pairs = pairs[level.notna()].reset_index(drop=True)
+        groups = (cntr_code[level.notna()]
+                  + level[level.notna()].astype('int64').astype(str))
+
+        found = names.match(pairs['new_region'], groups.to_numpy(), threshold)
+        proposals = pairs.iloc[found['query']].reset_index(drop=True)
+        proposals['map_id'] = found['id'].to_numpy()
+        proposals['NAME_LATN'] = found['name'].to_numpy()
+        proposals['score'] = found['score'].to_numpy()
+        return proposals
+
+    def apply_matches(self, trials, proposals):
+        """Resolve the rows of match_names()'s (country, new_region) pairs
+        with the proposed codes. Returns the table and the number of rows
+        resolved."""
+        keys = pd.MultiIndex.from_frame(
+            trials[['country', 'new_region']].astype(object))
+        codes = pd.Series(proposals['map_id'].to_numpy(),
+                          index=pd.MultiIndex.from_frame(
+                              proposals[['country', 'new_region']]))
+        codes = pd.Series(codes.reindex(keys).to_numpy(), index=trials.index)
+        missing = trials['map_id'].isna() & codes.notna()
+        return assign(trials, missing, codes), int(missing.sum())
+
+
+def shown_levels(trials):
+    """The NUTS level each country's resolved rows are counted at, by
+    country code."""
+    return trials.dropna(subset=['map_id']).groupby(
+        'cntr_code')['nuts_level'].max().astype('int64')
+
+
+def assign(trials, rows, codes):
+    """`trials` with the NUTS `codes` (a Series on the same index) as the
+    map_id of the `rows`, and their level and country code to match."""
+    trials = trials.copy()
+    trials.loc[rows, 'map_id'] = codes[rows]
+    trials.loc[rows, 'nuts_level'] = nuts_level(codes[rows])
+    trials.loc[rows, 'cntr_code'] = codes[rows].str[:2]
+    return trials
+
+
+def drop_unresolved(trials):
+    """The rows with a NUTS code."""
+    trials = trials[trials['map_id'].notna()].copy()
+    trials['nuts_level'] = trials['nuts_level'].astype('int64')
+    return trials
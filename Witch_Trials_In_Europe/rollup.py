@@ -0,0 +1,119 @@
+# Trial counts at the finest NUTS code known, rolled up to any level per
+# country.
+
+# The level a country is shown at comes from data/region_map_v1.csv (the
+# column its trials are counted by), and the sums used to exist at that level
+# only: another level meant another mapping and another run of the cleaning
+# and aggregation. Here the trials are summed once per decade at the finest
+# NUTS code known for each of them: the NUTS-3 region its coordinates fall
+# into when that lies within the region it was resolved to, and the resolved
+# region otherwise. A NUTS code's parents are its prefixes (2, 3, 4 and 5
+# characters for levels 0-3), so any per-country level map is one pass over
+# the (small) table of sums: every code is cut to its country's length and
+# the sums are added up again. Trials whose finest code is coarser than the
+# level asked for stay at their code.
+
+import numpy as np
+import pandas as pd
+
+from aggregation import aggregate_trials
+from regions import shown_levels
+
+
+CODE_LENGTH = 5  # a NUTS-3 code
+LEVELS = range(4)
+
+
+def truncate(codes, lengths):
+    """Every NUTS code of `codes` cut to its length in `lengths` (or left
+    as it is if it's shorter)."""
+    codes = np.asarray(codes, dtype='U%d' % CODE_LENGTH)
+    chars = codes.view('U1').reshape(len(codes), CODE_LENGTH).copy()
+    chars[np.arange(CODE_LENGTH) >= np.asarray(lengths)[:, None]] = ''
+    return chars.view('U%d' % CODE_LENGTH).ravel()
+
+
+def finest_codes(trials, located):
+    """The map_id of every trial of the cleaned table, or the NUTS-3 region
+    its coordinates fall into (`located`, see the locate stage) if that is
+    within the map_id's region."""
+    map_id = trials['map_id'].to_numpy(dtype=str)
+    nuts_3 = located['nuts_3'].reindex(trials.index)
+    nuts_3 = nuts_3.fillna('').to_numpy(dtype=str)
+    within = truncate(nuts_3, np.char.str_len(map_id)) == map_id
+    return np.where(within, nuts_3, map_id)
+
+
+class RollUp:
+    """The trials summed per finest NUTS code (`codes`) and decade, and the
+    level each country with trials is shown at by default."""
+
+    def __init__(self, codes, decades, tried, executed, countries, levels):
+        self.codes = np.asarray(codes).astype('U%d' % CODE_LENGTH)
+        self.decades = np.asarray(decades, dtype='int64')
+        self.tried = np.asarray(tried, dtype='int64')
+        self.executed = np.asarray(executed, dtype='int64')
+        self.countries = np.asarray(countries).astype('U2')  # sorted
+        self.levels = np.asarray(levels, dtype='int64')
+
+    @classmethod
+    def from_trials(cls, trials, located, backend='auto'):
+        """From the cleaned trials and the NUTS regions of their
+        coordinates (LOCATED_COLUMNS)."""
+        finest = trials[['decade', 'tried', 'executed']].assign(
+            map_id=finest_codes(trials, located))
+        sums = aggregate_trials(finest, backend).per_decade
+        default = shown_levels(trials).sort_index()
+        return cls(sums['map_id'], sums['decade'], sums['tried'],
+                   sums['executed'], default.index, default.to_numpy())
+
+    def to_arrays(self):
+        return {'codes': self.codes, 'decades': self.decades,
+                'tried': self.tried, 'executed': self.executed,
+                'countries': self.countries, 'levels': self.levels}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['codes'], arrays['decades'], arrays['tried'],
+                   arrays['executed'], arrays['countries'], arrays['levels'])
+
+    # ROLLING UP **************************************************************
+
+    def level_map(self, levels=None):
+        """The level of every country with trials: the default one, or the
+        one in `levels` (country code --> level) for the countries in it.
+        Codes of countries without trials are an error."""
+        levels = dict(levels or {})
+        wrong = {code: level for code, level in levels.items()
+                 if level not in LEVELS}
+        if wrong:
+            raise ValueError('NUTS levels are 0 to 3, not %s' % wrong)
+        default = dict(zip(self.countries.tolist(), self.levels.tolist()))
+        unknown = sorted(code for code in levels if code not in default)
+        if unknown:
+            raise ValueError('unknown country codes %s, the countries with '
+                             'trials are %s' % (unknown, sorted(default)))
+        return {code: levels.get(code, level)
+                for code, level in default.items()}
+
+    def aggregate(self, levels=None):
+        """The sums at the levels of level_map(levels), per place and
+        decade and per place (aggregation.Aggregates)."""
+        level_map = self.level_map(levels)
+        shown = np.array([level_map[code]
+                          for code in self.countries.tolist()], dtype='int64')
+        country = np.searchsorted(self.countries, self.codes.astype('U2'))
+        codes = truncate(self.codes, 2 + shown[country])
+        sums = pd.DataFrame({'map_id': codes, 'decade': self.decades,
+                             'tried': self.tried,
+                             'executed': self.executed})
+        return aggregate_trials(sums, 'pandas')
+
+    def places(self, countries, levels=None):
+        """(country code, level) of the places on the map: the countries
+        with trials at their levels, and the other ones of `countries` at
+        level 0."""
+        level_map = self.level_map(levels)
+        countries = list(countries) + [code for code in level_map
+                                       if code not in countries]
+        return [(code, level_map.get(code, 0)) for code in countries]
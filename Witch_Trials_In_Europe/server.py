@@ -0,0 +1,188 @@
+# A local interactive version of the map: pick a range of decades and a set
+# of countries, and the circles follow.
+
+# The page gets the whole figure once (coastlines and boundaries included)
+# together with a local copy of plotly.js, so nothing is loaded from outside.
+# After that, every change of the controls only fetches /data: the changing
+# arrays of Layers 4-6 (see animation.frame_data), computed from the decade
+# index in O(places) and cached, which the page merges into its copy of the
+# traces and hands to Plotly.react. The coastline and boundary GeoJSON never
+# go over the wire again.
+
+# python server.py [--port 8050]  -->  http://127.0.0.1:8050/
+
+import argparse
+import json
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import plotly.utils
+from plotly.offline import get_plotlyjs
+
+import eu_witch_trials as ewt
+from animation import base_traces, frame_data, merged
+from batch import static_figure
+from decades import DecadeIndex
+
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Witch Trials in Europe</title>
+<script src="/plotly.min.js"></script>
+<style>
+body {margin: 0; background: #010103; color: rgba(255,234,187,0.8);
+      font-family: 'Almendra Display', serif;}
+#controls {padding: 10px 20px; font-size: 18px;}
+#controls input, #controls select {background: #010103;
+    color: rgba(255,234,187,0.8); border: 1px solid rgba(64,64,64,1);
+    font-family: inherit; font-size: 16px;}
+#controls input {width: 5em;}
+</style>
+</head>
+<body>
+<div id="controls">
+  Decades <input id="start" type="number" step="10" value="%(start)d">
+  &ndash; <input id="end" type="number" step="10" value="%(end)d">
+  &nbsp; Countries <select id="countries" multiple size="1">%(options)s</select>
+  <small>(none selected = all)</small>
+</div>
+<div id="map"></div>
+<script>
+const figure = %(figure)s;
+const traces = %(traces)s;
+const gd = document.getElementById('map');
+let revision = 0;
+
+function merged(trace, update) {
+  const out = Object.assign({}, trace);
+  for (const [name, value] of Object.entries(update)) {
+    out[name] = (value && typeof value === 'object' && !value.bdata
+                 && trace[name] && typeof trace[name] === 'object')
+      ? merged(trace[name], value) : value;
+  }
+  return out;
+}
+
+async function update() {
+  const countries = Array.from(
+    document.getElementById('countries').selectedOptions, o => o.value);
+  const query = new URLSearchParams({
+    start: document.getElementById('start').value,
+    end: document.getElementById('end').value,
+    countries: countries.join(',')});
+  const updates = await (await fetch('/data?' + query)).json();
+  const data = gd.data.slice();
+  traces.forEach((i, k) => { data[i] = merged(figure.data[i], updates[k]); });
+  gd.layout.datarevision = ++revision;
+  Plotly.react(gd, data, gd.layout);
+}
+
+Plotly.newPlot(gd, figure.data, figure.layout, {responsive: true});
+for (const id of ['start', 'end', 'countries']) {
+  document.getElementById(id).addEventListener('change', update);
+}
+</script>
+</body>
+</html>
+'''
+
+
+class MapApp:
+    """Everything the handler serves, built once at start-up."""
+
+    def __init__(self):
+        self.index = DecadeIndex.from_arrays(ewt.pipeline.run('decade_index'))
+        static = static_figure()
+        data, self.traces = base_traces(static, self.index)
+        start, end = self.index.decades[0], self.index.decades[-1]
+        for i, update in zip(self.traces, frame_data(self.index, start, end)):
+            data[i] = merged(data[i], update)
+        figure = {'data': data, 'layout': static['layout']}
+
+        places = ewt.marker_columns(self.index.totals())
+        countries = places.drop_duplicates('CNTR_CODE').sort_values('country')
+        options = ''.join('<option value="%s">%s</option>' % (code, name)
+                          for code, name in zip(countries['CNTR_CODE'],
+                                                countries['country']))
+
+        self.page = (PAGE % {
+            'start': start, 'end': end, 'options': options,
+            'figure': json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder),
+            'traces': json.dumps(self.traces),
+        }).encode()
+        self.plotlyjs = get_plotlyjs().encode()
+
+    @lru_cache(maxsize=4096)
+    def data(self, start, end, countries):
+        """The Layer 4-6 updates as JSON bytes; `countries` is a tuple."""
+        return json.dumps(frame_data(self.index, start, end, countries),
+                          cls=plotly.utils.PlotlyJSONEncoder).encode()
+
+
+class MapHandler(BaseHTTPRequestHandler):
+    app = None  # set by serve()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/':
+            self.send(self.app.page, 'text/html; charset=utf-8')
+        elif url.path == '/plotly.min.js':
+            self.send(self.app.plotlyjs, 'application/javascript',
+                      cache='max-age=86400')
+        elif url.path == '/data':
+            query = parse_qs(url.query)
+            try:
+                start = int(query['start'][0])
+                end = int(query['end'][0])
+            except (KeyError, ValueError):
+                self.send_error(400, 'start and end must be decades')
+                return
+            countries = query.get('countries', [''])[0]
+            countries = tuple(sorted(c for c in countries.split(',') if c))
+            self.send(self.app.data(start, end, countries), 'application/json')
+        else:
+            self.send_error(404)
+
+    def send(self, body, content_type, cache='no-cache'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', cache)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no line per request
+
+
+class MapServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default 5 drops bursts of requests
+
+
+def serve(host='127.0.0.1', port=8050):
+    MapHandler.app = MapApp()
+    server = MapServer((host, port), MapHandler)
+    print('http://%s:%d/' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the interactive map '
+                                     'locally.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    args = parser.parse_args()
+    serve(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
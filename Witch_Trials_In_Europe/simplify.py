@@ -0,0 +1,61 @@
+# Level-of-detail pyramid for the map's geometry.
+
+# The Eurostat files are 1:10M, which is far more detail than a 1050 px wide
+# PNG of Europe can show, let alone a thumbnail. Each packed feature collection
+# (geo_cache.pack_features) is simplified at a few tolerances once, the
+# results are cached next to the full-resolution geometry, and the map then
+# takes the coarsest level whose tolerance stays under half a pixel.
+
+import numpy as np
+import shapely
+
+from spatial import from_shapely, to_shapely
+
+
+# Tolerances in degrees; level 0 is the full-resolution geometry.
+LOD_TOLERANCES = (0, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2)
+
+# Largest allowed vertex displacement, in output pixels.
+PIXEL_TOLERANCE = 0.5
+
+
+def simplify_packed(packed, tolerance):
+    """Topology-preserving (Douglas-Peucker) simplification of every feature:
+    rings never self-intersect and small islands are kept rather than
+    collapsed."""
+    if tolerance <= 0:
+        return {name: np.asarray(array) for name, array in packed.items()}
+    geometries = shapely.simplify(to_shapely(packed), tolerance,
+                                  preserve_topology=True)
+    return from_shapely(geometries, packed['ids'])
+
+
+def build_pyramid(packed, tolerances=LOD_TOLERANCES):
+    """All the levels in one dict of arrays, level i under the 'i.' prefix."""
+    pyramid = {}
+    for level, tolerance in enumerate(tolerances):
+        for name, array in simplify_packed(packed, tolerance).items():
+            pyramid['%d.%s' % (level, name)] = array
+    return pyramid
+
+
+def pyramid_level(pyramid, level):
+    prefix = '%d.' % level
+    return {name[len(prefix):]: array for name, array in pyramid.items()
+            if name.startswith(prefix)}
+
+
+def pick_level(width, height, lon_range, lat_range, tolerances=LOD_TOLERANCES,
+               pixel_tolerance=PIXEL_TOLERANCE):
+    """The coarsest level that is still invisible at width x height px for
+    the given lonaxis/lataxis ranges. The projection stretches latitudes
+    unevenly, so the smaller of the two degrees-per-pixel values is used."""
+    degrees_per_pixel = min(abs(lon_range[1] - lon_range[0]) / width,
+                            abs(lat_range[1] - lat_range[0]) / height)
+    allowed = degrees_per_pixel * pixel_tolerance
+    return max(level for level, tolerance in enumerate(tolerances)
+               if tolerance <= allowed)
+
+
+def vertex_count(packed):
+    return len(packed['coords'])
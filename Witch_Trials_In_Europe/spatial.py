@@ -0,0 +1,231 @@
+# Spatial helpers for the packed feature collections (see geo_cache.py).
+
+import numpy as np
+import shapely
+from shapely import STRtree, box
+
+from geo_cache import LINE, MULTILINE, MULTIPOLYGON, POLYGON
+
+
+LINE_KINDS = (LINE, MULTILINE)
+POLYGON_KINDS = (POLYGON, MULTIPOLYGON)
+
+
+# PACKED FEATURES <--> SHAPELY ************************************************
+
+def to_shapely(packed):
+    """Packed features --> an array of shapely geometries, one per feature."""
+    coords = np.asarray(packed['coords'])
+    ring_offsets = np.asarray(packed['ring_offsets'])
+    poly_offsets = np.asarray(packed['poly_offsets'])
+    feat_offsets = np.asarray(packed['feat_offsets'])
+    kinds = np.asarray(packed['kinds'])
+
+    if np.isin(kinds, LINE_KINDS).all():
+        # one ring per part, so ring numbers are part numbers
+        geometries = shapely.from_ragged_array(
+            shapely.GeometryType.MULTILINESTRING, coords,
+            (ring_offsets, feat_offsets))
+    elif np.isin(kinds, POLYGON_KINDS).all():
+        geometries = shapely.from_ragged_array(
+            shapely.GeometryType.MULTIPOLYGON, coords,
+            (ring_offsets, poly_offsets, feat_offsets))
+    else:
+        raise ValueError('cannot convert a mix of lines and polygons')
+
+    single = np.isin(kinds, (LINE, POLYGON))
+    geometries[single] = shapely.get_geometry(geometries[single], 0)
+    return geometries
+
+
+def from_shapely(geometries, ids):
+    """The inverse of to_shapely. Empty geometries aren't allowed: drop them
+    first."""
+    geometries = np.asarray(geometries, dtype=object)
+    types = shapely.get_type_id(geometries)
+    lines = np.isin(types, (shapely.GeometryType.LINESTRING,
+                            shapely.GeometryType.MULTILINESTRING))
+
+    # to_ragged_array wants one geometry type, so single lines and polygons
+    # go in as one-part multi-geometries (and come back out of to_shapely
+    # as singles thanks to their kind):
+    if lines.all():
+        single = types == shapely.GeometryType.LINESTRING
+        promote = shapely.multilinestrings
+    else:
+        single = types == shapely.GeometryType.POLYGON
+        promote = shapely.multipolygons
+    promoted = geometries.copy()
+    promoted[single] = promote(geometries[single],
+                               indices=np.arange(single.sum()))
+
+    _, coords, offsets = shapely.to_ragged_array(promoted)
+    if lines.all():
+        ring_offsets, feat_offsets = offsets
+        poly_offsets = np.arange(len(ring_offsets))
+        kinds = np.where(single, LINE, MULTILINE)
+    else:
+        ring_offsets, poly_offsets, feat_offsets = offsets
+        kinds = np.where(single, POLYGON, MULTIPOLYGON)
+
+    return {
+        'coords': coords,
+        'ring_offsets': ring_offsets.astype('int64'),
+        'poly_offsets': poly_offsets.astype('int64'),
+        'feat_offsets': feat_offsets.astype('int64'),
+        'kinds': kinds.astype('uint8'),
+        'ids': np.asarray(ids),
+    }
+
+
+# CLIPPING ********************************************************************
+
+def as_mask(mask):
+    """A clipping mask from a (minx, miny, maxx, maxy) bbox, a list of
+    (lon, lat) vertices or a ready shapely geometry."""
+    if isinstance(mask, shapely.Geometry):
+        return mask
+    if len(mask) == 4 and np.ndim(mask) == 1:
+        return box(*mask)
+    return shapely.Polygon(mask)
+
+
+def clip_to_mask(geometries, mask, whole=None, anchors=None):
+    """Intersect all the geometries with the mask in one vectorized call.
+
+    Features flagged in `whole` (e.g. islands) are never cut: they're kept as
+    they are when their anchor point (by default a point on their surface) is
+    inside the mask, and dropped otherwise. Returns the positions of the
+    features that aren't empty afterwards and their new geometries."""
+    geometries = np.asarray(geometries, dtype=object)
+    mask = as_mask(mask)
+    shapely.prepare(mask)
+
+    clipped = shapely.intersection(geometries, mask)
+
+    # Where the mask only grazes a feature, the result can be a collection
+    # with stray points or lines; keep the parts of the feature's own
+    # dimension:
+    grazed = np.flatnonzero(shapely.get_type_id(clipped)
+                            == shapely.GeometryType.GEOMETRYCOLLECTION)
+    for i in grazed:
+        parts = shapely.get_parts(clipped[i])
+        parts = parts[shapely.get_dimensions(parts)
+                      == shapely.get_dimensions(geometries[i])]
+        clipped[i] = shapely.union_all(parts)
+
+    if whole is not None:
+        whole = np.asarray(whole, dtype=bool)
+        if anchors is None:
+            anchors = shapely.point_on_surface(geometries)
+        inside = shapely.contains(mask, anchors)
+        clipped[whole & inside] = geometries[whole & inside]
+        clipped[whole & ~inside] = None
+
+    keep = np.flatnonzero(~(shapely.is_missing(clipped)
+                            | shapely.is_empty(clipped)))
+    return keep, clipped[keep]
+
+
+# BOUNDS INDEX ****************************************************************
+
+class BoundsIndex:
+    """Per-feature bounding boxes (minx, miny, maxx, maxy as NumPy arrays)
+    with an STRtree over them, so that picking the features that fall into a
+    map window is a single query instead of a loop over every feature."""
+
+    def __init__(self, minx, miny, maxx, maxy):
+        self.minx = np.asarray(minx, dtype='float64')
+        self.miny = np.asarray(miny, dtype='float64')
+        self.maxx = np.asarray(maxx, dtype='float64')
+        self.maxy = np.asarray(maxy, dtype='float64')
+        self.tree = STRtree(box(self.minx, self.miny, self.maxx, self.maxy))
+
+    @classmethod
+    def from_packed(cls, packed):
+        """Bounds of each feature's vertices, computed with one reduceat per
+        column over the flat coordinate array."""
+        coords = np.asarray(packed['coords'])
+        ring_offsets = np.asarray(packed['ring_offsets'])
+        poly_offsets = np.asarray(packed['poly_offsets'])
+        feat_offsets = np.asarray(packed['feat_offsets'])
+        starts = ring_offsets[poly_offsets[feat_offsets[:-1]]]
+        return cls(np.minimum.reduceat(coords[:, 0], starts),
+                   np.minimum.reduceat(coords[:, 1], starts),
+                   np.maximum.reduceat(coords[:, 0], starts),
+                   np.maximum.reduceat(coords[:, 1], starts))
+
+    def __len__(self):
+        return len(self.minx)
+
+    def to_arrays(self):
+        return {'minx': self.minx, 'miny': self.miny,
+                'maxx': self.maxx, 'maxy': self.maxy}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['minx'], arrays['miny'], arrays['maxx'],
+                   arrays['maxy'])
+
+    def query(self, window):
+        """Positions (in feature order) of the features whose bounds overlap
+        the (minx, miny, maxx, maxy) window. Features that only touch its
+        edge are left out."""
+        minx, miny, maxx, maxy = window
+        candidates = np.sort(self.tree.query(box(minx, miny, maxx, maxy)))
+        inside = ((self.maxx[candidates] > minx)
+                  & (self.minx[candidates] < maxx)
+                  & (self.maxy[candidates] > miny)
+                  & (self.miny[candidates] < maxy))
+        return candidates[inside]
+
+
+# POINT IN POLYGON ************************************************************
+
+class PolygonLocator:
+    """Polygons (e.g. the NUTS-3 regions) with an STRtree over them, to find
+    the polygon each of many points falls into with one bulk query."""
+
+    def __init__(self, geometries, ids):
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.ids = np.asarray(ids)
+        self.tree = STRtree(self.geometries)
+
+    @classmethod
+    def from_packed(cls, packed):
+        return cls(to_shapely(packed), packed['ids'])
+
+    def locate(self, lon, lat):
+        """Position of the polygon containing each point (-1 where there's
+        none, or the coordinates are missing). A point on the border of two
+        polygons goes to the first one.
+
+        The repeated coordinates are only looked up once, and all the points
+        go through the tree in one query that runs the exact test too."""
+        xy = np.column_stack([np.asarray(lon, dtype='float64'),
+                              np.asarray(lat, dtype='float64')])
+        found = np.full(len(xy), -1, dtype='int64')
+        known = ~np.isnan(xy).any(axis=1)
+        unique, inverse = np.unique(xy[known], axis=0, return_inverse=True)
+
+        points = shapely.points(unique)
+        point, polygon = self.tree.query(points, predicate='intersects')
+
+        # the first polygon of every point (the pairs sorted by point, then
+        # polygon):
+        order = np.lexsort([polygon, point])
+        point, polygon = point[order], polygon[order]
+        first = np.r_[True, point[1:] != point[:-1]]
+        position = np.full(len(unique), -1, dtype='int64')
+        position[point[first]] = polygon[first]
+
+        found[known] = position[inverse.ravel()]
+        return found
+
+    def locate_ids(self, lon, lat):
+        """The id of the polygon containing each point (None where there's
+        none)."""
+        found = self.locate(lon, lat)
+        ids = self.ids.astype(object)[np.maximum(found, 0)]
+        ids[found < 0] = None
+        return ids
@@ -0,0 +1,115 @@
+# A stage reruns when the project code it calls changes (pipeline.py).
+
+import importlib
+import os
+import sys
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pipeline import Pipeline  # noqa: E402
+
+
+STAGES = '''
+    import numpy as np
+
+    import helpers
+
+
+    def numbers():
+        return {'x': np.array([helpers.double(1)])}
+'''
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """A folder with a stage module and its helpers, importable."""
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    def write(name, text):
+        (tmp_path / (name + '.py')).write_text(textwrap.dedent(text))
+
+    def load():
+        """A pipeline over the modules as they're on the disk now."""
+        for name in ('helpers', 'stages'):
+            sys.modules.pop(name, None)
+        importlib.invalidate_caches()
+        stages = importlib.import_module('stages')
+        pipeline = Pipeline(str(tmp_path / '.stage_cache'))
+        pipeline.stage(name='numbers')(stages.numbers)
+        return pipeline
+
+    write('stages', STAGES)
+    yield write, load
+    for name in ('helpers', 'stages'):
+        sys.modules.pop(name, None)
+
+
+def run(load):
+    pipeline = load()
+    result = pipeline.run('numbers')
+    return int(result['x'][0]), pipeline.executed
+
+
+@pytest.mark.parametrize('edited', [
+    # a helper's code
+    '''
+    def double(x, scale=2):
+        return x * scale + 1
+    ''',
+    # a default argument
+    '''
+    def double(x, scale=3):
+        return x * scale
+    ''',
+])
+def test_helper_change_reruns_stage(project, edited):
+    write, load = project
+    write('helpers', '''
+    def double(x, scale=2):
+        return x * scale
+    ''')
+    assert run(load) == (2, ['numbers'])
+    assert run(load) == (2, [])  # cached
+
+    write('helpers', edited)
+    value, executed = run(load)
+    assert executed == ['numbers']
+    assert value != 2
+
+
+def test_constant_change_reruns_stage(project):
+    write, load = project
+    write('helpers', '''
+    SCALE = 2
+
+    def double(x):
+        return x * SCALE
+    ''')
+    assert run(load) == (2, ['numbers'])
+    write('helpers', '''
+    SCALE = 5
+
+    def double(x):
+        return x * SCALE
+    ''')
+    assert run(load) == (5, ['numbers'])
+
+
+def test_comment_change_keeps_cache(project):
+    write, load = project
+    write('helpers', '''
+    def double(x):
+        return x * 2
+    ''')
+    assert run(load) == (2, ['numbers'])
+    write('helpers', '''
+    def double(x):
+        # twice x
+        return x * 2
+    ''')
+    assert run(load) == (2, [])
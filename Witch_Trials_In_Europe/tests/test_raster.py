@@ -0,0 +1,49 @@
+# The raster backend draws the map as Kaleido does (raster.py), to within
+# MAX_MEAN_DIFFERENCE levels on average and MAX_OFF_SHARE of the pixels
+# more than OFF_LEVELS off. Skipped where Kaleido can't draw it (no
+# Kaleido, or no network for plotly's topojson files: KALEIDO_TOPOJSON can
+# point to a local folder of them).
+
+import io
+import os
+import sys
+import warnings
+
+import pytest
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT)
+
+import raster  # noqa: E402
+
+
+@pytest.fixture
+def kaleido(monkeypatch):
+    pytest.importorskip('kaleido')
+    import plotly.io as pio
+    if os.environ.get('KALEIDO_TOPOJSON'):
+        monkeypatch.setattr(pio.kaleido.scope, 'topojson',
+                            os.environ['KALEIDO_TOPOJSON'])
+    return pio
+
+
+def test_raster_matches_kaleido(kaleido, monkeypatch):
+    monkeypatch.chdir(PROJECT)
+    import eu_witch_trials as ewt
+    from PIL import Image
+
+    fig = ewt.pipeline.run('figure')
+    width, height = ewt.view['width'], ewt.view['height']
+    try:
+        png = kaleido.to_image(fig, format='png', width=width,
+                               height=height, validate=False)
+    except ValueError as error:
+        pytest.skip("Kaleido can't draw the map here: %s" % error)
+    with warnings.catch_warnings():
+        # the fonts that aren't installed: Chromium falls back as well
+        warnings.simplefilter('ignore')
+        image = raster.render_figure(fig, width, height, font_fallback=True)
+
+    mean, off = raster.pixel_difference(image, Image.open(io.BytesIO(png)))
+    assert mean <= raster.MAX_MEAN_DIFFERENCE
+    assert off <= raster.MAX_OFF_SHARE
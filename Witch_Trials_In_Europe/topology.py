@@ -0,0 +1,293 @@
+# Boundaries as a topology: shared arcs on a quantized grid (as TopoJSON).
+
+# In the GeoJSON layers every border between two neighbours is stored twice,
+# once in each polygon, with full-precision floats. A topology snaps all the
+# vertices to a grid (`step` degrees apart), cuts the rings into arcs at the
+# points where they meet other rings, and stores every arc once; a ring is a
+# list of arc numbers (~i for arc i walked backwards). Written as TopoJSON,
+# the arcs' points are small integer deltas (as typed arrays in the exported
+# page).
+
+# Topology.from_packed() builds one from packed features (geo_cache.py),
+# to_packed() turns it back into packed features (all in NumPy, no loop over
+# the points), to_topojson() writes the TopoJSON dict, and DECODE_JS is the
+# browser-side decoder the exported page (export.py) uses.
+
+import numpy as np
+
+from geo_cache import KIND_NAMES, LINE, MULTILINE, POLYGON
+
+
+# Grid step in degrees: 1e-3 is about 100 m, a fifth of the finest
+# simplification tolerance (simplify.LOD_TOLERANCES) and ~1/25 of a pixel
+# of the map. The deltas along the arcs then fit in 16 bits.
+STEP = 1e-3
+
+
+# BUILDING ********************************************************************
+
+def point_ids(q):
+    """One integer per distinct grid point of the (n, 2) integer array."""
+    width = q[:, 1].max() + 1 if len(q) else 1
+    return q[:, 0] * width + q[:, 1]
+
+
+def junctions(pid, ring_starts, ring_ends):
+    """The point ids where rings meet or part: points seen with different
+    pairs of neighbours. `ring_starts`/`ring_ends` delimit the cyclic
+    rings (without their closing points) in `pid`."""
+    lengths = ring_ends - ring_starts
+    position = np.arange(len(pid)) - np.repeat(ring_starts, lengths)
+    start = np.repeat(ring_starts, lengths)
+    length = np.repeat(lengths, lengths)
+    prev = pid[start + (position - 1) % length]
+    next = pid[start + (position + 1) % length]
+    pairs = np.column_stack([pid, np.minimum(prev, next),
+                             np.maximum(prev, next)])
+    seen = np.unique(pairs, axis=0)[:, 0]
+    ids, count = np.unique(seen, return_counts=True)
+    return ids[count > 1]
+
+
+class Topology:
+    """Arcs (integer grid points, arcs[arc_offsets[i]:arc_offsets[i + 1]]
+    is arc i) and the features: each ring is a run of signed arc numbers in
+    `ring_arcs` (ring_arc_offsets), grouped into polygons and features as in
+    the packed format. Coordinates are `q * step + origin`."""
+
+    def __init__(self, arcs, arc_offsets, ring_arcs, ring_arc_offsets,
+                 poly_offsets, feat_offsets, kinds, ids, step, origin):
+        self.arcs = np.asarray(arcs, dtype='int64').reshape(-1, 2)
+        self.arc_offsets = np.asarray(arc_offsets, dtype='int64')
+        self.ring_arcs = np.asarray(ring_arcs, dtype='int64')
+        self.ring_arc_offsets = np.asarray(ring_arc_offsets, dtype='int64')
+        self.poly_offsets = np.asarray(poly_offsets, dtype='int64')
+        self.feat_offsets = np.asarray(feat_offsets, dtype='int64')
+        self.kinds = np.asarray(kinds, dtype='uint8')
+        self.ids = np.asarray(ids)
+        self.step = float(step)
+        self.origin = np.asarray(origin, dtype='float64')
+
+    @classmethod
+    def from_packed(cls, packed, step=STEP):
+        coords = np.asarray(packed['coords'], dtype='float64')
+        ring_offsets = np.asarray(packed['ring_offsets'])
+        kinds = np.asarray(packed['kinds'])
+        if np.isin(kinds, (LINE, MULTILINE)).any():
+            raise ValueError('only polygons can be turned into a topology')
+
+        origin = coords.min(axis=0) if len(coords) else np.zeros(2)
+        q = np.round((coords - origin) / step).astype('int64')
+
+        # Drop the points that fall onto the previous one of their ring:
+        n = len(ring_offsets) - 1
+        ring = np.repeat(np.arange(n), np.diff(ring_offsets))
+        repeated = np.r_[False, (q[1:] == q[:-1]).all(axis=1)
+                         & (ring[1:] == ring[:-1])]
+        q, ring = q[~repeated], ring[~repeated]
+        counts = np.bincount(ring, minlength=n)
+        ends = np.cumsum(counts)
+
+        # ... and the closing ones: the rings are cyclic from here on.
+        closing = counts > 1
+        closing[closing] = (q[ends[closing] - 1]
+                            == q[(ends - counts)[closing]]).all(axis=1)
+        keep = np.ones(len(q), dtype=bool)
+        keep[ends[closing] - 1] = False
+        q = q[keep]
+        counts = counts - closing
+        starts = np.cumsum(counts) - counts
+
+        pid = point_ids(q)
+        is_junction = np.isin(pid, junctions(pid, starts, starts + counts))
+
+        arcs, arc_offsets, ring_arcs, ring_arc_offsets = [], [0], [], [0]
+        known = {}  # an arc's point ids (as bytes) --> its number
+
+        def add_arc(points):
+            key = pid[points].tobytes()
+            if key in known:
+                return known[key]
+            back = pid[points[::-1]].tobytes()
+            if back in known:
+                return ~known[back]
+            known[key] = len(arcs)
+            arcs.append(q[points])
+            arc_offsets.append(arc_offsets[-1] + len(points))
+            return known[key]
+
+        positions = np.arange(len(q))
+        for start, count in zip(starts.tolist(), counts.tolist()):
+            points = positions[start:start + count]
+            cuts = np.flatnonzero(is_junction[points])
+            if not len(cuts):
+                # a ring touching no other: one closed arc, starting at its
+                # smallest point so that the same ring elsewhere matches
+                points = np.roll(points, -np.argmin(pid[points]))
+                ring_arcs.append(add_arc(np.r_[points, points[:1]]))
+            else:
+                points = np.roll(points, -cuts[0])
+                cuts = np.r_[cuts - cuts[0], count]
+                for a, b in zip(cuts[:-1], cuts[1:]):
+                    ring_arcs.append(add_arc(
+                        np.r_[points[a:b], points[b % count]]))
+            ring_arc_offsets.append(len(ring_arcs))
+
+        return cls(np.concatenate(arcs) if arcs else np.zeros((0, 2)),
+                   arc_offsets, ring_arcs, ring_arc_offsets,
+                   packed['poly_offsets'], packed['feat_offsets'], kinds,
+                   packed['ids'], step, origin)
+
+    def to_arrays(self):
+        return {'arcs': self.arcs, 'arc_offsets': self.arc_offsets,
+                'ring_arcs': self.ring_arcs,
+                'ring_arc_offsets': self.ring_arc_offsets,
+                'poly_offsets': self.poly_offsets,
+                'feat_offsets': self.feat_offsets, 'kinds': self.kinds,
+                'ids': self.ids, 'step': np.array(self.step),
+                'origin': self.origin}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['arcs'], arrays['arc_offsets'], arrays['ring_arcs'],
+                   arrays['ring_arc_offsets'], arrays['poly_offsets'],
+                   arrays['feat_offsets'], arrays['kinds'], arrays['ids'],
+                   arrays['step'], arrays['origin'])
+
+    # DECODING ****************************************************************
+
+    def to_packed(self):
+        """The features as packed arrays: every ring is its arcs laid end to
+        end (reversed ones backwards), each arc after the first without its
+        first point, which is the previous arc's last."""
+        refs = self.ring_arcs
+        arc = np.where(refs < 0, ~refs, refs)
+        start, end = self.arc_offsets[arc], self.arc_offsets[arc + 1]
+        first = np.zeros(len(refs), dtype=bool)
+        first[self.ring_arc_offsets[:-1]] = True
+        skip = (~first).astype('int64')
+        lengths = end - start - skip
+
+        within = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        forward = np.repeat(start + skip, lengths) + within
+        backward = np.repeat(end - 1 - skip, lengths) - within
+        index = np.where(np.repeat(refs < 0, lengths), backward, forward)
+
+        # (every ring has at least one arc)
+        ring_lengths = np.add.reduceat(lengths, self.ring_arc_offsets[:-1]) \
+            if len(lengths) else np.zeros(0, dtype='int64')
+        return {
+            'coords': self.arcs[index] * self.step + self.origin,
+            'ring_offsets': np.r_[0, np.cumsum(ring_lengths)].astype('int64'),
+            'poly_offsets': self.poly_offsets,
+            'feat_offsets': self.feat_offsets,
+            'kinds': self.kinds,
+            'ids': self.ids,
+        }
+
+    # TOPOJSON ****************************************************************
+
+    def to_topojson(self, name='features', typed=False):
+        """A TopoJSON dict with the features as one GeometryCollection
+        object; the arcs are delta-encoded. With `typed`, the arcs are three
+        NumPy arrays instead of nested lists, for the page to send as typed
+        arrays (export.py): every arc's first point (`starts`), the
+        differences from the previous point of all the others (`deltas`),
+        and the number of points of each arc (`lengths`). DECODE_JS reads
+        both forms."""
+        deltas = self.arcs.copy()
+        lengths = np.diff(self.arc_offsets)
+        starts = self.arc_offsets[:-1][lengths > 0]
+        deltas[1:] -= self.arcs[:-1]
+        deltas[starts] = self.arcs[starts]
+        if typed:
+            first = np.zeros(len(deltas), dtype=bool)
+            first[starts] = True
+            arcs = {'starts': deltas[first], 'deltas': deltas[~first],
+                    'lengths': lengths}
+        else:
+            deltas = deltas.tolist()
+            arcs = [deltas[a:b] for a, b in zip(
+                self.arc_offsets[:-1].tolist(), self.arc_offsets[1:].tolist())]
+
+        ring_arcs = self.ring_arcs.tolist()
+        rings = [ring_arcs[a:b] for a, b in zip(
+            self.ring_arc_offsets[:-1].tolist(),
+            self.ring_arc_offsets[1:].tolist())]
+        poly_offsets = self.poly_offsets.tolist()
+        polygons = [rings[a:b] for a, b in zip(poly_offsets[:-1],
+                                               poly_offsets[1:])]
+        feat_offsets = self.feat_offsets.tolist()
+
+        geometries = []
+        for i, (kind, idx) in enumerate(zip(self.kinds.tolist(),
+                                            self.ids.tolist())):
+            parts = polygons[feat_offsets[i]:feat_offsets[i + 1]]
+            geometries.append({
+                'type': KIND_NAMES[kind], 'id': idx,
+                'arcs': parts[0] if kind == POLYGON else parts})
+
+        return {
+            'type': 'Topology',
+            'transform': {'scale': [self.step, self.step],
+                          'translate': self.origin.tolist()},
+            'objects': {name: {'type': 'GeometryCollection',
+                               'geometries': geometries}},
+            'arcs': arcs,
+        }
+
+
+# The page-side decoder: TopoJSON (one GeometryCollection of polygons, with
+# the arcs as nested lists or as to_topojson(typed=True)'s typed arrays) -->
+# GeoJSON FeatureCollection.
+DECODE_JS = '''
+const TYPED_ARRAYS = {i1: Int8Array, u1: Uint8Array, i2: Int16Array,
+                      u2: Uint16Array, i4: Int32Array, u4: Uint32Array,
+                      f4: Float32Array, f8: Float64Array};
+function flatValues(value) {
+  if (Array.isArray(value)) {
+    return value.flat();
+  }
+  const bytes = Uint8Array.from(atob(value.bdata), c => c.charCodeAt(0));
+  return new TYPED_ARRAYS[value.dtype](bytes.buffer);
+}
+function deltaArcs(arcs) {
+  if (Array.isArray(arcs)) {
+    return arcs;
+  }
+  const starts = flatValues(arcs.starts), deltas = flatValues(arcs.deltas);
+  let next = 0;
+  return Array.from(flatValues(arcs.lengths), (length, i) => {
+    const arc = [[starts[2 * i], starts[2 * i + 1]]];
+    for (let k = 1; k < length; k++, next += 2) {
+      arc.push([deltas[next], deltas[next + 1]]);
+    }
+    return arc;
+  });
+}
+function topologyFeatures(topology, name) {
+  const [sx, sy] = topology.transform.scale;
+  const [tx, ty] = topology.transform.translate;
+  const arcs = deltaArcs(topology.arcs).map(arc => {
+    let x = 0, y = 0;
+    return arc.map(([dx, dy]) => [(x += dx) * sx + tx, (y += dy) * sy + ty]);
+  });
+  const ring = refs => {
+    const points = [];
+    refs.forEach((ref, i) => {
+      const arc = ref < 0 ? arcs[~ref].slice().reverse() : arcs[ref];
+      points.push(...(i ? arc.slice(1) : arc));
+    });
+    return points;
+  };
+  const polygon = rings => rings.map(ring);
+  return {
+    type: 'FeatureCollection',
+    features: topology.objects[name].geometries.map(g => ({
+      type: 'Feature', id: g.id,
+      geometry: {type: g.type, coordinates: g.type === 'Polygon'
+        ? polygon(g.arcs) : g.arcs.map(polygon)}})),
+  };
+}
+'''